@@ -44,7 +44,8 @@ and writePlistToString().
 from Foundation import NSData, \
                        NSPropertyListSerialization, \
                        NSPropertyListMutableContainers, \
-                       NSPropertyListXMLFormat_v1_0
+                       NSPropertyListXMLFormat_v1_0, \
+                       NSPropertyListBinaryFormat_v1_0
 
 class FoundationPlistException(Exception):
     pass
@@ -55,12 +56,16 @@ class NSPropertyListSerializationException(FoundationPlistException):
 class NSPropertyListWriteException(FoundationPlistException):
     pass
 
-def readPlist(filepath):
+def readPlist(filepath, mapped=False):
     """
     Read a .plist file from filepath.  Return the unpacked root object
-    (which is usually a dictionary).
+    (which is usually a dictionary). If mapped is True, the file is
+    memory-mapped instead of read into memory up front.
     """
-    plistData = NSData.dataWithContentsOfFile_(filepath)
+    if mapped:
+        plistData = NSData.dataWithContentsOfMappedFile_(filepath)
+    else:
+        plistData = NSData.dataWithContentsOfFile_(filepath)
     dataObject, plistFormat, error = \
         NSPropertyListSerialization.propertyListFromData_mutabilityOption_format_errorDescription_(
                      plistData, NSPropertyListMutableContainers, None, None)
@@ -85,13 +90,18 @@ def readPlistFromString(data):
         return dataObject
 
 
-def writePlist(dataObject, filepath):
+def writePlist(dataObject, filepath, binary=False):
     '''
-    Write 'rootObject' as a plist to filepath.
+    Write 'rootObject' as a plist to filepath. If binary is True, write
+    a binary plist instead of an XML one.
     '''
+    if binary:
+        plistFormat = NSPropertyListBinaryFormat_v1_0
+    else:
+        plistFormat = NSPropertyListXMLFormat_v1_0
     plistData, error = \
      NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-                            dataObject, NSPropertyListXMLFormat_v1_0, None)
+                            dataObject, plistFormat, None)
     if error:
         error = error.encode('ascii', 'ignore')
         raise NSPropertyListSerializationException(error)
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+catalogindex
+
+An SQLite index of a repo's catalogs, written by makecatalogs next to the
+catalogs, so munkiimport and manifestutil can look things up without
+reading and parsing every catalog each time they run.
+
+Note: this module should be 100% free of ObjC-dependant Python imports,
+since manifestutil and makecatalogs can run without PyObjC.
+"""
+
+
+import os
+import sqlite3
+
+
+# lives in the catalogs directory; the leading period keeps it from being
+# mistaken for a catalog
+INDEX_FILENAME = '.catalogs.sqlite'
+# bump this when the schema changes; older indexes are then ignored
+INDEX_VERSION = 2
+
+# the lookup tables munkiimport uses to find an existing pkginfo
+LOOKUP_KINDS = ['hashes', 'receipts', 'applications', 'installer_items']
+
+
+def lookupRows(catalogitems, warn=None):
+    """Generates (kind, key, version, itemindex) tuples for the lookup
+    tables of a list of pkginfo items, usually catalogs/all.
+    warn, if given, is called with a message for each bad item."""
+    for itemindex, item in enumerate(catalogitems):
+        name = item.get('name', 'NO NAME')
+        vers = item.get('version', 'NO VERSION')
+
+        if (name == 'NO NAME' or vers == 'NO VERSION') and warn:
+            warn('Bad pkginfo: %s' % item)
+
+        if 'installer_item_hash' in item:
+            yield ('hashes', item['installer_item_hash'], vers, itemindex)
+
+        if 'installer_item_location' in item:
+            yield ('installer_items',
+                   os.path.basename(item['installer_item_location']),
+                   vers, itemindex)
+
+        for receipt in item.get('receipts', []):
+            try:
+                if 'packageid' in receipt and 'version' in receipt:
+                    yield ('receipts', receipt['packageid'], vers, itemindex)
+            except TypeError:
+                if warn:
+                    warn('Bad receipt data for %s-%s: %s'
+                         % (name, vers, receipt))
+
+        for install in item.get('installs', []):
+            try:
+                if install.get('type') == 'application':
+                    if 'path' in install:
+                        yield ('applications', install['path'], vers,
+                               itemindex)
+            except (TypeError, AttributeError):
+                if warn:
+                    warn('Bad install data for %s-%s: %s'
+                         % (name, vers, install))
+
+
+def lookupTables(rows):
+    """Builds the lookup tables from (kind, key, version, itemindex) rows.
+    Returns a dict with a table for each of LOOKUP_KINDS. The hashes table
+    maps a hash to a list of item indexes; the others map a key to a dict
+    of version: list of item indexes."""
+    tables = {}
+    for kind in LOOKUP_KINDS:
+        tables[kind] = {}
+    for kind, key, vers, itemindex in rows:
+        table = tables[kind]
+        if kind == 'hashes':
+            if not key in table:
+                table[key] = []
+            table[key].append(itemindex)
+        else:
+            if not key in table:
+                table[key] = {}
+            if not vers in table[key]:
+                table[key][vers] = []
+            table[key][vers].append(itemindex)
+    return tables
+
+
+def fileSignature(path):
+    """Returns a string that changes when the file at path does, or None if
+    it doesn't exist"""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return '%r:%s:%s' % (info.st_mtime, info.st_size, info.st_ino)
+
+
+def indexText(value):
+    """Returns value as unicode for storing in an index"""
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return unicode(value, 'utf-8', 'replace')
+    return unicode(value)
+
+
+def writeIndex(indexpath, catalogs, serialize, catalogsdir=None):
+    """Writes an index of catalogs to indexpath.
+    catalogs is a dict of catalog name: list of pkginfo items, including
+    'all'; the other catalogs must contain the same pkginfo objects as
+    'all'. serialize turns a pkginfo into a plist string.
+    The catalog files, already written, are in catalogsdir, or in the
+    index's directory if it isn't given; we record their signatures so
+    openIndex can tell when they change."""
+    if catalogsdir is None:
+        catalogsdir = os.path.dirname(indexpath)
+    if os.path.exists(indexpath):
+        os.remove(indexpath)
+    db = sqlite3.connect(indexpath)
+    try:
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.execute('CREATE TABLE catalogs (name TEXT PRIMARY KEY, '
+                   'signature TEXT)')
+        db.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, '
+                   'name TEXT, update_for INTEGER, pkginfo BLOB)')
+        db.execute('CREATE TABLE catalog_items (catalog TEXT, '
+                   'item_id INTEGER)')
+        db.execute('CREATE TABLE lookups (kind TEXT, key TEXT, '
+                   'version TEXT, item_id INTEGER)')
+
+        allitems = catalogs['all']
+        db.executemany(
+            'INSERT INTO items VALUES (?, ?, ?, ?)',
+            ((itemindex,
+              'name' in item and indexText(item['name']) or None,
+              bool(item.get('update_for')),
+              sqlite3.Binary(serialize(item)))
+             for itemindex, item in enumerate(allitems)))
+        db.executemany(
+            'INSERT INTO lookups VALUES (?, ?, ?, ?)',
+            ((kind, indexText(key), indexText(vers), itemindex)
+             for kind, key, vers, itemindex in lookupRows(allitems)))
+
+        item_ids = dict((id(item), itemindex)
+                        for itemindex, item in enumerate(allitems))
+        for catalogname in catalogs:
+            db.execute('INSERT INTO catalogs VALUES (?, ?)',
+                       (indexText(catalogname),
+                        fileSignature(os.path.join(catalogsdir,
+                                                   catalogname))))
+            db.executemany(
+                'INSERT INTO catalog_items VALUES (?, ?)',
+                ((indexText(catalogname), item_ids[id(item)])
+                 for item in catalogs[catalogname]))
+
+        db.execute('CREATE INDEX lookups_key ON lookups (kind, key)')
+        db.execute('CREATE INDEX catalog_items_catalog '
+                   'ON catalog_items (catalog)')
+        db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+        db.commit()
+    finally:
+        db.close()
+
+
+def openIndex(catalogsdir):
+    """Returns a connection to the index in catalogsdir, or None if there
+    isn't a usable one: missing, from another version, or out of date
+    because catalogs were added, removed or changed since it was written.
+    Catalogs are compared by size, modification date and inode, so a
+    catalog copied in with its old modification date still counts as
+    changed."""
+    indexpath = os.path.join(catalogsdir, INDEX_FILENAME)
+    if not os.path.isfile(indexpath):
+        return None
+    try:
+        db = sqlite3.connect(indexpath)
+    except sqlite3.Error:
+        return None
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] == INDEX_VERSION:
+            signatures = dict(
+                db.execute('SELECT name, signature FROM catalogs'))
+            if _catalogsMatch(catalogsdir, signatures):
+                return db
+    except (OSError, sqlite3.Error):
+        pass
+    db.close()
+    return None
+
+
+def _catalogsMatch(catalogsdir, signatures):
+    """Returns True if the catalog files in catalogsdir are the ones
+    described by signatures, a dict of catalog name: fileSignature"""
+    for name, signature in signatures.items():
+        if fileSignature(os.path.join(catalogsdir, name)) != signature:
+            return False
+    # names in the index are unicode
+    for name in os.listdir(indexText(catalogsdir)):
+        if name.startswith('.') or name in signatures:
+            continue
+        if name.endswith('.gz') and name[:-3] in signatures:
+            # makecatalogs' gzipped copy of an indexed catalog
+            continue
+        if os.path.isfile(os.path.join(catalogsdir, name)):
+            return False
+    return True
+
+
+def catalogNames(db):
+    """Returns the names of the indexed catalogs, including 'all'"""
+    return [row[0] for row in db.execute('SELECT name FROM catalogs')]
+
+
+def installerItemNames(db, cataloglist):
+    """Returns a sorted list of the unique names of the items in the given
+    catalogs that aren't updates for other items"""
+    names = set()
+    for catalogname in cataloglist:
+        names.update(
+            row[0] for row in db.execute(
+                'SELECT DISTINCT items.name FROM catalog_items '
+                'JOIN items ON items.id = catalog_items.item_id '
+                'WHERE catalog_items.catalog = ? AND NOT items.update_for '
+                'AND items.name IS NOT NULL', (indexText(catalogname),)))
+    return sorted(names)
+
+
+def indexedLookupTables(db):
+    """Returns the lookup tables stored in the index, or None if they
+    can't be read; see lookupTables"""
+    try:
+        return lookupTables(
+            db.execute('SELECT kind, key, version, item_id FROM lookups'))
+    except sqlite3.Error:
+        return None
+
+
+class IndexedItems(object):
+    """The pkginfo items of catalogs/all, read from the index as they are
+    needed. Indexes match the ones in the lookup tables."""
+
+    def __init__(self, db, deserialize):
+        self.db = db
+        self.deserialize = deserialize
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def __getitem__(self, itemindex):
+        row = self.db.execute('SELECT pkginfo FROM items WHERE id = ?',
+                              (itemindex,)).fetchone()
+        if row is None:
+            raise IndexError(itemindex)
+        return self.deserialize(str(row[0]))
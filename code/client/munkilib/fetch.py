@@ -22,19 +22,31 @@ Created by Greg Neagle on 2011-09-29.
 """
 
 #standard libs
+import base64
 import calendar
+import datetime
+import email.utils
 import errno
+import hashlib
+import httplib
 import os
 import re
 import shutil
+import socket
+import ssl
 import subprocess
+import tempfile
+import threading
 import time
+import urllib
 import urllib2
 import urlparse
 import xattr
+import zlib
 
 #our libs
 import munkicommon
+import utils
 #import munkistatus
 
 
@@ -42,6 +54,20 @@ import munkicommon
 XATTR_ETAG = 'com.googlecode.munki.etag'
 # XATTR name storing the sha256 of the file after original download by munki.
 XATTR_SHA = 'com.googlecode.munki.sha256'
+# XATTR name storing the progress of a segmented download, so it can be
+# resumed
+XATTR_SEGMENTS = 'com.googlecode.munki.segments'
+
+# seconds without any data before httpget gives up, like curl's speed-time
+HTTP_TIMEOUT = 30
+# most redirects httpget will follow
+MAX_REDIRECTS = 10
+# seconds to wait for a peer cache to accept a connection
+PEER_CONNECT_TIMEOUT = 3
+# how many more times segmentedget tries segments that fail
+SEGMENT_RETRIES = 1
+# how many bytes a segment downloads between saves of its progress
+SEGMENT_CHECKPOINT_SIZE = 8 * 1024 * 1024
 
 
 class CurlError(Exception):
@@ -66,6 +92,10 @@ class PackageVerificationError(MunkiDownloadError):
     """Package failed verification"""
     pass
 
+class DownloadWindowError(MunkiDownloadError):
+    """Download not attempted because we're outside the download window"""
+    pass
+
 
 def getxattr(pathname, attr):
     """Get a named xattr from a file. Return None if not present"""
@@ -87,10 +117,68 @@ def writeCachedChecksum(file_path, fhash=None):
     return None
 
 
+# per-thread download settings. Downloads running alongside others set
+# quiet_progress so they don't fight over the progress display.
+THREAD_SETTINGS = threading.local()
+
+def displayPercentDone(current, maximum):
+    """Displays download progress, unless this thread's downloads should
+    be quiet"""
+    if not getattr(THREAD_SETTINGS, 'quiet_progress', False):
+        munkicommon.display_percent_done(current, maximum)
+
+
+class DownloadHasher(object):
+    """Computes the sha256 hash of a file while it is being downloaded, so
+    we don't have to read the whole file again when it's done.
+
+    Either feed it the downloaded data with update(), or call catchUp() to
+    hash whatever has been appended to the file since the last call."""
+
+    def __init__(self, path):
+        self.path = path
+        self.hash_function = hashlib.sha256()
+        self.offset = 0
+
+    def update(self, data):
+        """Hash data that was just appended to the file"""
+        self.hash_function.update(data)
+        self.offset += len(data)
+
+    def catchUp(self):
+        """Hash any bytes appended to the file since we last looked"""
+        try:
+            fileobj = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            fileobj.seek(self.offset)
+            while True:
+                chunk = fileobj.read(2**16)
+                if not chunk:
+                    break
+                self.update(chunk)
+        finally:
+            fileobj.close()
+
+    def hexdigest(self):
+        """Returns the hash of the whole file, or None if we haven't seen
+        all of it (for example, if it was modified behind our back)."""
+        self.catchUp()
+        try:
+            if os.path.getsize(self.path) != self.offset:
+                return None
+        except OSError:
+            return None
+        return self.hash_function.hexdigest()
+
+
 WARNINGSLOGGED = {}
 def curl(url, destinationpath,
          cert_info=None, custom_headers=None, donotrecurse=False, etag=None,
-         message=None, onlyifnewer=False, resume=False, follow_redirects=False):
+         message=None, onlyifnewer=False, resume=False, follow_redirects=False,
+         rate_limit=None, max_time=None, compressed=False,
+         connect_timeout=None):
     """Gets an HTTP or HTTPS URL and stores it in
     destination path. Returns a dictionary of headers, which includes
     http_result_code and http_result_description.
@@ -104,19 +192,28 @@ def curl(url, destinationpath,
     Finally, if you set resume to True, curl will attempt to resume an
     interrupted download. You'll get an error if the existing file is
     complete; if the file has changed since the first download attempt, you'll
-    get a mess."""
+    get a mess.
+    rate_limit is the maximum download speed in KB/sec, and max_time the
+    maximum number of seconds the transfer may take; a download stopped
+    because of max_time is kept for resuming later if resume is True.
+    If compressed is True, we ask the server for a compressed response and
+    decompress it as it's written.
+    connect_timeout is the maximum number of seconds to wait for the server
+    to accept the connection."""
 
     header = {}
     header['http_result_code'] = '000'
     header['http_result_description'] = ''
 
-    curldirectivepath = os.path.join(munkicommon.tmpdir, 'curl_temp')
     tempdownloadpath = destinationpath + '.download'
 
     # we're writing all the curl options to a file and passing that to
-    # curl so we avoid the problem of URLs showing up in a process listing
+    # curl so we avoid the problem of URLs showing up in a process listing.
+    # Each call gets its own file so several downloads can run at once.
     try:
-        fileobj = open(curldirectivepath, mode='w')
+        fd, curldirectivepath = tempfile.mkstemp(prefix='curl_temp.',
+                                                 dir=munkicommon.tmpdir)
+        fileobj = os.fdopen(fd, 'w')
         print >> fileobj, 'silent'          # no progress meter
         print >> fileobj, 'show-error'      # print error msg to stderr
         print >> fileobj, 'no-buffer'       # don't buffer output
@@ -126,6 +223,14 @@ def curl(url, destinationpath,
         print >> fileobj, 'output = "%s"' % tempdownloadpath
         print >> fileobj, 'ciphers = HIGH,!ADH' #use only secure >=128 bit SSL
         print >> fileobj, 'url = "%s"' % url
+        if rate_limit:
+            print >> fileobj, 'limit-rate = %sK' % int(rate_limit)
+        if max_time:
+            print >> fileobj, 'max-time = %s' % int(max_time)
+        if connect_timeout:
+            print >> fileobj, 'connect-timeout = %s' % int(connect_timeout)
+        if compressed and not resume:
+            print >> fileobj, 'compressed'
 
         munkicommon.display_debug2('follow_redirects is %s', follow_redirects)
         if follow_redirects:
@@ -228,6 +333,9 @@ def curl(url, destinationpath,
     downloadedpercent = -1
     donewithheaders = False
     maxheaders = 15
+    # hash the file as it downloads; when resuming this includes the
+    # partial file we already have
+    hasher = DownloadHasher(tempdownloadpath)
 
     while True:
         if not donewithheaders:
@@ -266,6 +374,11 @@ def curl(url, destinationpath,
                         targetsize = int(targetsize)
                     except (ValueError, TypeError):
                         targetsize = 0
+                    if header.get('content-encoding', 'identity') not in [
+                            'identity', '']:
+                        # curl decompresses as it writes, so the file won't
+                        # end up Content-Length bytes
+                        targetsize = 0
                     if header.get('http_result_code') == '206':
                         # partial content because we're resuming
                         munkicommon.display_detail(
@@ -293,12 +406,15 @@ def curl(url, destinationpath,
                 if percent != downloadedpercent:
                     # percent changed; update display
                     downloadedpercent = percent
-                    munkicommon.display_percent_done(downloadedpercent, 100)
+                    displayPercentDone(downloadedpercent, 100)
+                hasher.catchUp()
             time.sleep(0.1)
         else:
             # Headers have finished, but not targetsize or HTTP2xx.
             # It's possible that Content-Length was not in the headers.
             # so just sleep and loop again. We can't show progress.
+            if header.get('http_result_code', '').startswith('2'):
+                hasher.catchUp()
             time.sleep(0.1)
 
         if (proc.poll() != None):
@@ -308,6 +424,11 @@ def curl(url, destinationpath,
             if donewithheaders or maxheaders <= 0:
                 break
 
+    try:
+        os.unlink(curldirectivepath)
+    except OSError:
+        pass
+
     retcode = proc.poll()
     if retcode:
         curlerr = ''
@@ -351,7 +472,11 @@ def curl(url, destinationpath,
                                 message=message,
                                 onlyifnewer=onlyifnewer,
                                 resume=resume,
-                                follow_redirects=follow_redirects)
+                                follow_redirects=follow_redirects,
+                                rate_limit=rate_limit,
+                                max_time=max_time,
+                                compressed=compressed,
+                                connect_timeout=connect_timeout)
             elif retcode == 22:
                 # TODO: Made http(s) connection but 400 series error.
                 # What should we do?
@@ -393,8 +518,11 @@ def curl(url, destinationpath,
             if downloadedsize >= targetsize:
                 if targetsize and not downloadedpercent == 100:
                     # need to display a percent done of 100%
-                    munkicommon.display_percent_done(100, 100)
+                    displayPercentDone(100, 100)
+                fhash = hasher.hexdigest()
                 os.rename(tempdownloadpath, destinationpath)
+                if fhash:
+                    writeCachedChecksum(destinationpath, fhash=fhash)
                 if (resume and not header.get('etag')
                     and not 'HTTPetag' in WARNINGSLOGGED):
                     # use display_info instead of display_warning so these
@@ -427,6 +555,826 @@ def curl(url, destinationpath,
                                 header.get('http_result_description',''))
 
 
+class HTTPConnectionPool(object):
+    """Keeps idle keep-alive HTTP(S) connections so later requests to the
+    same host can reuse them instead of making a new connection (and TLS
+    handshake) for every file. Safe to use from several threads."""
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _sslContext(self, cert_info):
+        """Returns an SSLContext set up from cert_info"""
+        context = ssl.create_default_context()
+        # use only secure >=128 bit SSL, like our curl directives
+        context.set_ciphers('HIGH:!ADH')
+        cert_info = cert_info or {}
+        cacert = cert_info.get('cacert')
+        capath = cert_info.get('capath')
+        cert = cert_info.get('cert')
+        key = cert_info.get('key')
+        if cacert:
+            if not os.path.isfile(cacert):
+                raise CurlError(-1, 'No CA cert at %s' % cacert)
+        if capath:
+            if not os.path.isdir(capath):
+                raise CurlError(-2, 'No CA directory at %s' % capath)
+        if cacert or capath:
+            context.load_verify_locations(cafile=cacert, capath=capath)
+        if cert:
+            if not os.path.isfile(cert):
+                raise CurlError(-3, 'No client cert at %s' % cert)
+            if key and not os.path.isfile(key):
+                raise CurlError(-4, 'No client key at %s' % key)
+            context.load_cert_chain(cert, key)
+        return context
+
+    def getConnection(self, scheme, netloc, cert_info=None):
+        """Returns a (key, connection, reused) tuple for scheme and netloc.
+        Pass key and connection to returnConnection when done with it."""
+        cert_key = tuple(sorted((cert_info or {}).items()))
+        key = (scheme, netloc, cert_key)
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle:
+                return (key, idle.pop(), True)
+        finally:
+            self._lock.release()
+
+        host = netloc.rpartition('@')[2]
+        proxy = None
+        # like curl, we only look at the *_proxy environment variables
+        proxies = urllib.getproxies_environment()
+        if scheme in proxies and not urllib.proxy_bypass_environment(
+                host.rpartition(':')[0] or host):
+            proxy = urlparse.urlparse(proxies[scheme]).netloc
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(
+                proxy or host, timeout=HTTP_TIMEOUT,
+                context=self._sslContext(cert_info))
+            if proxy:
+                connection.set_tunnel(host)
+        else:
+            connection = httplib.HTTPConnection(
+                proxy or host, timeout=HTTP_TIMEOUT)
+        # remember if requests need an absolute URL for a plain http proxy
+        connection.munki_http_proxy = bool(proxy and scheme == 'http')
+        return (key, connection, False)
+
+    def returnConnection(self, key, connection):
+        """Keeps a connection around for reuse"""
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(connection)
+        finally:
+            self._lock.release()
+
+    def closeAll(self):
+        """Closes all idle connections"""
+        self._lock.acquire()
+        try:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+
+CONNECTION_POOL = HTTPConnectionPool()
+
+
+def httpBackendAvailable(url):
+    """Returns True if httpget can handle url. https needs the SSLContext
+    support added in Python 2.7.9."""
+    if urlparse.urlparse(url).scheme == 'https':
+        return hasattr(ssl, 'create_default_context')
+    return True
+
+
+def _curlErrorForException(err):
+    """Returns a CurlError with a curl-like code for a connection error"""
+    if isinstance(err, socket.timeout):
+        return CurlError(28, 'Operation timed out: %s' % err)
+    if isinstance(err, socket.gaierror):
+        return CurlError(6, 'Could not resolve host: %s' % err)
+    if isinstance(err, ssl.SSLError):
+        return CurlError(35, 'SSL error: %s' % err)
+    return CurlError(7, 'Connection failed: %s' % err)
+
+
+def _requestHeaders(url_parse, custom_headers):
+    """Returns the basic request headers for an httplib request: no
+    compression, Basic auth from the URL and any custom_headers"""
+    headers = {'Accept-Encoding': 'identity'}
+    if url_parse.username is not None:
+        headers['Authorization'] = 'Basic ' + base64.b64encode(
+            '%s:%s' % (urllib2.unquote(url_parse.username),
+                       urllib2.unquote(url_parse.password or '')))
+
+    # Add any additional headers specified in custom_headers
+    # custom_headers must be an array of strings with valid HTTP
+    # header format.
+    if custom_headers:
+        for custom_header in custom_headers:
+            custom_header = custom_header.strip().encode('utf-8')
+            if re.search(r'^[\w-]+:.+', custom_header):
+                (name, value) = custom_header.split(':', 1)
+                headers[name.strip()] = value.strip()
+            else:
+                munkicommon.display_warning(
+                    'Skipping invalid HTTP header: %s' % custom_header)
+    return headers
+
+
+def _sendRequest(url_parse, cert_info, headers, connect_timeout=None):
+    """Sends a GET request for url_parse using a connection from
+    CONNECTION_POOL. Returns a (poolkey, connection, response) tuple.
+    A new connection waits at most connect_timeout seconds to connect,
+    if given. Raises CurlError if we can't connect."""
+    path = url_parse.path or '/'
+    if url_parse.query:
+        path = path + '?' + url_parse.query
+
+    # a pooled connection may have been closed by the server since we last
+    # used it, so if a reused connection fails, try once more with a new one
+    while True:
+        (poolkey, connection, reused) = CONNECTION_POOL.getConnection(
+            url_parse.scheme, url_parse.netloc, cert_info)
+        munkicommon.display_debug2('%s connection to %s'
+                                   % (reused and 'Reusing' or 'Opening',
+                                      url_parse.netloc))
+        if connection.munki_http_proxy:
+            requestpath = urlparse.urlunparse(
+                url_parse[:2] + (url_parse.path or '/',) + url_parse[3:5]
+                + ('',))
+        else:
+            requestpath = path
+        try:
+            if connect_timeout and not reused:
+                connection.timeout = connect_timeout
+                connection.connect()
+                connection.timeout = HTTP_TIMEOUT
+                connection.sock.settimeout(HTTP_TIMEOUT)
+            connection.request('GET', requestpath, headers=headers)
+            return (poolkey, connection, connection.getresponse())
+        except (httplib.HTTPException, socket.error), err:
+            connection.close()
+            if not reused:
+                raise _curlErrorForException(err)
+
+
+def _finishResponse(poolkey, connection, response):
+    """Reads any remaining body and keeps the connection if we can"""
+    try:
+        while response.read(65536):
+            pass
+    except (httplib.HTTPException, socket.error):
+        connection.close()
+        return
+    if response.will_close:
+        connection.close()
+    else:
+        CONNECTION_POOL.returnConnection(poolkey, connection)
+
+
+def httpget(url, destinationpath,
+            cert_info=None, custom_headers=None, donotrecurse=False,
+            etag=None, message=None, onlyifnewer=False, resume=False,
+            follow_redirects=False, rate_limit=None, max_time=None,
+            compressed=False, connect_timeout=None, redirects=0):
+    """Gets an HTTP or HTTPS URL and stores it in destination path, using
+    Python's httplib and keep-alive connections from CONNECTION_POOL
+    instead of launching curl.
+
+    Takes the same arguments, returns the same dictionary of headers and
+    raises the same exceptions as curl()."""
+
+    header = {}
+    header['http_result_code'] = '000'
+    header['http_result_description'] = ''
+
+    starttime = time.time()
+    tempdownloadpath = destinationpath + '.download'
+    url_parse = urlparse.urlparse(url)
+
+    headers = _requestHeaders(url_parse, custom_headers)
+    if compressed and not resume:
+        headers['Accept-Encoding'] = 'gzip'
+
+    if os.path.exists(destinationpath):
+        if etag:
+            headers['If-None-Match'] = etag
+        elif onlyifnewer:
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                os.path.getmtime(destinationpath), usegmt=True)
+        else:
+            os.remove(destinationpath)
+
+    resuming = False
+    if os.path.exists(tempdownloadpath):
+        if resume and not os.path.exists(destinationpath):
+            # let's try to resume this download
+            resuming = True
+            headers['Range'] = 'bytes=%s-' % os.path.getsize(
+                tempdownloadpath)
+            # if an existing etag, only resume if etags still match.
+            tempetag = getxattr(tempdownloadpath, XATTR_ETAG)
+            if tempetag:
+                headers['If-Match'] = tempetag
+        else:
+            os.remove(tempdownloadpath)
+
+    (poolkey, connection, response) = _sendRequest(
+        url_parse, cert_info, headers, connect_timeout=connect_timeout)
+
+    header['http_result_code'] = str(response.status)
+    header['http_result_description'] = response.reason
+    for (fieldname, value) in response.getheaders():
+        header[fieldname.lower()] = value
+    munkicommon.display_debug2('HTTP/1.1 %s %s'
+                               % (response.status, response.reason))
+    for (fieldname, value) in response.getheaders():
+        munkicommon.display_debug2('%s: %s' % (fieldname, value))
+
+    def finishResponse():
+        """Reads any remaining body and keeps the connection if we can"""
+        _finishResponse(poolkey, connection, response)
+
+    http_result = header['http_result_code']
+    if (follow_redirects and http_result in ['301', '302', '303', '307']
+            and header.get('location')):
+        finishResponse()
+        if redirects >= MAX_REDIRECTS:
+            raise CurlError(47, 'Maximum (%s) redirects followed'
+                            % MAX_REDIRECTS)
+        return httpget(urlparse.urljoin(url, header['location']),
+                       destinationpath, cert_info=cert_info,
+                       custom_headers=custom_headers,
+                       donotrecurse=donotrecurse, etag=etag,
+                       message=message, onlyifnewer=onlyifnewer,
+                       resume=resume, follow_redirects=follow_redirects,
+                       rate_limit=rate_limit, max_time=max_time,
+                       compressed=compressed,
+                       connect_timeout=connect_timeout,
+                       redirects=redirects + 1)
+
+    if http_result == '304':
+        finishResponse()
+        return header
+
+    if not http_result.startswith('2'):
+        finishResponse()
+        if not (http_result.startswith('4') or http_result.startswith('5')):
+            # curl doesn't consider this an error, but we can't use the
+            # response; clean all relevant downloads that may be in a bad
+            # state.
+            for f in [tempdownloadpath, destinationpath]:
+                try:
+                    os.unlink(f)
+                except OSError:
+                    pass
+            raise HTTPError(http_result,
+                            header.get('http_result_description', ''))
+        # the equivalent of curl's error 22
+        if os.path.exists(tempdownloadpath):
+            if not resume:
+                os.remove(tempdownloadpath)
+            elif http_result in ['412', '416']:
+                # 412: Etag didn't match (precondition failed), could not
+                #   resume partial download as file on server has changed.
+                # 416: Bad range request; the resource may now be smaller.
+                os.remove(tempdownloadpath)
+                if http_result == '412' and not donotrecurse:
+                    return httpget(url, destinationpath,
+                                   cert_info=cert_info,
+                                   custom_headers=custom_headers,
+                                   donotrecurse=True, etag=etag,
+                                   message=message, onlyifnewer=onlyifnewer,
+                                   resume=resume,
+                                   follow_redirects=follow_redirects,
+                                   rate_limit=rate_limit, max_time=max_time,
+                                   compressed=compressed,
+                                   connect_timeout=connect_timeout)
+            elif http_result.startswith('5') and http_result != '503':
+                # the webserver is likely misconfigured; don't try to
+                # resume from it later
+                os.remove(tempdownloadpath)
+        curlerr = 'The requested URL returned error: %s' % http_result
+        munkicommon.display_detail('Download error: %s. Failed (%s) with: %s'
+                                   % (url, 22, curlerr))
+        munkicommon.display_detail('Headers: %s', header)
+        raise CurlError(22, curlerr)
+
+    # Prefer Content-Length header to determine download size, otherwise
+    # fall back to a custom X-Download-Size header.
+    try:
+        targetsize = int(header.get('content-length') or
+                         header.get('x-download-size'))
+    except (ValueError, TypeError):
+        targetsize = 0
+    if http_result == '206' and resuming:
+        # partial content because we're resuming
+        munkicommon.display_detail(
+            'Resuming partial download for %s' %
+            os.path.basename(destinationpath))
+        try:
+            targetsize = int(header.get('content-range', '').split('/')[1])
+        except (ValueError, IndexError):
+            targetsize = 0
+        mode = 'ab'
+    else:
+        if resuming and not 'HTTPRange' in WARNINGSLOGGED:
+            munkicommon.display_info('WARNING: Web server refused '
+                    'partial/range request. Munki cannot run '
+                    'efficiently when this support is absent for '
+                    'pkg urls. URL: %s' % url)
+            WARNINGSLOGGED['HTTPRange'] = 1
+        mode = 'wb'
+
+    if message:
+        # log always, display if verbose is 1 or more
+        # also display in MunkiStatus detail field
+        munkicommon.display_status_minor(message)
+
+    downloadedpercent = -1
+    hasher = DownloadHasher(tempdownloadpath)
+    try:
+        fileobj = open(tempdownloadpath, mode)
+        try:
+            downloadedsize = fileobj.tell()
+            if downloadedsize:
+                # hash the partial file we're resuming
+                hasher.catchUp()
+            decoder = None
+            if header.get('content-encoding') == 'gzip':
+                # we asked for a compressed response; write it out
+                # decompressed. downloadedsize counts what we received.
+                decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            transferstart = time.time()
+            transferred = 0
+            while True:
+                if max_time and time.time() - starttime > max_time:
+                    raise socket.timeout(
+                        'Maximum time of %s seconds reached' % max_time)
+                data = response.read(65536)
+                if not data:
+                    break
+                downloadedsize += len(data)
+                transferred += len(data)
+                if decoder:
+                    data = decoder.decompress(data)
+                fileobj.write(data)
+                hasher.update(data)
+                if rate_limit:
+                    # sleep long enough to bring our average speed down
+                    # to the limit
+                    delay = (float(transferred) / (rate_limit * 1024)
+                             - (time.time() - transferstart))
+                    if delay > 0:
+                        time.sleep(delay)
+                if targetsize:
+                    percent = int(float(downloadedsize)
+                                  / float(targetsize) * 100)
+                    if percent != downloadedpercent:
+                        # percent changed; update display
+                        downloadedpercent = percent
+                        displayPercentDone(
+                            downloadedpercent, 100)
+            if decoder:
+                data = decoder.flush()
+                fileobj.write(data)
+                hasher.update(data)
+        finally:
+            fileobj.close()
+    except (httplib.HTTPException, socket.error, IOError, zlib.error), err:
+        connection.close()
+        if os.path.exists(tempdownloadpath):
+            if not resume:
+                os.remove(tempdownloadpath)
+            elif header.get('etag'):
+                xattr.setxattr(tempdownloadpath, XATTR_ETAG, header['etag'])
+        if isinstance(err, IOError) and not isinstance(err, socket.error):
+            raise CurlError(23, 'Failed writing body: %s' % err)
+        if isinstance(err, zlib.error):
+            raise CurlError(61, 'Error decompressing response: %s' % err)
+        curlerror = _curlErrorForException(err)
+        munkicommon.display_detail('Download error: %s. Failed (%s) with: %s'
+                                   % (url, curlerror[0], curlerror[1]))
+        raise curlerror
+
+    if response.will_close:
+        connection.close()
+    else:
+        CONNECTION_POOL.returnConnection(poolkey, connection)
+
+    if downloadedsize >= targetsize:
+        if targetsize and not downloadedpercent == 100:
+            # need to display a percent done of 100%
+            displayPercentDone(100, 100)
+        fhash = hasher.hexdigest()
+        os.rename(tempdownloadpath, destinationpath)
+        if fhash:
+            writeCachedChecksum(destinationpath, fhash=fhash)
+        if (resume and not header.get('etag')
+                and not 'HTTPetag' in WARNINGSLOGGED):
+            munkicommon.display_info(
+                'WARNING: '
+                'Web server did not return an etag. Munki cannot '
+                'safely resume downloads without etag support on the '
+                'web server. URL: %s' % url)
+            WARNINGSLOGGED['HTTPetag'] = 1
+        return header
+    else:
+        # not enough bytes retreived
+        if not resume and os.path.exists(tempdownloadpath):
+            os.remove(tempdownloadpath)
+        raise CurlError(-5, 'Expected %s bytes, got: %s' %
+                        (targetsize, downloadedsize))
+
+
+def _parseContentRange(content_range):
+    """Returns (start, end, total) from a Content-Range header like
+    'bytes 0-0/1234', or None if it can't be parsed"""
+    match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', content_range or '')
+    if not match:
+        return None
+    return tuple(int(value) for value in match.groups())
+
+
+def _readSegmentState(tempdownloadpath):
+    """Returns the (targetsize, etag, segments) progress segmentedget saved
+    for a partial download, or None. segments is a list of
+    [start, end, position] lists, where position is the next byte of that
+    segment to download."""
+    try:
+        state = getxattr(tempdownloadpath, XATTR_SEGMENTS)
+    except (IOError, OSError):
+        return None
+    if not state:
+        return None
+    try:
+        lines = state.splitlines()
+        (targetsize, etag) = lines[0].split(' ', 1)
+        segments = [[int(value) for value in line.split()]
+                    for line in lines[1:]]
+        for segment in segments:
+            if len(segment) != 3:
+                return None
+        return (int(targetsize), etag, segments)
+    except (IndexError, ValueError):
+        return None
+
+
+def _writeSegmentState(tempdownloadpath, targetsize, etag, segments):
+    """Saves the progress of a segmented download; see _readSegmentState"""
+    lines = ['%s %s' % (targetsize, etag)]
+    for segment in segments:
+        lines.append('%s %s %s' % tuple(segment))
+    xattr.setxattr(tempdownloadpath, XATTR_SEGMENTS, '\n'.join(lines))
+
+
+def segmentedget(url, destinationpath, cert_info=None, custom_headers=None,
+                 message=None, follow_redirects=False, segments=4,
+                 minimum_size=0, rate_limit=None, max_time=None):
+    """Downloads url to destinationpath over several connections at once,
+    each fetching a byte range of the file into the .download file.
+
+    The progress of each range is saved with the .download file, so a
+    download that fails or is stopped is resumed where each range left off,
+    as long as the file on the server has the same ETag. Segments that fail
+    are retried SEGMENT_RETRIES times. rate_limit (KB/sec) is shared among
+    the segments; max_time works as for httpget.
+
+    Returns a dictionary of headers like httpget, or None without
+    downloading anything if the server doesn't support byte ranges or the
+    file is smaller than minimum_size bytes; the caller should then fall
+    back to a normal download. Raises CurlError or HTTPError if the
+    download fails."""
+
+    starttime = time.time()
+    tempdownloadpath = destinationpath + '.download'
+    url_parse = urlparse.urlparse(url)
+    headers = _requestHeaders(url_parse, custom_headers)
+
+    # ask for the first byte to find out the size of the file and whether
+    # the server will give us ranges at all
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    redirects = 0
+    while True:
+        (poolkey, connection, response) = _sendRequest(
+            url_parse, cert_info, probe_headers)
+        header = {}
+        for (fieldname, value) in response.getheaders():
+            header[fieldname.lower()] = value
+        header['http_result_code'] = str(response.status)
+        header['http_result_description'] = response.reason
+        if response.status == 200:
+            # the server is sending the whole file; don't wait for it
+            connection.close()
+        else:
+            _finishResponse(poolkey, connection, response)
+        if (follow_redirects
+                and header['http_result_code'] in ['301', '302', '303', '307']
+                and header.get('location') and redirects < MAX_REDIRECTS):
+            redirects += 1
+            url = urlparse.urljoin(url, header['location'])
+            url_parse = urlparse.urlparse(url)
+            continue
+        break
+
+    saved = None
+    if os.path.exists(tempdownloadpath):
+        saved = _readSegmentState(tempdownloadpath)
+    content_range = _parseContentRange(header.get('content-range'))
+    if header['http_result_code'] != '206' or not content_range:
+        munkicommon.display_debug1(
+            'Server did not return a byte range for %s; '
+            'not using a segmented download' % url)
+        if saved:
+            # only we can resume this, and we can't anymore
+            os.remove(tempdownloadpath)
+        return None
+    targetsize = content_range[2]
+    if targetsize < max(minimum_size, segments):
+        if saved:
+            os.remove(tempdownloadpath)
+        return None
+
+    etag = header.get('etag')
+    if (saved and etag and saved[:2] == (targetsize, etag)
+            and os.path.getsize(tempdownloadpath) == targetsize):
+        ranges = saved[2]
+        munkicommon.display_detail(
+            'Resuming segmented download of %s' % url)
+    else:
+        segmentsize = targetsize // segments + 1
+        ranges = [[start, min(start + segmentsize, targetsize) - 1, start]
+                  for start in range(0, targetsize, segmentsize)]
+        munkicommon.display_detail(
+            'Downloading %s in %s segments' % (url, len(ranges)))
+        # make a file of the right size for the segments to write into
+        if os.path.exists(tempdownloadpath):
+            os.remove(tempdownloadpath)
+        fileobj = open(tempdownloadpath, 'wb')
+        fileobj.truncate(targetsize)
+        fileobj.close()
+        if etag:
+            # without an etag we can't tell whether the file changed, so
+            # we don't save anything to resume from
+            _writeSegmentState(tempdownloadpath, targetsize, etag, ranges)
+    if message:
+        munkicommon.display_status_minor(message)
+
+    progress = {'downloaded': sum(position - start
+                                  for (start, unused_end, position) in ranges),
+                'percent': -1, 'hashing': False, 'stale': False}
+    progress_lock = threading.Lock()
+    quiet_progress = getattr(THREAD_SETTINGS, 'quiet_progress', False)
+    # we hash the file from the start as far as the segments have got,
+    # mostly by feeding it the data of the segment at that point as it
+    # arrives
+    hasher = DownloadHasher(tempdownloadpath)
+
+    def saveProgress():
+        """Saves the segments' progress. Call with progress_lock held."""
+        if etag and not progress['stale']:
+            try:
+                _writeSegmentState(tempdownloadpath, targetsize, etag,
+                                   ranges)
+            except (IOError, OSError):
+                pass
+
+    def catchUpHash():
+        """Hashes what the segments have written since the hash got to the
+        start of them. Only one thread does this at a time; the others
+        leave the hash alone while it does."""
+        progress_lock.acquire()
+        try:
+            if progress['hashing']:
+                return
+            progress['hashing'] = True
+        finally:
+            progress_lock.release()
+        try:
+            while True:
+                progress_lock.acquire()
+                try:
+                    available = 0
+                    for (start, end, position) in ranges:
+                        if start <= hasher.offset <= end:
+                            available = position - hasher.offset
+                            break
+                    if available <= 0:
+                        progress['hashing'] = False
+                        return
+                finally:
+                    progress_lock.release()
+                # bytes before a segment's position don't change, so we
+                # can read them without holding the lock
+                fileobj = open(tempdownloadpath, 'rb')
+                try:
+                    fileobj.seek(hasher.offset)
+                    while available > 0:
+                        chunk = fileobj.read(min(available, 2**20))
+                        if not chunk:
+                            raise IOError('%s is too short' % tempdownloadpath)
+                        hasher.update(chunk)
+                        available -= len(chunk)
+                finally:
+                    fileobj.close()
+        except (IOError, OSError):
+            # hexdigest will try again
+            progress_lock.acquire()
+            progress['hashing'] = False
+            progress_lock.release()
+
+    def getSegment(segment):
+        """Downloads the rest of one range of the file into the .download
+        file"""
+        THREAD_SETTINGS.quiet_progress = quiet_progress
+        (start, end) = segment[:2]
+        segment_headers = dict(headers)
+        segment_headers['Range'] = 'bytes=%s-%s' % (segment[2], end)
+        if etag:
+            # make sure every segment comes from the same file
+            segment_headers['If-Match'] = etag
+        (poolkey, connection, response) = _sendRequest(
+            url_parse, cert_info, segment_headers)
+        try:
+            try:
+                if (response.status != 206 or _parseContentRange(
+                        response.getheader('content-range'))
+                        != (segment[2], end, targetsize)):
+                    if response.status == 412:
+                        # the file changed on the server
+                        progress['stale'] = True
+                    if response.status >= 400:
+                        raise CurlError(
+                            22, 'The requested URL returned error: %s'
+                            % response.status)
+                    raise HTTPError(response.status, response.reason)
+                # unbuffered, so what we've counted is in the file for
+                # catchUpHash to read
+                segmentfile = open(tempdownloadpath, 'r+b', 0)
+                try:
+                    segmentfile.seek(segment[2])
+                    checkpoint = segment[2]
+                    transferstart = time.time()
+                    transferred = 0
+                    while segment[2] <= end:
+                        if munkicommon.stopRequested():
+                            raise CurlError(42, 'Download stopped')
+                        if max_time and time.time() - starttime > max_time:
+                            raise socket.timeout(
+                                'Maximum time of %s seconds reached'
+                                % max_time)
+                        data = response.read(
+                            min(65536, end + 1 - segment[2]))
+                        if not data:
+                            break
+                        segmentfile.write(data)
+                        transferred += len(data)
+                        progress_lock.acquire()
+                        try:
+                            if (not progress['hashing']
+                                    and hasher.offset == segment[2]):
+                                hasher.update(data)
+                            segment[2] += len(data)
+                            if segment[2] - checkpoint >= \
+                                    SEGMENT_CHECKPOINT_SIZE:
+                                checkpoint = segment[2]
+                                saveProgress()
+                            progress['downloaded'] += len(data)
+                            percent = int(float(progress['downloaded'])
+                                          / targetsize * 100)
+                            if percent != progress['percent']:
+                                progress['percent'] = percent
+                                displayPercentDone(percent, 100)
+                        finally:
+                            progress_lock.release()
+                        if rate_limit:
+                            # each segment gets its share of the limit
+                            delay = (float(transferred) * len(pending)
+                                     / (rate_limit * 1024)
+                                     - (time.time() - transferstart))
+                            if delay > 0:
+                                time.sleep(delay)
+                finally:
+                    segmentfile.close()
+                if segment[2] <= end:
+                    raise CurlError(18, 'Transferred a partial file')
+            except (httplib.HTTPException, socket.error), err:
+                connection.close()
+                raise _curlErrorForException(err)
+            except Exception:
+                connection.close()
+                raise
+        finally:
+            progress_lock.acquire()
+            try:
+                saveProgress()
+            finally:
+                progress_lock.release()
+            catchUpHash()
+        _finishResponse(poolkey, connection, response)
+        return end - start + 1
+
+    # hash what we're resuming from
+    catchUpHash()
+    errors = []
+    for attempt in range(SEGMENT_RETRIES + 1):
+        pending = [segment for segment in ranges if segment[2] <= segment[1]]
+        if not pending:
+            break
+        if attempt:
+            munkicommon.display_detail(
+                'Retrying %s segments of %s' % (len(pending), url))
+        results = utils.runConcurrently(getSegment, pending,
+                                        max_workers=len(pending))
+        errors = [err for (unused_result, err) in results if err]
+        if [err for err in errors
+                if not isinstance(err, CurlError) or err[0] in [22, 28, 42]]:
+            # errors trying again won't fix
+            break
+
+    if errors or progress['downloaded'] != targetsize:
+        if errors:
+            err = errors[0]
+        else:
+            err = CurlError(-5, 'Expected %s bytes, got: %s'
+                            % (targetsize, progress['downloaded']))
+        if progress['stale'] or not etag:
+            # nothing here we can resume from
+            os.remove(tempdownloadpath)
+        if isinstance(err, IOError) and not isinstance(err, socket.error):
+            err = CurlError(23, 'Failed writing body: %s' % err)
+        if isinstance(err, CurlError):
+            munkicommon.display_detail(
+                'Download error: %s. Failed (%s) with: %s'
+                % (url, err[0], err[1]))
+        raise err
+
+    fhash = hasher.hexdigest()
+    if etag:
+        xattr.removexattr(tempdownloadpath, XATTR_SEGMENTS)
+    os.rename(tempdownloadpath, destinationpath)
+    if fhash:
+        writeCachedChecksum(destinationpath, fhash=fhash)
+    return header
+
+
+def _parseWindowTime(timestring):
+    """Returns minutes after midnight for an 'HH:MM' string"""
+    (hours, minutes) = timestring.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def describeDownloadWindow():
+    """Returns the DownloadWindow preference as a string for messages"""
+    window = munkicommon.pref('DownloadWindow') or {}
+    return '%s-%s' % (window.get('Start'), window.get('End'))
+
+
+def getDownloadWindowTimeLeft(now=None):
+    """Checks the DownloadWindow preference, a dictionary with 'Start' and
+    'End' keys holding local times like '22:00' and '06:00'. The window may
+    span midnight.
+
+    Returns None if no window is configured, 0 if we're outside the
+    window, or the number of seconds until the window ends."""
+    window = munkicommon.pref('DownloadWindow')
+    if not window:
+        return None
+    try:
+        start = _parseWindowTime(window['Start'])
+        end = _parseWindowTime(window['End'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        munkicommon.display_warning(
+            'Ignoring invalid DownloadWindow preference: %s', window)
+        return None
+
+    if now is None:
+        now = datetime.datetime.now()
+    now_seconds = now.hour * 3600 + now.minute * 60 + now.second
+    start_seconds = start * 60
+    end_seconds = end * 60
+    if start_seconds == end_seconds:
+        # the window is the whole day
+        return None
+    if start_seconds < end_seconds:
+        inside = start_seconds <= now_seconds < end_seconds
+    else:
+        # window spans midnight
+        inside = now_seconds >= start_seconds or now_seconds < end_seconds
+    if not inside:
+        return 0
+    return (end_seconds - now_seconds) % (24 * 3600)
+
+
 def getResourceIfChangedAtomically(url,
                                    destinationpath,
                                    cert_info=None,
@@ -435,7 +1383,10 @@ def getResourceIfChangedAtomically(url,
                                    message=None,
                                    resume=False,
                                    verify=False,
-                                   follow_redirects=False):
+                                   follow_redirects=False,
+                                   rate_limit=None,
+                                   windowed=False,
+                                   compressed=False):
     """Gets file from a URL.
        Checks first if there is already a file with the necessary checksum.
        Then checks if the file has changed on the server, resuming or
@@ -445,6 +1396,13 @@ def getResourceIfChangedAtomically(url,
 
        Supported schemes are http, https, file.
 
+       rate_limit limits http(s) downloads to that many KB/sec. If windowed
+       is True, a file we don't already have is only downloaded during the
+       DownloadWindow preference's hours, and the download is stopped (and
+       kept for resuming) when the window ends. If compressed is True,
+       http(s) servers are asked for a compressed response, which is
+       decompressed before it's saved.
+
        Returns True if a new download was required; False if the
        item is already in the local cache.
 
@@ -471,12 +1429,21 @@ def getResourceIfChangedAtomically(url,
                 'will check if changed and redownload: %s' % destinationpath)
         #continue with normal if-modified-since/etag update methods.
 
+    max_time = None
+    if windowed and not os.path.exists(destinationpath):
+        max_time = getDownloadWindowTimeLeft()
+        if max_time == 0:
+            raise DownloadWindowError(
+                'Outside of the download window (%s)'
+                % describeDownloadWindow())
+
     url_parse = urlparse.urlparse(url)
     if url_parse.scheme in ['http', 'https']:
         changed = getHTTPfileIfChangedAtomically(
             url, destinationpath,
             cert_info=cert_info, custom_headers=custom_headers,
-            message=message, resume=resume, follow_redirects=follow_redirects)
+            message=message, resume=resume, follow_redirects=follow_redirects,
+            rate_limit=rate_limit, max_time=max_time, compressed=compressed)
     elif url_parse.scheme == 'file':
         changed = getFileIfChangedAtomically(url_parse.path, destinationpath)
     else:
@@ -484,9 +1451,11 @@ def getResourceIfChangedAtomically(url,
                 'Unsupported scheme for %s: %s' % (url, url_parse.scheme))
 
     if changed and verify:
-        (verify_ok, fhash) = verifySoftwarePackageIntegrity(destinationpath,
-                                                          expected_hash,
-                                                          always_hash=True)
+        # the download functions cache the hash they computed while
+        # downloading, so we don't need to read the file again
+        (verify_ok, fhash) = verifySoftwarePackageIntegrity(
+            destinationpath, expected_hash, always_hash=True,
+            file_hash=getxattr(destinationpath, XATTR_SHA))
         if not verify_ok:
             try:
                 os.unlink(destinationpath)
@@ -538,17 +1507,35 @@ def getFileIfChangedAtomically(path, destinationpath):
             raise FileCopyError('Removing %s: %s' % (
                 tmp_destinationpath, str(e)))
 
-    # copy from source to temporary destination
+    # copy from source to temporary destination, hashing as we go
+    hasher = DownloadHasher(tmp_destinationpath)
     try:
-        shutil.copy2(path, tmp_destinationpath)
-    except IOError, e:
+        source = open(path, 'rb')
+        try:
+            destination = open(tmp_destinationpath, 'wb')
+            try:
+                while True:
+                    chunk = source.read(2**20)
+                    if not chunk:
+                        break
+                    destination.write(chunk)
+                    hasher.update(chunk)
+            finally:
+                destination.close()
+        finally:
+            source.close()
+        shutil.copystat(path, tmp_destinationpath)
+    except (IOError, OSError), e:
         raise FileCopyError('Copy IOError: %s' % str(e))
 
     # rename temp destination to final destination
+    fhash = hasher.hexdigest()
     try:
         os.rename(tmp_destinationpath, destinationpath)
     except OSError, e:
         raise FileCopyError('Renaming %s: %s' % (destinationpath, str(e)))
+    if fhash:
+        writeCachedChecksum(destinationpath, fhash=fhash)
 
     return True
 
@@ -556,7 +1543,9 @@ def getFileIfChangedAtomically(path, destinationpath):
 def getHTTPfileIfChangedAtomically(url, destinationpath,
                                    cert_info=None, custom_headers=None,
                                    message=None, resume=False,
-                                   follow_redirects=False):
+                                   follow_redirects=False,
+                                   rate_limit=None, max_time=None,
+                                   compressed=False, connect_timeout=None):
     """Gets file from HTTP URL, checking first to see if it has changed on the
        server.
 
@@ -574,16 +1563,57 @@ def getHTTPfileIfChangedAtomically(url, destinationpath,
         if etag:
             getonlyifnewer = False
 
+    # FetchBackend 'httplib' downloads in-process, reusing connections
+    if (munkicommon.pref('FetchBackend') == 'httplib'
+            and httpBackendAvailable(url)):
+        fetchfunction = httpget
+    else:
+        fetchfunction = curl
+
+    # large installer items can be fetched as several byte ranges at once;
+    # not when there's a partial normal download to resume
+    tempdownloadpath = destinationpath + '.download'
+    partial_segments = (os.path.exists(tempdownloadpath)
+                        and getxattr(tempdownloadpath, XATTR_SEGMENTS))
+    segments = munkicommon.pref('DownloadSegments') or 1
+    segmented = (resume and segments > 1
+                 and not os.path.exists(destinationpath)
+                 and (partial_segments
+                      or not os.path.exists(tempdownloadpath))
+                 and httpBackendAvailable(url))
+    if partial_segments and not segmented:
+        # only segmentedget can resume a partial segmented download
+        os.remove(tempdownloadpath)
+
     try:
-        header = curl(url,
-                      destinationpath,
-                      cert_info=cert_info,
-                      custom_headers=custom_headers,
-                      etag=etag,
-                      message=message,
-                      onlyifnewer=getonlyifnewer,
-                      resume=resume,
-                      follow_redirects=follow_redirects)
+        header = None
+        if segmented:
+            minimum_size = munkicommon.pref('SegmentedDownloadThreshold') or 0
+            header = segmentedget(url,
+                                  destinationpath,
+                                  cert_info=cert_info,
+                                  custom_headers=custom_headers,
+                                  message=message,
+                                  follow_redirects=follow_redirects,
+                                  segments=segments,
+                                  minimum_size=minimum_size * 1024 * 1024,
+                                  rate_limit=rate_limit,
+                                  max_time=max_time)
+        if header is None:
+            # not segmented, or the server won't send byte ranges
+            header = fetchfunction(url,
+                                   destinationpath,
+                                   cert_info=cert_info,
+                                   custom_headers=custom_headers,
+                                   etag=etag,
+                                   message=message,
+                                   onlyifnewer=getonlyifnewer,
+                                   resume=resume,
+                                   follow_redirects=follow_redirects,
+                                   rate_limit=rate_limit,
+                                   max_time=max_time,
+                                   compressed=compressed,
+                                   connect_timeout=connect_timeout)
 
     except CurlError, err:
         err = 'Error %s: %s' % tuple(err)
@@ -615,6 +1645,54 @@ def getHTTPfileIfChangedAtomically(url, destinationpath,
         return True
 
 
+def getResourceFromPeer(peer_url, item_hash, destinationpath, message=None,
+                        rate_limit=None, max_time=None):
+    """Tries to get the file with sha256 hash item_hash from a peer cache:
+    a web server, usually on another Munki client on the local network,
+    serving files named by their hash from peer_url. What the peer sends
+    is always checked against item_hash, whatever the
+    PackageVerificationMode. rate_limit and max_time are as for
+    getResourceIfChangedAtomically; we give up quickly on a peer that
+    doesn't accept the connection.
+
+    Returns True if destinationpath now holds the file, False if the peer
+    couldn't supply it and we should get it from the repo instead."""
+    url = '%s/%s' % (peer_url.rstrip('/'), item_hash)
+    peerpath = destinationpath + '.peer'
+    for path in [peerpath, peerpath + '.download']:
+        if os.path.exists(path):
+            os.unlink(path)
+    munkicommon.display_debug1('Trying peer cache URL %s', url)
+    try:
+        # don't send our repo's AdditionalHttpHeaders (which may have
+        # credentials in them) to the peer
+        getHTTPfileIfChangedAtomically(
+            url, peerpath, message=message, rate_limit=rate_limit,
+            max_time=max_time, connect_timeout=PEER_CONNECT_TIMEOUT)
+    except MunkiDownloadError, err:
+        munkicommon.display_detail(
+            'Could not get %s from peer cache: %s',
+            os.path.basename(destinationpath), err)
+        if os.path.exists(peerpath + '.download'):
+            os.unlink(peerpath + '.download')
+        return False
+
+    fhash = (getxattr(peerpath, XATTR_SHA)
+             or munkicommon.getsha256hash(peerpath))
+    if fhash != item_hash:
+        munkicommon.display_warning(
+            'Peer cache sent a bad copy of %s (sha256 hash %s); ignoring it',
+            os.path.basename(destinationpath), fhash)
+        os.unlink(peerpath)
+        return False
+    # the peer's etag means nothing to the repo
+    if getxattr(peerpath, XATTR_ETAG):
+        xattr.removexattr(peerpath, XATTR_ETAG)
+    os.rename(peerpath, destinationpath)
+    writeCachedChecksum(destinationpath, fhash=fhash)
+    return True
+
+
 def getURLitemBasename(url):
     """For a URL, absolute or relative, return the basename string.
 
@@ -626,7 +1704,8 @@ def getURLitemBasename(url):
     return os.path.basename(url_parse.path)
 
 
-def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False):
+def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False,
+                                   file_hash=None):
     """Verifies the integrity of the given software package.
 
     The feature is controlled through the PackageVerificationMode key in
@@ -645,15 +1724,16 @@ def verifySoftwarePackageIntegrity(file_path, item_hash, always_hash=False):
         item_hash: the sha256 hash expected.
         always_hash: True/False always check (& return) the hash even if not
                 necessary for this function.
+        file_hash: the sha256 hash of the file, if already known.
 
     Returns:
         (True/False, sha256-hash)
         True if the package integrity could be validated. Otherwise, False.
     """
     mode = munkicommon.pref('PackageVerificationMode')
-    chash = None
+    chash = file_hash
     item_name = getURLitemBasename(file_path)
-    if always_hash:
+    if always_hash and not chash:
         chash = munkicommon.getsha256hash(file_path)
 
     if not mode:
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+manifestindex
+
+A persistent inverted index of the manifests in a repo, kept by manifestutil
+in the manifests directory. It maps each distinct string in the manifests
+(item names, catalogs, included manifests and so on) to the manifests and
+sections it appears in, so finding things doesn't mean reading every
+manifest. Manifests are re-indexed when their modification time, size or
+inode changes.
+
+Note: this module should be 100% free of ObjC-dependant Python imports,
+since manifestutil can run without PyObjC.
+"""
+
+
+import os
+import sqlite3
+
+# the catalog index decides the same way whether a file has changed
+from catalogindex import fileSignature, indexText
+
+
+# lives in the manifests directory; the leading period keeps it from being
+# mistaken for a manifest
+INDEX_FILENAME = '.manifests.sqlite'
+# bump this when the schema changes; older indexes are then rebuilt
+INDEX_VERSION = 1
+
+# so callers don't need to import sqlite3 to catch errors
+Error = sqlite3.Error
+
+
+def _createTables(db):
+    """Creates the index tables in an empty database"""
+    db.execute('CREATE TABLE manifests (id INTEGER PRIMARY KEY, '
+               'name TEXT UNIQUE, signature TEXT, readable INTEGER)')
+    db.execute('CREATE TABLE terms (id INTEGER PRIMARY KEY, '
+               'value TEXT UNIQUE)')
+    db.execute('CREATE TABLE postings (term_id INTEGER, manifest_id INTEGER, '
+               'section TEXT, position INTEGER)')
+    db.execute('CREATE INDEX postings_term ON postings (term_id)')
+    db.execute('CREATE INDEX postings_manifest ON postings (manifest_id)')
+    db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+    db.commit()
+
+
+def openIndex(manifests_path):
+    """Returns a connection to the index in manifests_path, creating the
+    index if needed, or to a new in-memory index if manifests_path is None.
+    Raises Error if it can't be opened."""
+    if manifests_path is None:
+        db = sqlite3.connect(':memory:')
+    else:
+        db = sqlite3.connect(os.path.join(manifests_path, INDEX_FILENAME))
+    if db.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        for (table,) in db.execute(
+                'SELECT name FROM sqlite_master WHERE type = "table"'
+                ).fetchall():
+            db.execute('DROP TABLE %s' % table)
+        _createTables(db)
+    return db
+
+
+def _termId(db, value, term_ids):
+    """Returns the id of a term, adding it to the index if needed.
+    term_ids caches ids we've already looked up."""
+    if value not in term_ids:
+        row = db.execute('SELECT id FROM terms WHERE value = ?',
+                         (value,)).fetchone()
+        if row:
+            term_ids[value] = row[0]
+        else:
+            term_ids[value] = db.execute(
+                'INSERT INTO terms (value) VALUES (?)', (value,)).lastrowid
+    return term_ids[value]
+
+
+def _indexManifest(db, name, signature, manifest, term_ids):
+    """Replaces the index entries for one manifest. manifest is None if it
+    couldn't be read."""
+    _removeManifest(db, name)
+    manifest_id = db.execute(
+        'INSERT INTO manifests (name, signature, readable) VALUES (?, ?, ?)',
+        (indexText(name), signature, manifest is not None)).lastrowid
+    if not manifest:
+        return
+    postings = []
+    for section, value in manifest.items():
+        if isinstance(value, basestring):
+            value = [value]
+        elif not isinstance(value, list):
+            continue
+        for position, item in enumerate(value):
+            if isinstance(item, basestring):
+                postings.append(
+                    (_termId(db, indexText(item), term_ids), manifest_id,
+                     indexText(section), position))
+    db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)', postings)
+
+
+def _removeManifest(db, name):
+    """Removes a manifest from the index"""
+    row = db.execute('SELECT id FROM manifests WHERE name = ?',
+                     (indexText(name),)).fetchone()
+    if row:
+        db.execute('DELETE FROM postings WHERE manifest_id = ?', row)
+        db.execute('DELETE FROM manifests WHERE id = ?', row)
+
+
+def _removeUnusedTerms(db):
+    """Removes terms no manifest uses anymore"""
+    db.execute('DELETE FROM terms WHERE id NOT IN '
+               '(SELECT DISTINCT term_id FROM postings)')
+
+
+def indexManifest(db, manifests_path, name, manifest, pending=False):
+    """Updates the index for a manifest we just wrote, so we don't have to
+    read it again. If pending, the manifest hasn't been written yet; it is
+    indexed without a signature, so updateIndex reads the file again."""
+    signature = None
+    if not pending:
+        signature = fileSignature(os.path.join(manifests_path, name))
+    _indexManifest(db, name, signature, manifest, {})
+    _removeUnusedTerms(db)
+    db.commit()
+
+
+def updateIndex(db, manifests_path, names, readmanifest):
+    """Brings the index up to date with the manifests in manifests_path.
+    names lists the manifests there; readmanifest(path) returns a manifest
+    or raises an exception if it can't. Returns the number of manifests
+    that were (re-)indexed."""
+    indexed = {}
+    for name, signature in db.execute('SELECT name, signature FROM manifests'):
+        indexed[name] = signature
+    term_ids = {}
+    count = 0
+    for name in names:
+        path = os.path.join(manifests_path, name)
+        signature = fileSignature(path)
+        if indexed.pop(indexText(name), None) == signature:
+            continue
+        try:
+            manifest = readmanifest(path)
+        except Exception:
+            manifest = None
+        _indexManifest(db, name, signature, manifest, term_ids)
+        count += 1
+    for name in indexed:
+        # these are gone
+        _removeManifest(db, name)
+        count += 1
+    if count:
+        _removeUnusedTerms(db)
+    db.commit()
+    return count
+
+
+def unreadableManifests(db):
+    """Returns the names of manifests that couldn't be read when they were
+    indexed"""
+    return [row[0] for row in db.execute(
+        'SELECT name FROM manifests WHERE NOT readable ORDER BY name')]
+
+
+def findText(db, findtext, section=None):
+    """Finds manifest entries containing findtext, ignoring case.
+    Returns a sorted list of (manifest name, section, item) tuples with
+    the first matching item of each section of each manifest, optionally
+    only looking at one section."""
+    findtext = indexText(findtext).upper()
+    term_ids = [term_id for term_id, value
+                in db.execute('SELECT id, value FROM terms')
+                if findtext in value.upper()]
+    return _firstPostings(db, term_ids, section)
+
+
+def _firstPostings(db, term_ids, section=None):
+    """Returns sorted (manifest name, section, item) tuples with the first
+    posting for any of term_ids in each section of each manifest"""
+    first = {}
+    for offset in range(0, len(term_ids), 500):
+        # stay under SQLite's limit on query parameters
+        chunk = term_ids[offset:offset + 500]
+        query = ('SELECT manifests.name, postings.section, '
+                 'postings.position, terms.value FROM postings '
+                 'JOIN manifests ON manifests.id = postings.manifest_id '
+                 'JOIN terms ON terms.id = postings.term_id '
+                 'WHERE postings.term_id IN (%s)'
+                 % ', '.join(['?'] * len(chunk)))
+        params = list(chunk)
+        if section:
+            query += ' AND postings.section = ?'
+            params.append(indexText(section))
+        for name, keyname, position, value in db.execute(query, params):
+            if (not (name, keyname) in first
+                    or position < first[(name, keyname)][0]):
+                first[(name, keyname)] = (position, value)
+    return sorted((name, keyname, value)
+                  for (name, keyname), (position, value) in first.items())
+
+
+def manifestsWith(db, item, section=None, recursive=False):
+    """Finds the manifests that contain item exactly, optionally only in
+    one section. With recursive, also finds the manifests that include
+    those through included_manifests, and so on. Returns a sorted list of
+    (manifest name, section, item) tuples."""
+    results = set()
+    seen = set()
+    wanted = [(indexText(item), section)]
+    while wanted:
+        value, keyname = wanted.pop()
+        row = db.execute('SELECT id FROM terms WHERE value = ?',
+                         (value,)).fetchone()
+        if not row:
+            continue
+        for result in _firstPostings(db, [row[0]], keyname):
+            results.add(result)
+            if recursive and result[0] not in seen:
+                seen.add(result[0])
+                wanted.append((result[0], 'included_manifests'))
+    return sorted(results)
@@ -1186,7 +1186,19 @@ def pref(pref_name):
         'SuppressUserNotification': False,
         'SuppressAutoInstall': False,
         'SuppressStopButtonOnInstall': False,
-        'PackageVerificationMode': 'hash'
+        'PackageVerificationMode': 'hash',
+        'MaxConcurrentFetches': 4,
+        'FetchBackend': 'curl',
+        'MaxConcurrentDownloads': 1,
+        'MaxConcurrentDownloadsPerHost': 2,
+        'DownloadOrder': 'install_order',
+        'DownloadRateLimit': 0,
+        'DownloadSegments': 1,
+        'SegmentedDownloadThreshold': 1024,
+        'DownloadCacheSizeLimit': 1024,
+        'PeerCacheAdvertise': False,
+        'UseCatalogDeltas': False,
+        'UseCompressedTransfers': False
     }
     pref_value = CFPreferencesCopyAppValue(pref_name, BUNDLE_ID)
     if pref_value == None:
@@ -1290,6 +1302,54 @@ class MunkiLooseVersion (version.LooseVersion):
         return cmp(self_cmp_version, other_cmp_version)
 
 
+# parsed MunkiVersionKeys; emptied when it reaches VERSION_KEY_CACHE_SIZE
+# (a plain dict, since OrderedDict needs Python 2.7)
+_VERSION_KEY_CACHE = {}
+VERSION_KEY_CACHE_SIZE = 4096
+
+class MunkiVersionKey(tuple):
+    '''A parsed version as an immutable tuple, for fast comparisons and
+    sorting. Compares like MunkiLooseVersion ("10.6" == "10.6.0"), but
+    only against other MunkiVersionKeys.
+
+    Parsed keys are cached, so MunkiVersionKey(vstring) is cheap to call
+    repeatedly with the same version strings.'''
+
+    __slots__ = ()
+
+    def __new__(cls, vstring=None):
+        if isinstance(vstring, MunkiVersionKey):
+            return vstring
+        if vstring is None:
+            # treat None like an empty string
+            vstring = ''
+        elif isinstance(vstring, unicode):
+            vstring = vstring.encode('UTF-8')
+        else:
+            vstring = str(vstring)
+        try:
+            return _VERSION_KEY_CACHE[vstring]
+        except KeyError:
+            components = [x for x in
+                          version.LooseVersion.component_re.split(vstring)
+                          if x and x != '.']
+            for index, component in enumerate(components):
+                if component.isdigit():
+                    components[index] = int(component)
+            # trailing zeros don't matter: this is equivalent to the
+            # padding MunkiLooseVersion does when comparing
+            while components and components[-1] == 0:
+                del components[-1]
+            key = tuple.__new__(cls, components)
+            if len(_VERSION_KEY_CACHE) >= VERSION_KEY_CACHE_SIZE:
+                _VERSION_KEY_CACHE.clear()
+            _VERSION_KEY_CACHE[vstring] = key
+            return key
+
+    def __repr__(self):
+        return 'MunkiVersionKey(%s)' % tuple.__repr__(self)
+
+
 def padVersionString(versString, tupleCount):
     """Normalize the format of a version string"""
     if versString == None:
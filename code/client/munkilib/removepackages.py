@@ -26,13 +26,18 @@ only file removals are done.
 Callable directly from the command-line and as a python module.
 """
 
+import errno
+import itertools
 import os
 import optparse
+import shutil
+import stat
 import subprocess
 import sqlite3
 import time
 import munkistatus
 import munkicommon
+import utils
 import FoundationPlist
 
 
@@ -93,6 +98,15 @@ import FoundationPlist
 #                          uid INTEGER,
 #                          gid INTEGER,
 #                          perms INTEGER )
+# CREATE TABLE receipts (receipt VARCHAR NOT NULL PRIMARY KEY,
+#                        fingerprint VARCHAR NOT NULL,
+#                        pkg_key INTEGER )
+#
+# receipts has a row for every receipt we've imported, so we only need to
+# import the ones that change. pkg_key is NULL for receipts we skipped.
+# CREATE INDEX pkgs_paths_pkg_key ON pkgs_paths (pkg_key)
+# CREATE INDEX pkgs_paths_path_key ON pkgs_paths (path_key)
+# PRAGMA user_version is RECEIPTDB_VERSION.
 #################################################################
 
 
@@ -164,9 +178,11 @@ def shouldRebuildDB(pkgdbpath):
     return False
 
 
-def CreateTables(curs):
+def CreateTables(curs, indexes=True):
     """
-    Creates the tables needed for our internal package database.
+    Creates the tables needed for our internal package database, and
+    their indexes unless indexes is False, for when we'll create them
+    after loading the tables.
     """
     curs.execute('''CREATE TABLE paths
                          (path_key INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -186,6 +202,22 @@ def CreateTables(curs):
                           uid INTEGER,
                           gid INTEGER,
                           perms INTEGER )''')
+    curs.execute('''CREATE TABLE receipts
+                         (receipt VARCHAR NOT NULL PRIMARY KEY,
+                          fingerprint VARCHAR NOT NULL,
+                          pkg_key INTEGER )''')
+    if indexes:
+        CreateIndexes(curs)
+
+
+def CreateIndexes(curs):
+    """
+    Creates the indexes for our internal package database.
+    """
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_pkg_key
+                         ON pkgs_paths (pkg_key)''')
+    curs.execute('''CREATE INDEX IF NOT EXISTS pkgs_paths_path_key
+                         ON pkgs_paths (path_key)''')
 
 
 def findBundleReceiptFromID(pkgid):
@@ -207,19 +239,178 @@ def findBundleReceiptFromID(pkgid):
     return ''
 
 
-def ImportPackage(packagepath, curs):
+def listBomPaths(bompath):
     """
-    Imports package data from the receipt at packagepath into
-    our internal package database.
+    Generates (path, uid, gid, perms) tuples for the items in a bom file,
+    with paths relative to the package's install location.
     """
+    cmd = ["/usr/bin/lsbom", bompath]
+    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in proc.stdout:
+        line = line.decode('UTF-8').rstrip("\n")
+        if not line:
+            continue
+        item = line.split("\t")
+        path = item[0]
+        try:
+            perms = item[1]
+            uidgid = item[2].split("/")
+            uid = uidgid[0]
+            gid = uidgid[1]
+        except IndexError:
+            # we really only care about the path
+            perms = "0000"
+            uid = "0"
+            gid = "0"
+
+        if path != ".":
+            yield (path.lstrip("./"), uid, gid, perms)
+    proc.wait()
+
 
+def listPkgutilPaths(pkgid):
+    """
+    Generates (path, uid, gid, perms) tuples for the files pkgutil
+    says pkgid installed, with paths relative to the package's install
+    location.
+    """
+    cmd = ["/usr/sbin/pkgutil", "--files", pkgid]
+    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in proc.stdout:
+        path = line.decode('UTF-8').rstrip("\n")
+        if not path or path == ".":
+            continue
+        # pkgutil --files pkgid only gives us path info.  We don't
+        # really need perms, uid and gid, so we'll just fake them.
+        # if we needed them, we'd have to call
+        # pkgutil --export-plist pkgid and iterate through the
+        # plist.  That would be slower, so we'll do things this way...
+        yield (path.lstrip("./"), "0", "0", "0000")
+    proc.wait()
+
+
+def installedPaths(pathinfo, ppath):
+    """
+    Prepends ppath, a package's install location, to the paths in
+    pathinfo, so the paths match the actual install locations.
+    """
+    if not ppath:
+        return pathinfo
+    return ((ppath + "/" + path, uid, gid, perms)
+            for (path, uid, gid, perms) in pathinfo)
+
+
+def findReceiptBom(packagepath):
+    """
+    Returns the path to the bom file of the bundle receipt at packagepath,
+    or None if it doesn't have one.
+    """
     bompath = os.path.join(packagepath, 'Contents/Archive.bom')
+    if not os.path.exists(bompath):
+        # look in receipt's Resources directory
+        bomname = os.path.splitext(os.path.basename(packagepath))[0] + '.bom'
+        bompath = os.path.join(packagepath, "Contents/Resources",
+                               bomname)
+        if not os.path.exists(bompath):
+            return None
+    return bompath
+
+
+def listReceiptPaths(packagepath):
+    """
+    Generates (path, uid, gid, perms) tuples for the items in the bundle
+    receipt at packagepath. Generates nothing if it isn't a valid receipt;
+    ImportPackage will skip it.
+    """
+    bompath = None
+    if os.path.isdir(packagepath):
+        bompath = findReceiptBom(packagepath)
+    if bompath:
+        for item in listBomPaths(bompath):
+            yield item
+
+
+def listImportPaths(receiptinfo):
+    """
+    Lists the paths a receipt from getInstalledReceipts installed, so
+    they are ready for its importfunction. Runs on a worker thread, so it
+    only waits on subprocesses and leaves the database and
+    FoundationPlist to the main thread.
+    """
+    (unused_receipt, unused_fingerprint, unused_importfunction,
+     listfunction, importarg) = receiptinfo
+    return list(listfunction(importarg))
+
+
+def importPaths(curs, pkgkey, pathinfo):
+    """
+    Adds the paths a package installed to our internal package database.
+    pathinfo is an iterable of (path, uid, gid, perms) tuples.
+    The rows go into the staged_paths temporary table in bulk, and from
+    there into paths and pkgs_paths with a statement each, instead of a
+    lookup and two inserts per path. If that fails, we add the paths one
+    at a time and skip the ones that fail.
+    """
+    pathinfo = list(pathinfo)
+    try:
+        curs.executemany(
+            '''INSERT INTO staged_paths (path, uid, gid, perms)
+               values (?, ?, ?, ?)''', pathinfo)
+        curs.execute(
+            '''INSERT OR IGNORE INTO paths (path)
+               SELECT path FROM staged_paths''')
+        curs.execute(
+            '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
+               SELECT ?, paths.path_key, staged_paths.uid, staged_paths.gid,
+                      staged_paths.perms
+               FROM staged_paths
+               JOIN paths ON paths.path = staged_paths.path''',
+            (pkgkey, ))
+    except sqlite3.DatabaseError:
+        curs.execute('DELETE FROM pkgs_paths WHERE pkg_key = ?', (pkgkey, ))
+        for (path, uid, gid, perms) in pathinfo:
+            try:
+                importPath(curs, pkgkey, path, uid, gid, perms)
+            except sqlite3.DatabaseError:
+                pass
+    curs.execute('DELETE FROM staged_paths')
+
+
+def importPath(curs, pkgkey, path, uid, gid, perms):
+    """Adds a single path a package installed to our internal package
+    database"""
+    values_t = (path, )
+    row = curs.execute(
+        'SELECT path_key from paths where path = ?', values_t).fetchone()
+    if not row:
+        curs.execute('INSERT INTO paths (path) values (?)', values_t)
+        pathkey = curs.lastrowid
+    else:
+        pathkey = row[0]
+    values_t = (pkgkey, pathkey, uid, gid, perms)
+    curs.execute(
+        '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
+           values (?, ?, ?, ?, ?)''', values_t)
+
+
+def ImportPackage(packagepath, curs, pathinfo=None):
+    """
+    Imports package data from the receipt at packagepath into
+    our internal package database. Returns the new pkg_key, or None if
+    the receipt was skipped. pathinfo is what listReceiptPaths returns,
+    if we already have it.
+    """
+
     infopath = os.path.join(packagepath, 'Contents/Info.plist')
     pkgname = os.path.basename(packagepath)
 
     if not os.path.exists(packagepath):
         munkicommon.display_error("%s not found.", packagepath)
-        return
+        return None
 
     if not os.path.isdir(packagepath):
         # Every machine I've seen has a bogus BSD.pkg,
@@ -227,22 +418,18 @@ def ImportPackage(packagepath, curs):
         if pkgname != "BSD.pkg":
             munkicommon.display_warning(
                 "%s is not a valid receipt. Skipping.", packagepath)
-        return
+        return None
 
-    if not os.path.exists(bompath):
-        # look in receipt's Resources directory
-        bomname = os.path.splitext(pkgname)[0] + '.bom'
-        bompath = os.path.join(packagepath, "Contents/Resources",
-                                bomname)
-        if not os.path.exists(bompath):
-            munkicommon.display_warning(
-                "%s has no BOM file. Skipping.", packagepath)
-            return
+    bompath = findReceiptBom(packagepath)
+    if not bompath:
+        munkicommon.display_warning(
+            "%s has no BOM file. Skipping.", packagepath)
+        return None
 
     if not os.path.exists(infopath):
         munkicommon.display_warning(
             "%s has no Info.plist. Skipping.", packagepath)
-        return
+        return None
 
     timestamp = os.stat(packagepath).st_mtime
     owner = 0
@@ -273,65 +460,23 @@ def ImportPackage(packagepath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/bin/lsbom", bompath]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # special case for MS Office 2008 installers
+    if ppath == "tmp/com.microsoft.updater/office_location":
+        ppath = "Applications"
+    if pathinfo is None:
+        pathinfo = listBomPaths(bompath)
+    importPaths(curs, pkgkey, installedPaths(pathinfo, ppath))
 
-    while True:
-        line =  proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
+    return pkgkey
 
-        try:
-            item = line.rstrip("\n").split("\t")
-            path = item[0]
-            perms = item[1]
-            uidgid = item[2].split("/")
-            uid = uidgid[0]
-            gid = uidgid[1]
-        except IndexError:
-            # we really only care about the path
-            perms = "0000"
-            uid = "0"
-            gid = "0"
 
-        try:
-            if path != ".":
-                # special case for MS Office 2008 installers
-                if ppath == "tmp/com.microsoft.updater/office_location":
-                    ppath = "Applications"
-
-                # prepend the ppath so the paths match the actual install
-                # locations
-                path = path.lstrip("./")
-                if ppath:
-                    path = ppath + "/" + path
-
-                values_t = (path, )
-                row = curs.execute(
-                    'SELECT path_key from paths where path = ?',
-                                                        values_t).fetchone()
-                if not row:
-                    curs.execute(
-                            'INSERT INTO paths (path) values (?)', values_t)
-                    pathkey = curs.lastrowid
-                else:
-                    pathkey = row[0]
-
-                values_t = (pkgkey, pathkey, uid, gid, perms)
-                curs.execute(
-                '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
-                   values (?, ?, ?, ?, ?)''', values_t)
-        except sqlite3.DatabaseError:
-            pass
-
-
-def ImportBom(bompath, curs):
+def ImportBom(bompath, curs, pathinfo=None):
     """
     Imports package data into our internal package database
     using a combination of the bom file and data in Apple's
     package database into our internal package database.
+    Returns the new pkg_key. pathinfo is what listBomPaths returns, if we
+    already have it.
     """
     # If we completely trusted the accuracy of Apple's database, we wouldn't
     # need the bom files, but in my enviroment at least, the bom files are
@@ -370,58 +515,21 @@ def ImportBom(bompath, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/bin/lsbom", bompath]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    while True:
-        line =  proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        try:
-            item = line.rstrip("\n").split("\t")
-            path = item[0]
-            perms = item[1]
-            uidgid = item[2].split("/")
-            uid = uidgid[0]
-            gid = uidgid[1]
-        except IndexError:
-            # we really only care about the path
-            perms = "0000"
-            uid = "0"
-            gid = "0"
-
-        if path != ".":
-            # special case for MS Office 2008 installers
-            if ppath == "tmp/com.microsoft.updater/office_location":
-                ppath = "Applications"
-
-            #prepend the ppath so the paths match the actual install locations
-            path = path.lstrip("./")
-            if ppath:
-                path = ppath + "/" + path
-
-            values_t = (path, )
-            row = curs.execute(
-                'SELECT path_key from paths where path = ?',
-                                                        values_t).fetchone()
-            if not row:
-                curs.execute(
-                            'INSERT INTO paths (path) values (?)', values_t)
-                pathkey = curs.lastrowid
-            else:
-                pathkey = row[0]
+    # special case for MS Office 2008 installers
+    if ppath == "tmp/com.microsoft.updater/office_location":
+        ppath = "Applications"
+    if pathinfo is None:
+        pathinfo = listBomPaths(bompath)
+    importPaths(curs, pkgkey, installedPaths(pathinfo, ppath))
 
-            values_t = (pkgkey, pathkey, uid, gid, perms)
-            curs.execute(
-                '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
-                   values (?, ?, ?, ?, ?)''', values_t)
+    return pkgkey
 
 
-def ImportFromPkgutil(pkgname, curs):
+def ImportFromPkgutil(pkgname, curs, pathinfo=None):
     """
     Imports package data from pkgutil into our internal package database.
+    Returns the new pkg_key. pathinfo is what listPkgutilPaths returns, if
+    we already have it.
     """
 
     timestamp = 0
@@ -463,88 +571,69 @@ def ImportFromPkgutil(pkgname, curs):
            values (?, ?, ?, ?, ?, ?)''', values_t)
     pkgkey = curs.lastrowid
 
-    cmd = ["/usr/sbin/pkgutil", "--files", pkgid]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    while True:
-        line =  proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        path = line.rstrip("\n")
-
-        # pkgutil --files pkgid only gives us path info.  We don't
-        # really need perms, uid and gid, so we'll just fake them.
-        # if we needed them, we'd have to call
-        # pkgutil --export-plist pkgid and iterate through the
-        # plist.  That would be slower, so we'll do things this way...
-        perms = "0000"
-        uid = "0"
-        gid = "0"
-        if path != ".":
-            # special case for MS Office 2008 installers
-            # /tmp/com.microsoft.updater/office_location
-            if ppath == "tmp/com.microsoft.updater/office_location":
-                ppath = "Applications"
-
-            #prepend the ppath so the paths match the actual install locations
-            path = path.lstrip("./")
-            if ppath:
-                path = ppath + "/" + path
-
-            values_t = (path, )
-            row = curs.execute(
-                'SELECT path_key from paths where path = ?',
-                                                         values_t).fetchone()
-            if not row:
-                curs.execute(
-                            'INSERT INTO paths (path) values (?)', values_t)
-                pathkey = curs.lastrowid
-            else:
-                pathkey = row[0]
+    # special case for MS Office 2008 installers
+    # /tmp/com.microsoft.updater/office_location
+    if ppath == "tmp/com.microsoft.updater/office_location":
+        ppath = "Applications"
+    if pathinfo is None:
+        pathinfo = listPkgutilPaths(pkgid)
+    importPaths(curs, pkgkey, installedPaths(pathinfo, ppath))
 
-            values_t = (pkgkey, pathkey, uid, gid, perms)
-            curs.execute(
-                '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
-                   values (?, ?, ?, ?, ?)''', values_t)
+    return pkgkey
 
 
-def initDatabase(forcerebuild=False):
+def fileFingerprint(*paths):
     """
-    Builds or rebuilds our internal package database.
+    Returns a string that changes when any of the files at paths changes,
+    appears or disappears.
     """
-    if not shouldRebuildDB(packagedb) and not forcerebuild:
-        return True
-
-    munkicommon.display_status_minor(
-        'Gathering information on installed packages')
-
-    if os.path.exists(packagedb):
+    parts = []
+    for path in paths:
         try:
-            os.remove(packagedb)
-        except (OSError, IOError):
-            munkicommon.display_error(
-                "Could not remove out-of-date receipt database.")
-            return False
+            info = os.stat(path)
+            parts.append('%r:%s' % (info.st_mtime, info.st_size))
+        except OSError:
+            parts.append('-')
+    return ' '.join(parts)
 
-    os_version = munkicommon.getOsVersion(as_tuple=True)
-    pkgcount = 0
+
+def getInstalledReceipts():
+    """
+    Returns a list of the receipts on this machine, as
+    (receipt, fingerprint, importfunction, listfunction, importarg) tuples.
+    receipt is a unique name for the receipt; the fingerprint changes when
+    the receipt does; listfunction(importarg) lists the paths it installed
+    and importfunction(importarg, curs, pathinfo) imports it and those
+    paths into our database.
+    """
+    receipts = []
     receiptsdir = "/Library/Receipts"
     bomsdir = "/Library/Receipts/boms"
+    sl_receiptsdir = "/private/var/db/receipts"
     if os.path.exists(receiptsdir):
-        receiptlist = munkicommon.listdir(receiptsdir)
-        for item in receiptlist:
+        for item in munkicommon.listdir(receiptsdir):
             if item.endswith(".pkg"):
-                pkgcount += 1
+                receiptpath = os.path.join(receiptsdir, item)
+                fingerprint = fileFingerprint(
+                    receiptpath,
+                    os.path.join(receiptpath, 'Contents/Info.plist'),
+                    os.path.join(receiptpath, 'Contents/Archive.bom'),
+                    os.path.join(receiptpath, 'Contents/Resources',
+                                 os.path.splitext(item)[0] + '.bom'))
+                receipts.append(
+                    (receiptpath, fingerprint, ImportPackage,
+                     listReceiptPaths, receiptpath))
+
     if os.path.exists(bomsdir):
-        bomslist = munkicommon.listdir(bomsdir)
-        for item in bomslist:
+        for item in munkicommon.listdir(bomsdir):
             if item.endswith(".bom"):
-                pkgcount += 1
+                bompath = os.path.join(bomsdir, item)
+                receipts.append(
+                    (bompath, fileFingerprint(bompath), ImportBom,
+                     listBomPaths, bompath))
 
+    os_version = munkicommon.getOsVersion(as_tuple=True)
     if os_version >= (10, 6): # Snow Leopard or later
-        pkglist = []
         cmd = ['/usr/sbin/pkgutil', '--pkgs']
         proc = subprocess.Popen(cmd, shell=False, bufsize=1,
                                 stdin=subprocess.PIPE,
@@ -555,72 +644,211 @@ def initDatabase(forcerebuild=False):
             if not line and (proc.poll() != None):
                 break
 
-            pkglist.append(line.rstrip('\n'))
-            pkgcount += 1
+            pkg = line.rstrip('\n')
+            if not pkg:
+                continue
+            fingerprint = fileFingerprint(
+                os.path.join(sl_receiptsdir, pkg + '.plist'),
+                os.path.join(sl_receiptsdir, pkg + '.bom'))
+            receipts.append(
+                ('pkgutil:' + pkg.decode('UTF-8'), fingerprint,
+                 ImportFromPkgutil, listPkgutilPaths, pkg))
 
-    conn = sqlite3.connect(packagedb)
+    return receipts
+
+
+def forgetPackage(pkgkey, curs):
+    """
+    Removes a package's data from our internal package database.
+    Paths no longer used by any package are left for the caller to clean
+    up.
+    """
+    pkgkey_t = (pkgkey, )
+    curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
+    curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+    curs.execute('DELETE FROM receipts where pkg_key = ?', pkgkey_t)
+
+
+def removeUnusedPaths(curs):
+    """
+    Removes paths no package refers to anymore from our internal package
+    database.
+    """
+    curs.execute(
+        '''DELETE FROM paths WHERE NOT EXISTS
+           (SELECT 1 FROM pkgs_paths
+            WHERE pkgs_paths.path_key = paths.path_key)''')
+
+
+def prepareForImport(conn):
+    """
+    Creates the temporary table importPaths stages paths in. Creating a
+    table commits any open transaction, so we do this before we start one.
+    """
+    conn.execute('''CREATE TEMP TABLE staged_paths
+                         (path VARCHAR NOT NULL,
+                          uid INTEGER,
+                          gid INTEGER,
+                          perms INTEGER )''')
+
+
+def openDatabase():
+    """
+    Opens our existing internal package database so we can update it.
+    Returns a connection, or None if there isn't one we can use because
+    it's missing, damaged or from an older version of this module.
+    """
+    if not os.path.exists(packagedb):
+        return None
+    try:
+        conn = sqlite3.connect(packagedb)
+        if conn.execute('PRAGMA user_version').fetchone()[0] == \
+           RECEIPTDB_VERSION:
+            conn.text_factory = str
+            # databases from before pkgs_paths_path_key need it
+            CreateIndexes(conn.cursor())
+            prepareForImport(conn)
+            return conn
+        conn.close()
+    except sqlite3.Error:
+        pass
+    return None
+
+
+def createDatabase(dbpath):
+    """
+    Creates a new, empty internal package database at dbpath and returns
+    a connection to it. It's set up for loading as fast as possible: no
+    rollback journal and no waiting for the disk, since if anything goes
+    wrong before we're done we throw the whole thing away.
+    """
+    if os.path.exists(dbpath):
+        os.remove(dbpath)
+    conn = sqlite3.connect(dbpath)
     conn.text_factory = str
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA cache_size = 20000')
     curs = conn.cursor()
-    CreateTables(curs)
+    CreateTables(curs, indexes=False)
+    curs.close()
+    prepareForImport(conn)
+    return conn
 
-    currentpkgindex = 0
-    munkicommon.display_percent_done(0, pkgcount)
 
-    if os.path.exists(receiptsdir):
-        receiptlist = munkicommon.listdir(receiptsdir)
-        for item in receiptlist:
-            if munkicommon.stopRequested():
-                curs.close()
-                conn.close()
-                #our package db isn't valid, so we should delete it
-                os.remove(packagedb)
-                return False
+def initDatabase(forcerebuild=False):
+    """
+    Builds or updates our internal package database.
+    Only receipts that were added, changed or removed since the last time
+    are imported or dropped.
+    """
+    if not shouldRebuildDB(packagedb) and not forcerebuild:
+        return True
 
-            if item.endswith(".pkg"):
-                receiptpath = os.path.join(receiptsdir, item)
-                munkicommon.display_detail("Importing %s...", receiptpath)
-                ImportPackage(receiptpath, curs)
-                currentpkgindex += 1
-                munkicommon.display_percent_done(currentpkgindex, pkgcount)
+    munkicommon.display_status_minor(
+        'Gathering information on installed packages')
 
-    if os.path.exists(bomsdir):
-        bomslist = munkicommon.listdir(bomsdir)
-        for item in bomslist:
-            if munkicommon.stopRequested():
+    conn = None
+    if not forcerebuild:
+        conn = openDatabase()
+    rebuilding = conn is None
+    if rebuilding:
+        # build a new database next to the old one and swap it in when
+        # it's done, so we're never left with a partial one
+        dbpath = packagedb + '.new'
+        try:
+            conn = createDatabase(dbpath)
+        except (OSError, IOError, sqlite3.Error), err:
+            munkicommon.display_error(
+                "Could not create receipt database: %s", err)
+            return False
+    curs = conn.cursor()
+
+    # receipts that show up after this will be newer than our db
+    started = time.time()
+    known = {}
+    for (receipt, fingerprint, pkgkey) in curs.execute(
+            'SELECT receipt, fingerprint, pkg_key FROM receipts'):
+        known[receipt.decode('UTF-8')] = (fingerprint, pkgkey)
+
+    toimport = []
+    for receiptinfo in getInstalledReceipts():
+        receipt, fingerprint = receiptinfo[:2]
+        if receipt in known:
+            (known_fingerprint, pkgkey) = known.pop(receipt)
+            if known_fingerprint == fingerprint:
+                continue
+            # changed; import it again
+            if pkgkey is not None:
+                forgetPackage(pkgkey, curs)
+            curs.execute('DELETE FROM receipts where receipt = ?',
+                         (receipt, ))
+        toimport.append(receiptinfo)
+
+    # whatever is left has been removed from the machine
+    for receipt in known:
+        munkicommon.display_detail("Forgetting %s...", receipt)
+        (unused_fingerprint, pkgkey) = known[receipt]
+        if pkgkey is not None:
+            forgetPackage(pkgkey, curs)
+        curs.execute('DELETE FROM receipts where receipt = ?', (receipt, ))
+
+    pkgcount = len(toimport)
+    currentpkgindex = 0
+    munkicommon.display_percent_done(0, pkgcount)
+
+    # listing a receipt's paths is mostly waiting on lsbom or pkgutil, so
+    # we list several at once on worker threads, while this thread
+    # imports the listings in order and does all the database writes
+    listings = utils.iterConcurrently(listImportPaths, toimport,
+                                      max_workers=RECEIPT_LISTING_WORKERS)
+    for (receiptinfo, (pathinfo, err)) in itertools.izip(toimport, listings):
+        (receipt, fingerprint, importfunction, unused_listfunction,
+         importarg) = receiptinfo
+        if munkicommon.stopRequested():
+            # stops the workers from starting on any more receipts
+            listings.close()
+            if rebuilding:
                 curs.close()
                 conn.close()
-                #our package db isn't valid, so we should delete it
-                os.remove(packagedb)
-                return False
-
-            if item.endswith(".bom"):
-                bompath = os.path.join(bomsdir, item)
-                munkicommon.display_detail("Importing %s...", bompath)
-                ImportBom(bompath, curs)
-                currentpkgindex += 1
-                munkicommon.display_percent_done(currentpkgindex, pkgcount)
-    if os_version >= (10, 6):  # Snow Leopard or later
-        for pkg in pkglist:
-            if munkicommon.stopRequested():
+                os.remove(dbpath)
+            else:
+                conn.rollback()
                 curs.close()
                 conn.close()
-                #our package db isn't valid, so we should delete it
-                os.remove(packagedb)
-                return False
-
-            munkicommon.display_detail("Importing %s...", pkg)
-            ImportFromPkgutil(pkg, curs)
-            currentpkgindex += 1
-            munkicommon.display_percent_done(currentpkgindex, pkgcount)
+                # our package db is out of date, so make sure we look at
+                # the receipts again next time
+                os.utime(packagedb, (0, 0))
+            return False
 
-    # in case we didn't quite get to 100% for some reason
-    if currentpkgindex < pkgcount:
-        munkicommon.display_percent_done(pkgcount, pkgcount)
+        munkicommon.display_detail("Importing %s...", importarg)
+        if err:
+            # try again here, so any error is reported as it used to be
+            pathinfo = None
+        pkgkey = importfunction(importarg, curs, pathinfo)
+        curs.execute(
+            'INSERT INTO receipts (receipt, fingerprint, pkg_key) '
+            'values (?, ?, ?)', (receipt, fingerprint, pkgkey))
+        currentpkgindex += 1
+        munkicommon.display_percent_done(currentpkgindex, pkgcount)
+
+    if rebuilding:
+        # indexes are much faster to build in one go than to keep up to
+        # date while loading
+        CreateIndexes(curs)
+        curs.execute('PRAGMA user_version = %d' % RECEIPTDB_VERSION)
+    elif known or toimport:
+        removeUnusedPaths(curs)
 
     # commit and close the db when we're done.
     conn.commit()
     curs.close()
     conn.close()
+    if rebuilding:
+        os.rename(dbpath, packagedb)
+    # even if nothing changed, our db is now up to date
+    os.utime(packagedb, (started, started))
     return True
 
 
@@ -668,41 +896,33 @@ def getpkgkeys(pkgnames):
 
 def getpathstoremove(pkgkeylist):
     """
-    Queries our database for paths to remove.
+    Queries our database for paths to remove: the ones no package other
+    than the selected ones refers to.
     """
-    pkgkeys = tuple(pkgkeylist)
-
     # open connection and cursor to our database
     conn = sqlite3.connect(packagedb)
     curs = conn.cursor()
+    # databases from before pkgs_paths_path_key need it
+    CreateIndexes(curs)
 
-    # set up some subqueries:
-    # all the paths that are referred to by the selected packages:
-    if len(pkgkeys) > 1:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key in %s" % \
-           str(pkgkeys)
-    else:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key = %s" % \
-           str(pkgkeys[0])
-
-    # all the paths that are referred to by every package
-    # except the selected packages:
-    if len(pkgkeys) > 1:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key not in %s" % \
-         str(pkgkeys)
-    else:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key != %s" % \
-         str(pkgkeys[0])
-
-    # every path that is used by the selected packages and no other packages:
-    combined_query = \
-        "select path from paths where " + \
-        "(path_key in (%s) and path_key not in (%s))" % \
-                                (in_selected_packages, not_in_other_packages)
+    curs.execute(
+        'CREATE TEMP TABLE selected_pkgs (pkg_key INTEGER PRIMARY KEY)')
+    curs.executemany('INSERT OR IGNORE INTO selected_pkgs values (?)',
+                     [(pkgkey, ) for pkgkey in pkgkeylist])
+
+    # a path can go if every reference to it comes from one of the
+    # selected packages: count the references from the selected packages
+    # (using the pkg_key index), and compare with the count of all of them
+    # (using the path_key index)
+    combined_query = '''
+        SELECT paths.path FROM
+            (SELECT path_key, COUNT(*) AS selected_count FROM pkgs_paths
+             WHERE pkg_key IN (SELECT pkg_key FROM selected_pkgs)
+             GROUP BY path_key) AS selected
+        JOIN paths ON paths.path_key = selected.path_key
+        WHERE selected.selected_count =
+            (SELECT COUNT(*) FROM pkgs_paths
+             WHERE pkgs_paths.path_key = selected.path_key)'''
 
     munkicommon.display_status_minor(
         'Determining which filesystem items to remove')
@@ -770,8 +990,7 @@ def removeReceipts(pkgkeylist, noupdateapplepkgdb):
         # remove pkg info from our database
         munkicommon.display_detail(
             "Removing package data from internal database...")
-        curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
-        curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+        forgetPackage(pkgkey, curs)
 
         # then remove pkg info from Apple's database unless option is passed
         if not noupdateapplepkgdb and pkgid:
@@ -833,9 +1052,7 @@ def removeReceipts(pkgkeylist, noupdateapplepkgdb):
     # Apple DB...
     munkicommon.display_detail("Removing unused paths from internal package "
                                "database...")
-    curs.execute(
-        '''DELETE FROM paths where path_key not in
-           (select distinct path_key from pkgs_paths)''')
+    removeUnusedPaths(curs)
     conn.commit()
     curs.close()
     conn.close()
@@ -843,151 +1060,253 @@ def removeReceipts(pkgkeylist, noupdateapplepkgdb):
     munkicommon.display_percent_done(4, 4)
 
 
-def isBundle(pathname):
+# directory extensions that mean a directory is a bundle
+BUNDLE_EXTENSIONS = set([".action",
+                         ".app",
+                         ".bundle",
+                         ".clr",
+                         ".colorPicker",
+                         ".component",
+                         ".dictionary",
+                         ".docset",
+                         ".framework",
+                         ".fs",
+                         ".kext",
+                         ".loginPlugin",
+                         ".mdiimporter",
+                         ".monitorPanel",
+                         ".osax",
+                         ".pkg",
+                         ".plugin",
+                         ".prefPane",
+                         ".qlgenerator",
+                         ".saver",
+                         ".service",
+                         ".slideSaver",
+                         ".SpeechRecognizer",
+                         ".SpeechSynthesizer",
+                         ".SpeechVoice",
+                         ".spreporter",
+                         ".wdgt"])
+
+
+def hasBundleExtension(pathname):
     """
-    Returns true if pathname is a bundle-style directory.
+    Returns true if pathname's extension is one bundles use.
     """
-    bundle_extensions = [".action",
-                       ".app",
-                       ".bundle",
-                       ".clr",
-                       ".colorPicker",
-                       ".component",
-                       ".dictionary",
-                       ".docset",
-                       ".framework",
-                       ".fs",
-                       ".kext",
-                       ".loginPlugin",
-                       ".mdiimporter",
-                       ".monitorPanel",
-                       ".osax",
-                       ".pkg",
-                       ".plugin",
-                       ".prefPane",
-                       ".qlgenerator",
-                       ".saver",
-                       ".service",
-                       ".slideSaver",
-                       ".SpeechRecognizer",
-                       ".SpeechSynthesizer",
-                       ".SpeechVoice",
-                       ".spreporter",
-                       ".wdgt" ]
-    if os.path.isdir(pathname):
-        basename = os.path.basename(pathname)
-        extension = os.path.splitext(basename)[1]
-        if extension in bundle_extensions:
-            return True
-        else:
-            return False
-    else:
-        return False
+    return os.path.splitext(os.path.basename(pathname))[1] in \
+        BUNDLE_EXTENSIONS
 
 
-def insideBundle(pathname):
-    '''Check the path to see if it's inside a bundle.'''
-    while len(pathname) > 1:
-        if isBundle(pathname):
-            return True
-        else:
-            # chop off last item in path
-            pathname = os.path.dirname(pathname)
-    #if we get here, we didn't find a bundle path
-    return False
+def findBundles(pathnames):
+    """
+    Returns a dict mapping each directory that contains any of pathnames
+    to a tuple of the bundle directories that are or contain it, outermost
+    first. Each directory is looked at once, no matter how many of
+    pathnames it contains, and only if its name looks like a bundle's.
+    """
+    bundles = {'': ()}
+    for pathname in pathnames:
+        parent = pathname.rpartition('/')[0]
+        unknown = []
+        while parent not in bundles:
+            unknown.append(parent)
+            parent = parent.rpartition('/')[0]
+        enclosing = bundles[parent]
+        for directory in reversed(unknown):
+            if hasBundleExtension(directory):
+                try:
+                    if stat.S_ISDIR(os.lstat(directory).st_mode):
+                        enclosing = enclosing + (directory, )
+                except OSError:
+                    pass
+            bundles[directory] = enclosing
+    return bundles
+
+
+def removeDirectory(pathtoremove):
+    """
+    Removes a directory if it's empty, or holds nothing but a .DS_Store.
+    Returns False if it isn't empty; raises OSError if it can't be
+    removed for any other reason.
+    """
+    try:
+        os.rmdir(pathtoremove)
+        return True
+    except OSError, err:
+        if err.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+    if munkicommon.listdir(pathtoremove) != ['.DS_Store']:
+        return False
+    # If there's only a .DS_Store file we'll consider it empty
+    try:
+        os.remove(os.path.join(pathtoremove, '.DS_Store'))
+    except (OSError, IOError):
+        return False
+    os.rmdir(pathtoremove)
+    return True
 
 
-def removeFilesystemItems(removalpaths, forcedeletebundles):
+def removeFilesystemItems(removalpaths, forcedeletebundles, dryrun=False):
     """
-    Attempts to remove all the paths in the array removalpaths
+    Attempts to remove all the paths in the array removalpaths.
+    Each path is looked at with a single lstat. With dryrun, nothing is
+    removed; we just report what we would try to remove.
+    Returns a dict of counts of what was (or would be) removed.
     """
+    started = time.time()
     # we sort in reverse because we can delete from the bottom up,
     # clearing a directory before we try to remove the directory itself
     removalpaths.sort(reverse=True)
     removalerrors = ""
-    removalcount = len(removalpaths)
-    munkicommon.display_status_minor(
-        'Removing %s filesystem items' % removalcount)
-
     itemcount = len(removalpaths)
+    if dryrun:
+        munkicommon.display_status_minor(
+            'Checking %s filesystem items' % itemcount)
+    else:
+        munkicommon.display_status_minor(
+            'Removing %s filesystem items' % itemcount)
+
+    pathstoremove = ["/" + item for item in removalpaths]
+    # the bundles that contain the items we're removing, so we don't need
+    # to look at every parent directory of every item to find them
+    bundles = findBundles(pathstoremove)
+    # bundles we'll remove whole; no need to remove what's in them first
+    removalbundles = set()
+    if forcedeletebundles:
+        for enclosing in set(bundles.values()):
+            removalbundles.update(enclosing)
+        removalbundles.intersection_update(pathstoremove)
+
+    counts = {'files': 0, 'directories': 0, 'bundles': 0, 'missing': 0,
+              'in_bundles': 0, 'not_removed': 0}
+    # with dryrun, what we would have removed (or found missing) so far,
+    # so we can tell which directories would be empty when we got to them
+    gone = set()
+    # updating the progress display for every item is slow
+    progressstep = max(itemcount / 100, 1)
     itemindex = 0
     munkicommon.display_percent_done(itemindex, itemcount)
 
-    for item in removalpaths:
+    for pathtoremove in pathstoremove:
         itemindex += 1
-        pathtoremove = "/" + item
-        # use os.path.lexists so broken links return true
-        # so we can remove them
-        if os.path.lexists(pathtoremove):
-            munkicommon.display_detail("Removing: " + pathtoremove)
-            if (os.path.isdir(pathtoremove) and \
-               not os.path.islink(pathtoremove)):
-                diritems = munkicommon.listdir(pathtoremove)
-                if diritems == ['.DS_Store']:
-                    # If there's only a .DS_Store file
-                    # we'll consider it empty
-                    ds_storepath = pathtoremove + "/.DS_Store"
-                    try:
-                        os.remove(ds_storepath)
-                    except (OSError, IOError):
-                        pass
-                    diritems = munkicommon.listdir(pathtoremove)
-                if diritems == []:
-                    # directory is empty
-                    try:
-                        os.rmdir(pathtoremove)
-                    except (OSError, IOError), err:
-                        msg = "Couldn't remove directory %s - %s" % (
-                            pathtoremove, err)
-                        munkicommon.display_error(msg)
-                        removalerrors = removalerrors + "\n" + msg
-                else:
-                    # the directory is marked for deletion but isn't empty.
-                    # if so directed, if it's a bundle (like .app), we should
-                    # remove it anyway - no use having a broken bundle hanging
-                    # around
-                    if (forcedeletebundles and isBundle(pathtoremove)):
-                        munkicommon.display_warning(
-                            "Removing non-empty bundle: %s", pathtoremove)
-                        retcode = subprocess.call(['/bin/rm', '-r',
-                                                   pathtoremove])
-                        if retcode:
-                            msg = "Couldn't remove bundle %s" % pathtoremove
-                            munkicommon.display_error(msg)
-                            removalerrors = removalerrors + "\n" + msg
-                    else:
-                        # if this path is inside a bundle, and we've been
-                        # directed to force remove bundles,
-                        # we don't need to warn because it's going to be
-                        # removed with the bundle.
-                        # Otherwise, we should warn about non-empty
-                        # directories.
-                        if not insideBundle(pathtoremove) or \
-                           not forcedeletebundles:
-                            msg = \
-                              "Did not remove %s because it is not empty." % \
-                               pathtoremove
-                            munkicommon.display_error(msg)
-                            removalerrors = removalerrors + "\n" + msg
+        if itemindex % progressstep == 0 or itemindex == itemcount:
+            munkicommon.display_percent_done(itemindex, itemcount)
 
+        enclosing = bundles[pathtoremove.rpartition('/')[0]]
+        if enclosing and removalbundles.intersection(enclosing):
+            # this goes when we remove the bundle
+            counts['in_bundles'] += 1
+            continue
+
+        # use lstat so broken links are found and so we can remove them
+        try:
+            mode = os.lstat(pathtoremove).st_mode
+        except OSError:
+            counts['missing'] += 1
+            if dryrun:
+                gone.add(pathtoremove)
+            continue
+
+        if not stat.S_ISDIR(mode):
+            # not a directory, just unlink it
+            # I was using rm instead of Python because I don't trust
+            # handling of resource forks with Python
+            #retcode = subprocess.call(['/bin/rm', pathtoremove])
+            # but man that's slow.
+            # I think there's a lot of overhead with the
+            # subprocess call. I'm going to use os.remove.
+            # I hope I don't regret it.
+            if dryrun:
+                counts['files'] += 1
+                gone.add(pathtoremove)
+                continue
+            munkicommon.display_detail("Removing: " + pathtoremove)
+            try:
+                os.remove(pathtoremove)
+                counts['files'] += 1
+            except (OSError, IOError), err:
+                msg = "Couldn't remove item %s: %s" % (pathtoremove, err)
+                munkicommon.display_error(msg)
+                removalerrors = removalerrors + "\n" + msg
+                counts['not_removed'] += 1
+            continue
+
+        isbundle = hasBundleExtension(pathtoremove)
+        if dryrun:
+            # we go from the bottom up, so anything in this directory we
+            # would remove has been seen already
+            try:
+                empty = not [name for name in os.listdir(pathtoremove)
+                             if name != '.DS_Store' and not
+                             os.path.join(pathtoremove, name) in gone]
+            except OSError:
+                empty = False
+            if empty:
+                counts['directories'] += 1
+                gone.add(pathtoremove)
+            elif forcedeletebundles and isbundle:
+                counts['bundles'] += 1
+                gone.add(pathtoremove)
             else:
-                # not a directory, just unlink it
-                # I was using rm instead of Python because I don't trust
-                # handling of resource forks with Python
-                #retcode = subprocess.call(['/bin/rm', pathtoremove])
-                # but man that's slow.
-                # I think there's a lot of overhead with the
-                # subprocess call. I'm going to use os.remove.
-                # I hope I don't regret it.
-                retcode = ''
-                try:
-                    os.remove(pathtoremove)
-                except (OSError, IOError), err:
-                    msg = "Couldn't remove item %s: %s" % (pathtoremove, err)
-                    munkicommon.display_error(msg)
-                    removalerrors = removalerrors + "\n" + msg
+                counts['not_removed'] += 1
+            continue
 
-        munkicommon.display_percent_done(itemindex, itemcount)
+        munkicommon.display_detail("Removing: " + pathtoremove)
+        try:
+            if removeDirectory(pathtoremove):
+                counts['directories'] += 1
+                continue
+        except (OSError, IOError), err:
+            msg = "Couldn't remove directory %s - %s" % (pathtoremove, err)
+            munkicommon.display_error(msg)
+            removalerrors = removalerrors + "\n" + msg
+            counts['not_removed'] += 1
+            continue
+
+        # the directory is marked for deletion but isn't empty.
+        # if so directed, if it's a bundle (like .app), we should
+        # remove it anyway - no use having a broken bundle hanging
+        # around
+        if forcedeletebundles and isbundle:
+            munkicommon.display_warning(
+                "Removing non-empty bundle: %s", pathtoremove)
+            try:
+                shutil.rmtree(pathtoremove)
+                counts['bundles'] += 1
+            except (OSError, IOError), err:
+                msg = "Couldn't remove bundle %s: %s" % (pathtoremove, err)
+                munkicommon.display_error(msg)
+                removalerrors = removalerrors + "\n" + msg
+                counts['not_removed'] += 1
+            continue
+
+        counts['not_removed'] += 1
+        # if this path is inside a bundle, and we've been
+        # directed to force remove bundles,
+        # we don't need to warn because it's going to be
+        # removed with the bundle.
+        # Otherwise, we should warn about non-empty
+        # directories.
+        if not forcedeletebundles or not enclosing:
+            msg = "Did not remove %s because it is not empty." % \
+                   pathtoremove
+            munkicommon.display_error(msg)
+            removalerrors = removalerrors + "\n" + msg
+
+    if dryrun:
+        munkicommon.display_info(
+            "Would remove %s files, %s directories and %s bundles with %s "
+            "items in them; %s items are already gone. Checked %s items in "
+            "%.1f seconds.", counts['files'], counts['directories'],
+            counts['bundles'], counts['in_bundles'], counts['missing'],
+            itemcount, time.time() - started)
+    else:
+        munkicommon.display_detail(
+            "Removed %s files, %s directories and %s bundles with %s "
+            "items in them in %.1f seconds.", counts['files'],
+            counts['directories'], counts['bundles'], counts['in_bundles'],
+            time.time() - started)
 
     if removalerrors:
         munkicommon.display_info(
@@ -998,13 +1317,16 @@ def removeFilesystemItems(removalpaths, forcedeletebundles):
                         "---------------------------------------------------")
         munkicommon.display_info(removalerrors)
 
+    return counts
+
 
 def removepackages(pkgnames, forcedeletebundles=False, listfiles=False,
                     rebuildpkgdb=False, noremovereceipts=False,
-                    noupdateapplepkgdb=False):
+                    noupdateapplepkgdb=False, dryrun=False):
     """
     Our main function, called by installer.py to remove items based on
-    receipt info.
+    receipt info. With dryrun, reports what would be removed without
+    removing anything.
     """
     if pkgnames == []:
         munkicommon.display_error(
@@ -1030,6 +1352,9 @@ def removepackages(pkgnames, forcedeletebundles=False, listfiles=False,
             removalpaths.sort()
             for item in removalpaths:
                 print "/" + item.encode('UTF-8')
+        elif dryrun:
+            removeFilesystemItems(removalpaths, forcedeletebundles,
+                                  dryrun=True)
         else:
             if munkicommon.munkistatusoutput:
                 munkistatus.disableStopButton()
@@ -1039,7 +1364,7 @@ def removepackages(pkgnames, forcedeletebundles=False, listfiles=False,
         if munkicommon.munkistatusoutput:
             time.sleep(2)
 
-    if not listfiles:
+    if not listfiles and not dryrun:
         if not noremovereceipts:
             removeReceipts(pkgkeyslist, noupdateapplepkgdb)
         if munkicommon.munkistatusoutput:
@@ -1052,6 +1377,10 @@ def removepackages(pkgnames, forcedeletebundles=False, listfiles=False,
 
 # some globals
 packagedb = os.path.join(munkicommon.pref('ManagedInstallDir'), "b.receiptdb")
+# bump this when the schema changes, so older databases are rebuilt
+RECEIPTDB_VERSION = 2
+# how many lsbom/pkgutil processes to run at once when importing receipts
+RECEIPT_LISTING_WORKERS = 4
 
 def main():
     '''Used when calling removepackages.py directly from the command line.'''
@@ -1063,6 +1392,10 @@ def main():
     p.add_option('--listfiles', '-l', action='store_true',
                     help='''List the filesystem objects to be removed,
                     but do not actually remove them.''')
+    p.add_option('--dryrun', '-n', action='store_true',
+                    help='''Report how many filesystem objects would be
+                    removed, and how long it took to check them, but do not
+                    actually remove them.''')
     p.add_option('--rebuildpkgdb', action='store_true',
                     help='Force a rebuild of the internal package database.')
     p.add_option('--noremovereceipts', action='store_true',
@@ -1100,7 +1433,8 @@ def main():
                              listfiles=options.listfiles,
                              rebuildpkgdb=options.rebuildpkgdb,
                              noremovereceipts=options.noremovereceipts,
-                             noupdateapplepkgdb=options.noupdateapplepkgdb)
+                             noupdateapplepkgdb=options.noupdateapplepkgdb,
+                             dryrun=options.dryrun)
     if options.munkistatusoutput:
         munkistatus.quit()
     exit(retcode)
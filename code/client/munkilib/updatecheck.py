@@ -26,8 +26,12 @@ import datetime
 import os
 import subprocess
 import socket
+import tempfile
+import threading
+import time
 import urllib2
 import urlparse
+import xattr
 from urllib import quote_plus
 from OpenSSL.crypto import load_certificate, FILETYPE_PEM
 
@@ -37,6 +41,7 @@ import munkicommon
 import munkistatus
 import appleupdates
 import FoundationPlist
+import utils
 
 # Apple's libs
 from Foundation import NSDate, NSPredicate, NSTimeZone
@@ -82,6 +87,16 @@ def makeCatalogDB(catalogitems):
                     pkgid_table[pkg_id][version] = []
                 pkgid_table[pkg_id][version].append(itemindex)
 
+    # order each name's items latest version first, so that lookups for
+    # the latest version don't have to sort and parse versions every time
+    for name in name_table:
+        versionlist = sorted(name_table[name].keys(),
+                             key=munkicommon.MunkiVersionKey, reverse=True)
+        latest = []
+        for vers in versionlist:
+            latest.extend(name_table[name][vers])
+        name_table[name]['latest'] = latest
+
     # build table of update items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'update_for' list
@@ -94,6 +109,19 @@ def makeCatalogDB(catalogitems):
             # convert to list of strings
             update['update_for'] = [update['update_for']]
 
+    # build a reverse index of update_for values, so we can find the updates
+    # for an item without scanning all the updaters
+    update_for_table = {}
+    for update in updaters:
+        updatename = update.get('name')
+        if not updatename:
+            continue
+        for update_for in update['update_for']:
+            if not update_for in update_for_table:
+                update_for_table[update_for] = []
+            if not updatename in update_for_table[update_for]:
+                update_for_table[update_for].append(updatename)
+
     # build table of autoremove items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'autoremove' list
@@ -109,6 +137,7 @@ def makeCatalogDB(catalogitems):
     pkgdb['named'] = name_table
     pkgdb['receipts'] = pkgid_table
     pkgdb['updaters'] = updaters
+    pkgdb['update_for'] = update_for_table
     pkgdb['autoremoveitems'] = autoremoveitems
     pkgdb['items'] = catalogitems
 
@@ -186,8 +215,8 @@ def getInstalledPackages():
                         # installed, since presumably
                         # the newer package replaced the older one
                         storedversion = INSTALLEDPKGS[pkgid]
-                        if (munkicommon.MunkiLooseVersion(thisversion) >
-                            munkicommon.MunkiLooseVersion(storedversion)):
+                        if (munkicommon.MunkiVersionKey(thisversion) >
+                            munkicommon.MunkiVersionKey(storedversion)):
                             INSTALLEDPKGS[pkgid] = thisversion
 
     #ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
@@ -204,14 +233,14 @@ def bestVersionMatch(vers_num, item_dict):
     precision = 1
     while precision <= len(vers_tuple):
         test_vers = '.'.join(vers_tuple[0:precision])
-        match_names = []
+        match_names = set()
         for item in item_dict.keys():
             for item_version in item_dict[item]:
-                if (item_version.startswith(test_vers) and
-                    item not in match_names):
-                    match_names.append(item)
+                if item_version.startswith(test_vers):
+                    match_names.add(item)
+                    break
         if len(match_names) == 1:
-            return match_names[0]
+            return match_names.pop()
         precision = precision + 1
 
     return None
@@ -367,11 +396,11 @@ def compareVersions(thisvers, thatvers):
       1 if thisvers is the same as thatvers
       2 if thisvers is newer than thatvers
     """
-    if (munkicommon.MunkiLooseVersion(thisvers) <
-        munkicommon.MunkiLooseVersion(thatvers)):
+    thiskey = munkicommon.MunkiVersionKey(thisvers)
+    thatkey = munkicommon.MunkiVersionKey(thatvers)
+    if thiskey < thatkey:
         return -1
-    elif (munkicommon.MunkiLooseVersion(thisvers) ==
-          munkicommon.MunkiLooseVersion(thatvers)):
+    elif thiskey == thatkey:
         return 1
     else:
         return 2
@@ -778,8 +807,28 @@ def getInstalledVersion(item_plist):
     return 'UNKNOWN'
 
 
-def download_installeritem(item_pl, installinfo, uninstalling=False):
+def getInstallerItemURL(item_pl, location):
+    """Returns the URL to download the installer item at location from"""
+    # allow pkginfo preferences to override system munki preferences
+    downloadbaseurl = item_pl.get('PackageCompleteURL') or \
+                      item_pl.get('PackageURL') or \
+                      munkicommon.pref('PackageURL') or \
+                      munkicommon.pref('SoftwareRepoURL') + '/pkgs/'
+    munkicommon.display_debug2('Download base URL is: %s', downloadbaseurl)
+
+    # build a URL, quoting the the location to encode reserved characters
+    if item_pl.get('PackageCompleteURL'):
+        return downloadbaseurl
+    if not downloadbaseurl.endswith('/'):
+        downloadbaseurl = downloadbaseurl + '/'
+    return downloadbaseurl + urllib2.quote(location)
+
+
+def download_installeritem(item_pl, installinfo, uninstalling=False,
+                           check_space=True):
     """Downloads an (un)installer item.
+    Set check_space to False if the disk space was already checked when
+    the download was queued.
     Returns True if the item was downloaded, False if it was already cached.
     Raises an error if there are issues..."""
 
@@ -794,22 +843,8 @@ def download_installeritem(item_pl, installinfo, uninstalling=False):
         raise fetch.MunkiDownloadError(
             "No %s in item info.", download_item_key)
 
-    # allow pkginfo preferences to override system munki preferences
-    downloadbaseurl = item_pl.get('PackageCompleteURL') or \
-                      item_pl.get('PackageURL') or \
-                      munkicommon.pref('PackageURL') or \
-                      munkicommon.pref('SoftwareRepoURL') + '/pkgs/'
-
-    # build a URL, quoting the the location to encode reserved characters
-    if item_pl.get('PackageCompleteURL'):
-        pkgurl = downloadbaseurl
-    else:
-        if not downloadbaseurl.endswith('/'):
-            downloadbaseurl = downloadbaseurl + '/'
-        pkgurl = downloadbaseurl + urllib2.quote(location)
-
+    pkgurl = getInstallerItemURL(item_pl, location)
     pkgname = getInstallerItemBasename(location)
-    munkicommon.display_debug2('Download base URL is: %s', downloadbaseurl)
     munkicommon.display_debug2('Package name is: %s', pkgname)
     munkicommon.display_debug2('Download URL is: %s', pkgurl)
 
@@ -820,7 +855,15 @@ def download_installeritem(item_pl, installinfo, uninstalling=False):
 
     munkicommon.display_detail('Downloading %s from %s', pkgname, location)
 
-    if not os.path.exists(destinationpath):
+    expected_hash = item_pl.get(item_hash_key, None)
+    if (expected_hash and not os.path.exists(destinationpath)
+            and linkFromContentStore(mycachedir, expected_hash,
+                                     destinationpath)):
+        munkicommon.display_detail(
+            'Using %s from the download cache', pkgname)
+        return False
+
+    if check_space and not os.path.exists(destinationpath):
         # check to see if there is enough free space to download and install
         if not enoughDiskSpace(item_pl, installinfo['managed_installs']):
             raise fetch.MunkiDownloadError(
@@ -830,15 +873,237 @@ def download_installeritem(item_pl, installinfo, uninstalling=False):
                 'Downloading %s from %s', pkgname, location)
 
     dl_message = 'Downloading %s...' % pkgname
-    expected_hash = item_pl.get(item_hash_key, None)
+    # a download_rate_limit in the pkginfo overrides the DownloadRateLimit
+    # preference; both are in KB/sec
+    rate_limit = item_pl.get('download_rate_limit',
+                             munkicommon.pref('DownloadRateLimit'))
+    peer_url = munkicommon.pref('PeerCacheURL')
+    if peer_url and expected_hash and not os.path.exists(destinationpath):
+        # peer downloads keep to the download window and rate limit too
+        max_time = fetch.getDownloadWindowTimeLeft()
+        if max_time == 0:
+            raise fetch.DownloadWindowError(
+                'Outside of the download window (%s)'
+                % fetch.describeDownloadWindow())
+        if fetch.getResourceFromPeer(peer_url, expected_hash,
+                                     destinationpath, message=dl_message,
+                                     rate_limit=rate_limit,
+                                     max_time=max_time):
+            munkicommon.display_detail('Got %s from peer cache', pkgname)
+            addToContentStore(mycachedir, expected_hash, destinationpath)
+            return True
+
+    changed = getResourceIfChangedAtomically(pkgurl, destinationpath,
+                                             resume=True,
+                                             message=dl_message,
+                                             expected_hash=expected_hash,
+                                             verify=True,
+                                             rate_limit=rate_limit,
+                                             windowed=True)
+    if expected_hash:
+        addToContentStore(mycachedir, expected_hash, destinationpath)
+    return changed
+
+
+def getDownloadSpeed(installer_item_size, elapsed):
+    """Returns download speed in KB/sec given installer_item_size in KB and
+    elapsed, a datetime.timedelta."""
+    try:
+        if installer_item_size < 1024:
+            # ignore downloads under 1 MB or speeds will
+            # be skewed.
+            return 0
+        # installer_item_size is KBytes, so divide
+        # by seconds.
+        return int(installer_item_size / elapsed.seconds)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0
+
+
+# installer items to download once the install plan is complete. None
+# means processInstall downloads items as it goes.
+DOWNLOAD_QUEUE = None
+
+def queueDownload(item_pl, iteminfo, installinfo, manifestitem):
+    """Adds an installer item to DOWNLOAD_QUEUE. iteminfo is the item's
+    entry in installinfo['managed_installs'], updated by
+    downloadQueuedItems once the download is done.
+    Raises fetch.MunkiDownloadError if we can't download the item."""
+    location = item_pl.get('installer_item_location')
+    if not location:
+        raise fetch.MunkiDownloadError(
+            'No installer_item_location in item info.')
+    pkgname = getInstallerItemBasename(location)
+    mycachedir = os.path.join(munkicommon.pref('ManagedInstallDir'), 'Cache')
+    destinationpath = getDownloadCachePath(mycachedir, location)
+    if not os.path.exists(destinationpath):
+        # check to see if there is enough free space to download and install
+        # this and everything queued before it
+        if not enoughDiskSpace(item_pl, installinfo['managed_installs']):
+            raise fetch.MunkiDownloadError(
+                'Insufficient disk space to download and install %s'
+                % pkgname)
+    munkicommon.display_debug1('Queueing download of %s', pkgname)
+    DOWNLOAD_QUEUE.append({
+        'item_pl': item_pl,
+        'iteminfo': iteminfo,
+        'manifestitem': manifestitem,
+        'destinationpath': destinationpath,
+        'host': urlparse.urlparse(getInstallerItemURL(item_pl, location))[1],
+    })
+
+
+def downloadQueuedItem(queued, installinfo, host_semaphores):
+    """Downloads a single item from DOWNLOAD_QUEUE, recording the download
+    speed in its iteminfo. Raises fetch.MunkiDownloadError on failure."""
+    if munkicommon.stopRequested():
+        raise fetch.MunkiDownloadError('Stop requested')
+    semaphore = host_semaphores[queued['host']]
+    semaphore.acquire()
     try:
-        return getResourceIfChangedAtomically(pkgurl, destinationpath,
-                                              resume=True,
-                                              message=dl_message,
-                                              expected_hash=expected_hash,
-                                              verify=True)
-    except fetch.MunkiDownloadError:
-        raise
+        start = datetime.datetime.now()
+        # queueDownload made sure there's space for this and everything
+        # queued before it; installinfo['managed_installs'] now also holds
+        # this item and the ones after it, so checking again would count
+        # them against it
+        if download_installeritem(queued['item_pl'], installinfo,
+                                  check_space=False):
+            # Record the download speed to the InstallResults output.
+            download_speed = getDownloadSpeed(
+                queued['iteminfo']['installer_item_size'],
+                datetime.datetime.now() - start)
+        else:
+            download_speed = 0
+    finally:
+        semaphore.release()
+    queued['iteminfo']['download_kbytes_per_sec'] = download_speed
+    if download_speed:
+        munkicommon.display_detail(
+            '%s downloaded at %d KB/s',
+            queued['iteminfo']['installer_item'], download_speed)
+
+
+def markPrerequisiteFailures(installinfo, failed_names):
+    """Marks items in managed_installs that require, or are updates for,
+    an item we couldn't download, so we don't try to install them
+    either. Repeats until no more items are affected."""
+    while failed_names:
+        newly_failed = set()
+        for iteminfo in installinfo['managed_installs']:
+            if iteminfo.get('installed') or not iteminfo.get('installer_item'):
+                continue
+            prerequisites = []
+            for key in ['requires', 'update_for']:
+                value = iteminfo.get(key) or []
+                if isinstance(value, basestring):
+                    value = [value]
+                prerequisites.extend(value)
+            failed_prereqs = [prereq for prereq in prerequisites
+                              if nameAndVersion(prereq)[0] in failed_names]
+            if failed_prereqs:
+                munkicommon.display_warning(
+                    'Can\'t install %s because these prerequisites could '
+                    'not be downloaded: %s', iteminfo['name'],
+                    ', '.join(failed_prereqs))
+                del iteminfo['installer_item']
+                iteminfo['note'] = ('Prerequisite download failed (%s)'
+                                    % ', '.join(failed_prereqs))
+                newly_failed.add(iteminfo['name'])
+        failed_names = newly_failed
+
+
+def downloadQueuedItems(installinfo):
+    """Downloads everything in DOWNLOAD_QUEUE, several items at once if the
+    MaxConcurrentDownloads preference allows, then marks failed items and
+    the items that depend on them."""
+    if not DOWNLOAD_QUEUE:
+        return
+    queue = list(DOWNLOAD_QUEUE)
+    del DOWNLOAD_QUEUE[:]
+
+    if munkicommon.pref('DownloadOrder') == 'largest_first':
+        queue = sorted(
+            queue, reverse=True,
+            key=lambda queued: int(
+                queued['iteminfo'].get('installer_item_size') or 0))
+    max_workers = int(munkicommon.pref('MaxConcurrentDownloads') or 1)
+    per_host = int(munkicommon.pref('MaxConcurrentDownloadsPerHost') or 1)
+    host_semaphores = {}
+    for queued in queue:
+        if not queued['host'] in host_semaphores:
+            host_semaphores[queued['host']] = threading.Semaphore(per_host)
+
+    def download(queued):
+        """Worker function for concurrent downloads"""
+        # we display the overall progress instead
+        fetch.THREAD_SETTINGS.quiet_progress = True
+        return downloadQueuedItem(queued, installinfo, host_semaphores)
+
+    if max_workers < 2 or len(queue) < 2:
+        results = [(None, None)] * len(queue)
+        for index, queued in enumerate(queue):
+            try:
+                results[index] = (
+                    downloadQueuedItem(queued, installinfo, host_semaphores),
+                    None)
+            except fetch.MunkiDownloadError, err:
+                results[index] = (None, err)
+    else:
+        munkicommon.display_status_major(
+            'Downloading %s items...' % len(queue))
+        results = []
+        runner = threading.Thread(
+            target=lambda: results.extend(utils.runConcurrently(
+                download, queue, max_workers=max_workers)))
+        runner.daemon = True
+        runner.start()
+        # show overall progress of all the downloads
+        total_size = sum([int(queued['iteminfo'].get('installer_item_size')
+                              or 0) * 1024 for queued in queue])
+        downloadedpercent = -1
+        while runner.isAlive():
+            runner.join(0.5)
+            if not total_size:
+                continue
+            downloaded_size = 0
+            for queued in queue:
+                for path in [queued['destinationpath'],
+                             queued['destinationpath'] + '.download']:
+                    try:
+                        downloaded_size += os.path.getsize(path)
+                        break
+                    except OSError:
+                        pass
+            percent = min(int(float(downloaded_size) / total_size * 100), 100)
+            if percent != downloadedpercent:
+                downloadedpercent = percent
+                munkicommon.display_percent_done(percent, 100)
+
+    failed_names = set()
+    for queued, (unused_value, err) in zip(queue, results):
+        if not err:
+            continue
+        if not isinstance(err, fetch.MunkiDownloadError):
+            raise err
+        iteminfo = queued['iteminfo']
+        manifestitem = queued['manifestitem']
+        if isinstance(err, fetch.PackageVerificationError):
+            munkicommon.display_warning(
+                'Can\'t install %s because the integrity check failed.',
+                manifestitem)
+            iteminfo['note'] = 'Integrity check failed'
+        elif isinstance(err, fetch.CurlDownloadError):
+            munkicommon.display_warning(
+                'Download of %s failed: %s', manifestitem, err)
+            iteminfo['note'] = 'Download failed (%s)' % err
+        else:
+            munkicommon.display_warning(
+                'Can\'t install %s because: %s', manifestitem, err)
+            iteminfo['note'] = '%s' % err
+        iteminfo['installed'] = False
+        del iteminfo['installer_item']
+        failed_names.add(iteminfo['name'])
+    markPrerequisiteFailures(installinfo, failed_names)
 
 
 def isItemInInstallInfo(manifestitem_pl, thelist, vers=''):
@@ -895,12 +1160,8 @@ def getAllItemsWithName(name, cataloglist):
       list of pkginfo items; sorted with newest version first. No precedence
       is given to catalog order.
     """
-    def compare_item_versions(a, b):
-        """Internal comparison function for use with sorting"""
-        return cmp(munkicommon.MunkiLooseVersion(b['version']),
-                   munkicommon.MunkiLooseVersion(a['version']))
-
     itemlist = []
+    catalogs_with_name = 0
     # we'll throw away any included version info
     name = nameAndVersion(name)[0]
 
@@ -911,21 +1172,22 @@ def getAllItemsWithName(name, cataloglist):
             continue
         # is name in the catalog name table?
         if name in CATALOG[catalogname]['named']:
-            versionsmatchingname = CATALOG[catalogname]['named'][name]
-            for vers in versionsmatchingname.keys():
-                if vers != 'latest':
-                    indexlist = CATALOG[catalogname]['named'][name][vers]
-                    for index in indexlist:
-                        thisitem = CATALOG[catalogname]['items'][index]
-                        if not thisitem in itemlist:
-                            munkicommon.display_debug1(
-                             'Adding item %s, version %s from catalog %s...' %
-                                 (name, thisitem['version'], catalogname))
-                            itemlist.append(thisitem)
-
-    if itemlist:
-        # sort so latest version is first
-        itemlist.sort(compare_item_versions)
+            catalogs_with_name += 1
+            # items are already ordered latest version first
+            indexlist = CATALOG[catalogname]['named'][name]['latest']
+            for index in indexlist:
+                thisitem = CATALOG[catalogname]['items'][index]
+                if not thisitem in itemlist:
+                    munkicommon.display_debug1(
+                        'Adding item %s, version %s from catalog %s...' %
+                        (name, thisitem['version'], catalogname))
+                    itemlist.append(thisitem)
+
+    if catalogs_with_name > 1:
+        # merge items from multiple catalogs so latest version is first
+        itemlist.sort(
+            key=lambda item: munkicommon.MunkiVersionKey(item['version']),
+            reverse=True)
     return itemlist
 
 
@@ -955,11 +1217,6 @@ def getItemDetail(name, cataloglist, vers=''):
     If no version is given at all, the latest version is assumed.
     Returns a pkginfo item.
     """
-    def compare_version_keys(a, b):
-        """Internal comparison function for use in sorting"""
-        return cmp(munkicommon.MunkiLooseVersion(b),
-                   munkicommon.MunkiLooseVersion(a))
-
     if vers == 'apple_update_metadata':
         vers = 'latest'
     else:
@@ -984,15 +1241,9 @@ def getItemDetail(name, cataloglist, vers=''):
         if name in CATALOG[catalogname]['named']:
             itemsmatchingname = CATALOG[catalogname]['named'][name]
             indexlist = []
-            if vers == 'latest':
-                # order all our items, latest first
-                versionlist = itemsmatchingname.keys()
-                versionlist.sort(compare_version_keys)
-                for versionkey in versionlist:
-                    indexlist.extend(itemsmatchingname[versionkey])
-
-            elif vers in itemsmatchingname:
-                # get the specific requested version
+            if vers in itemsmatchingname:
+                # get the specific requested version; 'latest' holds all
+                # our items, already ordered latest first by makeCatalogDB
                 indexlist = itemsmatchingname[vers]
 
             munkicommon.display_debug1(
@@ -1009,8 +1260,8 @@ def getItemDetail(name, cataloglist, vers=''):
                         item['name'], item['version'], min_munki_vers)
                     munkicommon.display_debug1('Our Munki version is %s' %
                                                 MACHINE['munki_version'])
-                    if (munkicommon.MunkiLooseVersion(MACHINE['munki_version'])
-                        < munkicommon.MunkiLooseVersion(min_munki_vers)):
+                    if (munkicommon.MunkiVersionKey(MACHINE['munki_version'])
+                        < munkicommon.MunkiVersionKey(min_munki_vers)):
                         # skip this one, go to the next
                         reason = ('Rejected item %s, version %s '
                                   'with minimum Munki version required %s. '
@@ -1030,8 +1281,8 @@ def getItemDetail(name, cataloglist, vers=''):
                         item['name'], item['version'], min_os_vers)
                     munkicommon.display_debug1(
                         'Our OS version is %s', MACHINE['os_vers'])
-                    if (munkicommon.MunkiLooseVersion(MACHINE['os_vers']) <
-                       munkicommon.MunkiLooseVersion(min_os_vers)):
+                    if (munkicommon.MunkiVersionKey(MACHINE['os_vers']) <
+                       munkicommon.MunkiVersionKey(min_os_vers)):
                         # skip this one, go to the next
                         reason = (('Rejected item %s, version %s '
                                   'with minimum os version required %s. '
@@ -1050,8 +1301,8 @@ def getItemDetail(name, cataloglist, vers=''):
                         item['name'], item['version'], max_os_vers)
                     munkicommon.display_debug1(
                         'Our OS version is %s', MACHINE['os_vers'])
-                    if (munkicommon.MunkiLooseVersion(MACHINE['os_vers']) >
-                        munkicommon.MunkiLooseVersion(max_os_vers)):
+                    if (munkicommon.MunkiVersionKey(MACHINE['os_vers']) >
+                        munkicommon.MunkiVersionKey(max_os_vers)):
                         # skip this one, go to the next
                         reason = (('Rejected item %s, version %s '
                                   'with maximum os version required %s. '
@@ -1136,8 +1387,13 @@ def enoughDiskSpace(manifestitem_pl, installlist=None,
         download = getDownloadCachePath(
             cachedir,
             manifestitem_pl['installer_item_location'])
+        storepath = getContentStorePath(
+            cachedir, manifestitem_pl.get('installer_item_hash', ''))
         if os.path.exists(download):
             alreadydownloadedsize = os.path.getsize(download)
+        elif (manifestitem_pl.get('installer_item_hash')
+              and os.path.exists(storepath)):
+            alreadydownloadedsize = os.path.getsize(storepath)
     if 'installer_item_size' in manifestitem_pl:
         installeritemsize = int(manifestitem_pl['installer_item_size'])
     if 'installed_size' in manifestitem_pl:
@@ -1161,6 +1417,15 @@ def enoughDiskSpace(manifestitem_pl, installlist=None,
                 availablediskspace = availablediskspace - \
                                      int(item.get('installed_size', 0))
 
+    if availablediskspace <= diskspaceneeded:
+        # make room by removing unused items from the download cache, but
+        # only as many as we need to, so later runs can still reuse the rest
+        cachedir = os.path.join(munkicommon.pref('ManagedInstallDir'), 'Cache')
+        freed = evictFromContentStore(
+            cachedir, 0,
+            bytes_needed=(diskspaceneeded - availablediskspace + 1) * 1024)
+        availablediskspace += freed / 1024
+
     if availablediskspace > diskspaceneeded:
         return True
     elif warn:
@@ -1424,11 +1689,7 @@ def lookForUpdates(itemname, cataloglist):
             # in case the list refers to a non-existant catalog
             continue
 
-        updaters = CATALOG[catalogname]['updaters']
-        # list comprehension coming up...
-        update_items = [catalogitem['name']
-                        for catalogitem in updaters
-                        if (itemname in catalogitem.get('update_for', []))]
+        update_items = CATALOG[catalogname]['update_for'].get(itemname)
         if update_items:
             update_list.extend(update_items)
 
@@ -1784,24 +2045,19 @@ def processInstall(manifestitem, cataloglist, installinfo):
                 # Packageless install
                 download_speed = 0
                 filename = 'packageless_install'
+            elif DOWNLOAD_QUEUE is not None:
+                # download it later, along with everything else we need,
+                # once we know the whole install plan
+                queueDownload(item_pl, iteminfo, installinfo, manifestitem)
+                download_speed = 0
+                filename = getInstallerItemBasename(
+                    item_pl['installer_item_location'])
             else:
                 if download_installeritem(item_pl, installinfo):
                     # Record the download speed to the InstallResults output.
-                    end = datetime.datetime.now()
-                    download_seconds = (end - start).seconds
-                    try:
-                        if iteminfo['installer_item_size'] < 1024:
-                            # ignore downloads under 1 MB or speeds will
-                            # be skewed.
-                            download_speed = 0
-                        else:
-                            # installer_item_size is KBytes, so divide
-                            # by seconds.
-                            download_speed = int(
-                                iteminfo['installer_item_size'] /
-                                download_seconds)
-                    except (TypeError, ValueError, ZeroDivisionError):
-                        download_speed = 0
+                    download_speed = getDownloadSpeed(
+                        iteminfo['installer_item_size'],
+                        datetime.datetime.now() - start)
                 else:
                     # Item was already in cache; set download_speed to 0.
                     download_speed = 0
@@ -2420,54 +2676,341 @@ def getManifestValueForKey(manifestpath, keyname):
         return None
 
 
+# bump this whenever the tables built by makeCatalogDB change so that
+# previously saved catalog indexes are discarded
+CATALOG_INDEX_VERSION = 3
+
+def getCatalogIndexPath(catalogpath):
+    """Returns the path of the compiled index stored next to a catalog"""
+    catalog_dir, catalogname = os.path.split(catalogpath)
+    return os.path.join(catalog_dir, '.%s.index' % catalogname)
+
+
+def getCatalogChecksum(catalogpath):
+    """Returns a string identifying the current contents of a downloaded
+    catalog: its ETag if we got one from the server, otherwise its
+    sha256 hash (cached in an xattr so we compute it only once per
+    download)."""
+    try:
+        etag = fetch.getxattr(catalogpath, fetch.XATTR_ETAG)
+        if etag:
+            return 'etag:' + etag
+        fhash = (fetch.getxattr(catalogpath, fetch.XATTR_SHA) or
+                 fetch.writeCachedChecksum(catalogpath))
+    except (OSError, IOError):
+        return None
+    if fhash:
+        return 'sha256:' + fhash
+    return None
+
+
+def loadCatalogIndex(indexpath, checksum):
+    """Loads a compiled catalog index written by saveCatalogIndex.
+    Returns a pkgdb like the one built by makeCatalogDB, or None if the
+    index is missing, stale or unreadable."""
+    if not checksum or not os.path.exists(indexpath):
+        return None
+    try:
+        index = FoundationPlist.readPlist(indexpath, mapped=True)
+    except FoundationPlist.FoundationPlistException:
+        return None
+    try:
+        if (index.get('index_version') != CATALOG_INDEX_VERSION or
+                index.get('catalog_checksum') != checksum):
+            return None
+        pkgdb = {}
+        pkgdb['named'] = index['named']
+        pkgdb['receipts'] = index['receipts']
+        pkgdb['update_for'] = index['update_for']
+        pkgdb['autoremoveitems'] = index['autoremoveitems']
+        pkgdb['items'] = index['items']
+    except (AttributeError, KeyError):
+        return None
+    # update_for values were already normalized to lists before the
+    # index was saved
+    pkgdb['updaters'] = [item for item in pkgdb['items']
+                         if item.get('update_for')]
+    return pkgdb
+
+
+def saveCatalogIndex(indexpath, checksum, pkgdb):
+    """Saves the tables built by makeCatalogDB as a binary plist so the
+    next run can skip parsing and indexing an unchanged catalog."""
+    if not checksum:
+        return
+    index = {}
+    index['index_version'] = CATALOG_INDEX_VERSION
+    index['catalog_checksum'] = checksum
+    index['named'] = pkgdb['named']
+    index['receipts'] = pkgdb['receipts']
+    index['update_for'] = pkgdb['update_for']
+    index['autoremoveitems'] = pkgdb['autoremoveitems']
+    index['items'] = pkgdb['items']
+    try:
+        FoundationPlist.writePlist(index, indexpath, binary=True)
+    except FoundationPlist.FoundationPlistException, err:
+        munkicommon.display_debug1(
+            'Could not save catalog index %s: %s', indexpath, err)
+        try:
+            os.unlink(indexpath)
+        except (OSError, IOError):
+            pass
+
+
 # global to hold our catalog DBs
 CATALOG = {}
-def getCatalogs(cataloglist):
-    """Retrieves the catalogs from the server and populates our catalogs
-    dictionary.
-    """
-    #global CATALOG
+# catalogs downloaded but not yet loaded into CATALOG; values are None or
+# the MunkiDownloadError raised by the download
+CATALOG_DOWNLOADS = {}
+
+# the sha256 hash of the repo's catalog file our cached catalog matches,
+# for catalog deltas
+XATTR_CATALOG_VERSION = 'com.googlecode.munki.catalogversion'
+# how many deltas we'll apply before giving up and fetching the catalog
+MAX_CATALOG_DELTAS = 20
+# set once the server turns out to have no catalog deltas, so we stop
+# asking for them this run
+CATALOG_DELTAS_MISSING = False
+
+def updateCatalogFromDeltas(catalogname, catalogpath, catalogbaseurl):
+    """Tries to bring our cached copy of a catalog up to date by applying
+    the deltas makecatalogs writes to catalogs/.deltas/<catalog>/ in the
+    repo. Returns True if the cached catalog is now current; False if we
+    need to fetch the whole catalog."""
+    global CATALOG_DELTAS_MISSING
+    version = fetch.getxattr(catalogpath, XATTR_CATALOG_VERSION)
+    if (not version or catalogbaseurl.endswith('?')
+            or CATALOG_DELTAS_MISSING):
+        return False
+    deltaurl = '%s.deltas/%s/' % (catalogbaseurl, urllib2.quote(catalogname))
+    tempdir = tempfile.mkdtemp(dir=munkicommon.tmpdir)
+
+    def getDeltaPlist(name):
+        """Downloads and reads a plist from the catalog's delta dir"""
+        destinationpath = os.path.join(tempdir, name)
+        getResourceIfChangedAtomically(deltaurl + name, destinationpath)
+        return FoundationPlist.readPlist(destinationpath)
+
+    try:
+        try:
+            current = getDeltaPlist('current.plist').get('sha256')
+        except fetch.MunkiDownloadError, err:
+            if 'error: 404' in str(err):
+                if not CATALOG_DELTAS_MISSING:
+                    CATALOG_DELTAS_MISSING = True
+                    munkicommon.display_info(
+                        'Server has no catalog deltas; getting whole '
+                        'catalogs instead')
+                return False
+            raise
+        if current == version:
+            munkicommon.display_debug1(
+                'Catalog %s is up to date', catalogname)
+            return True
+        catalog = FoundationPlist.readPlist(catalogpath)
+        for unused_count in range(MAX_CATALOG_DELTAS):
+            delta = getDeltaPlist(version + '.plist')
+            if delta.get('base') != version:
+                return False
+            newcatalog = []
+            for entry in delta.get('entries', []):
+                if isinstance(entry, (int, long)):
+                    # an unchanged item from the previous version
+                    newcatalog.append(catalog[entry])
+                else:
+                    newcatalog.append(entry)
+            catalog = newcatalog
+            version = delta.get('sha256')
+            if version == current:
+                break
+        else:
+            return False
+        # write it next to the cached catalog, then replace it; the new
+        # file has none of the old ETag and hash attributes
+        temppath = catalogpath + '.delta'
+        FoundationPlist.writePlist(catalog, temppath)
+        # we don't know when the server's copy was modified, so clear the
+        # modification date; if we ever need to fetch this catalog whole,
+        # an If-Modified-Since request then can't wrongly get a 304
+        os.utime(temppath, (time.time(), 0))
+        os.rename(temppath, catalogpath)
+        xattr.setxattr(catalogpath, XATTR_CATALOG_VERSION, version)
+        munkicommon.display_detail(
+            'Updated catalog %s from catalog deltas', catalogname)
+        return True
+    except (fetch.MunkiDownloadError, IndexError, TypeError,
+            FoundationPlist.FoundationPlistException), err:
+        munkicommon.display_debug1(
+            'Could not update catalog %s from deltas: %s', catalogname, err)
+        return False
+    finally:
+        for item in os.listdir(tempdir):
+            os.unlink(os.path.join(tempdir, item))
+        os.rmdir(tempdir)
+
+
+def downloadCatalog(catalogname):
+    """Downloads a single catalog from the server to our catalogs dir.
+    Raises fetch.MunkiDownloadError on failure."""
     catalogbaseurl = munkicommon.pref('CatalogURL') or \
                      munkicommon.pref('SoftwareRepoURL') + '/catalogs/'
     if not catalogbaseurl.endswith('?') and not catalogbaseurl.endswith('/'):
         catalogbaseurl = catalogbaseurl + '/'
     munkicommon.display_debug2('Catalog base URL is: %s', catalogbaseurl)
+    catalog_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
+                               'catalogs')
+    catalogurl = catalogbaseurl + urllib2.quote(catalogname)
+    catalogpath = os.path.join(catalog_dir, catalogname)
+    munkicommon.display_detail('Getting catalog %s...', catalogname)
+    if (munkicommon.pref('UseCatalogDeltas')
+            and os.path.exists(catalogpath)):
+        if updateCatalogFromDeltas(catalogname, catalogpath, catalogbaseurl):
+            return True
+    message = 'Retrieving catalog "%s"...' % catalogname
+    changed = getResourceIfChangedAtomically(
+        catalogurl, catalogpath, message=message,
+        compressed=munkicommon.pref('UseCompressedTransfers'))
+    if (munkicommon.pref('UseCatalogDeltas')
+            and (changed or not fetch.getxattr(catalogpath,
+                                               XATTR_CATALOG_VERSION))):
+        # remember which version of the catalog this is so we can apply
+        # deltas to it next time
+        checksum = (fetch.getxattr(catalogpath, fetch.XATTR_SHA)
+                    or fetch.writeCachedChecksum(catalogpath))
+        if checksum:
+            xattr.setxattr(catalogpath, XATTR_CATALOG_VERSION, checksum)
+    return changed
+
+
+def downloadCatalogs(cataloglist):
+    """Downloads the catalogs in cataloglist we haven't already downloaded
+    this run, several at a time. Results are left in CATALOG_DOWNLOADS
+    for getCatalogs."""
+    catalognames = []
+    for catalogname in cataloglist:
+        if (not catalogname in CATALOG
+                and not catalogname in CATALOG_DOWNLOADS
+                and not catalogname in catalognames):
+            catalognames.append(catalogname)
+    results = utils.runConcurrently(
+        downloadCatalog, catalognames,
+        max_workers=munkicommon.pref('MaxConcurrentFetches'))
+    for catalogname, (unused_value, err) in zip(catalognames, results):
+        if err and not isinstance(err, fetch.MunkiDownloadError):
+            raise err
+        CATALOG_DOWNLOADS[catalogname] = err
+
+
+def getCatalogs(cataloglist):
+    """Retrieves the catalogs from the server and populates our catalogs
+    dictionary.
+    """
+    #global CATALOG
     catalog_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
                                'catalogs')
 
+    # fetch them all at once, then load them in order
+    downloadCatalogs(cataloglist)
     for catalogname in cataloglist:
-        if not catalogname in CATALOG:
-            catalogurl = catalogbaseurl + urllib2.quote(catalogname)
-            catalogpath = os.path.join(catalog_dir, catalogname)
-            munkicommon.display_detail('Getting catalog %s...', catalogname)
-            message = 'Retrieving catalog "%s"...' % catalogname
+        if catalogname in CATALOG or not catalogname in CATALOG_DOWNLOADS:
+            continue
+        err = CATALOG_DOWNLOADS.pop(catalogname)
+        if err:
+            munkicommon.display_error(
+                'Could not retrieve catalog %s from server: %s',
+                catalogname, err)
+            continue
+        catalogpath = os.path.join(catalog_dir, catalogname)
+        checksum = getCatalogChecksum(catalogpath)
+        indexpath = getCatalogIndexPath(catalogpath)
+        pkgdb = loadCatalogIndex(indexpath, checksum)
+        if pkgdb:
+            munkicommon.display_debug1(
+                'Using cached index for catalog %s', catalogname)
+            CATALOG[catalogname] = pkgdb
+            continue
+        try:
+            catalogdata = FoundationPlist.readPlist(catalogpath)
+        except FoundationPlist.NSPropertyListSerializationException:
+            munkicommon.display_error(
+                'Retreived catalog %s is invalid.', catalogname)
             try:
-                unused_value = getResourceIfChangedAtomically(
-                    catalogurl, catalogpath, message=message)
-            except fetch.MunkiDownloadError, err:
-                munkicommon.display_error(
-                    'Could not retrieve catalog %s from server: %s',
-                    catalogname, err)
-            else:
-                try:
-                    catalogdata = FoundationPlist.readPlist(catalogpath)
-                except FoundationPlist.NSPropertyListSerializationException:
-                    munkicommon.display_error(
-                        'Retreived catalog %s is invalid.', catalogname)
-                    try:
-                        os.unlink(catalogpath)
-                    except (OSError, IOError):
-                        pass
-                else:
-                    CATALOG[catalogname] = makeCatalogDB(catalogdata)
+                os.unlink(catalogpath)
+            except (OSError, IOError):
+                pass
+        else:
+            CATALOG[catalogname] = makeCatalogDB(catalogdata)
+            saveCatalogIndex(indexpath, checksum, CATALOG[catalogname])
+
+
+def prefetchManifestTree(manifestpath):
+    """Downloads the catalogs and included manifests referenced by a
+    manifest and everything it includes, several at a time, so that
+    processManifestForKey finds them already in the MANIFESTS cache and
+    CATALOG_DOWNLOADS instead of fetching them one by one.
+
+    Manifests included only by conditional_items are left for
+    processManifestForKey, since we don't know yet if they apply."""
+    def fetchItem(item):
+        """Fetches a single catalog or manifest."""
+        kind, name = item
+        if kind == 'catalog':
+            return downloadCatalog(name)
+        # errors will be reported when the manifest is processed
+        return getmanifest(name, suppress_errors=True)
+
+    manifestpaths = [manifestpath]
+    seen_manifests = set()
+    while manifestpaths and not munkicommon.stopRequested():
+        catalognames = []
+        includednames = []
+        for path in manifestpaths:
+            manifestdata = getManifestData(path)
+            try:
+                catalognames.extend(manifestdata.get('catalogs') or [])
+                includednames.extend(
+                    manifestdata.get('included_manifests') or [])
+            except AttributeError:
+                continue
+
+        fetchlist = []
+        for catalogname in catalognames:
+            item = ('catalog', catalogname)
+            if (not catalogname in CATALOG
+                    and not catalogname in CATALOG_DOWNLOADS
+                    and not item in fetchlist):
+                fetchlist.append(item)
+        for name in includednames:
+            # MANIFESTS is keyed by basename
+            basename = os.path.split(name)[1]
+            if basename in seen_manifests or basename in MANIFESTS:
+                continue
+            seen_manifests.add(basename)
+            fetchlist.append(('manifest', name))
+
+        results = utils.runConcurrently(
+            fetchItem, fetchlist,
+            max_workers=munkicommon.pref('MaxConcurrentFetches'))
+        manifestpaths = []
+        for (kind, name), (value, err) in zip(fetchlist, results):
+            if kind == 'catalog':
+                if err and not isinstance(err, fetch.MunkiDownloadError):
+                    raise err
+                CATALOG_DOWNLOADS[name] = err
+            elif err and not isinstance(err, ManifestException):
+                raise err
+            elif value:
+                manifestpaths.append(value)
 
 
 def cleanUpCatalogs():
     """Removes any catalog files that are no longer in use by this client"""
     catalog_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
                                'catalogs')
+    index_files = [os.path.basename(getCatalogIndexPath(name))
+                   for name in CATALOG.keys()]
     for item in os.listdir(catalog_dir):
-        if item not in CATALOG.keys():
+        if item not in CATALOG.keys() and item not in index_files:
             os.unlink(os.path.join(catalog_dir, item))
 
 
@@ -2514,7 +3057,8 @@ def getmanifest(partialurl, suppress_errors=False):
     message = 'Retrieving list of software for this machine...'
     try:
         unused_value = getResourceIfChangedAtomically(
-            manifesturl, manifestpath, message=message)
+            manifesturl, manifestpath, message=message,
+            compressed=munkicommon.pref('UseCompressedTransfers'))
     except fetch.MunkiDownloadError, err:
         if not suppress_errors:
             munkicommon.display_error(
@@ -2705,6 +3249,155 @@ def getDownloadCachePath(destinationpathprefix, url):
         destinationpathprefix, getInstallerItemBasename(url))
 
 
+# Downloaded installer items are also kept in a content store inside the
+# Cache directory, named by their sha256 hash. Items in the Cache directory
+# are hard links to files in the store, so identical items downloaded under
+# different names or versions share one copy, and a stored file with a link
+# count of 1 isn't used by any item in the Cache directory.
+CONTENT_STORE_DIRNAME = '.store'
+# list of the hashes in the store, for peers to check
+CONTENT_STORE_INDEX = 'index.txt'
+XATTR_LASTUSED = 'com.googlecode.munki.lastused'
+
+def getContentStorePath(cachedir, item_hash):
+    """Returns the path in the content store for item_hash"""
+    return os.path.join(cachedir, CONTENT_STORE_DIRNAME, item_hash)
+
+
+def touchContentStoreItem(storepath):
+    """Records when a stored file was last used, for eviction. We don't
+    use the modification date since that's the date from the server."""
+    try:
+        xattr.setxattr(storepath, XATTR_LASTUSED, str(time.time()))
+    except (IOError, OSError):
+        pass
+
+
+def linkFromContentStore(cachedir, item_hash, destinationpath):
+    """If the content store has a file with item_hash, links it to
+    destinationpath. Returns True if it did."""
+    storepath = getContentStorePath(cachedir, item_hash)
+    if not os.path.isfile(storepath):
+        return False
+    stored_hash = (fetch.getxattr(storepath, fetch.XATTR_SHA)
+                   or fetch.writeCachedChecksum(storepath))
+    if stored_hash != item_hash:
+        munkicommon.display_warning(
+            'Removing damaged item %s from the download cache', storepath)
+        os.unlink(storepath)
+        return False
+    try:
+        if os.path.lexists(destinationpath):
+            os.unlink(destinationpath)
+        os.link(storepath, destinationpath)
+    except OSError, err:
+        munkicommon.display_debug1(
+            'Could not link %s to %s: %s', storepath, destinationpath, err)
+        return False
+    touchContentStoreItem(storepath)
+    return True
+
+
+def addToContentStore(cachedir, item_hash, path):
+    """Adds the downloaded file at path to the content store, if its
+    cached hash matches item_hash."""
+    if fetch.getxattr(path, fetch.XATTR_SHA) != item_hash:
+        return
+    storepath = getContentStorePath(cachedir, item_hash)
+    try:
+        if os.path.exists(storepath):
+            if os.path.samefile(storepath, path):
+                touchContentStoreItem(storepath)
+                return
+        else:
+            storedir = os.path.dirname(storepath)
+            if not os.path.isdir(storedir):
+                os.mkdir(storedir, 0755)
+        # link under a temporary name first so the store never has a
+        # partial file under a hash name
+        temppath = '%s.%s.tmp' % (storepath, os.getpid())
+        if os.path.lexists(temppath):
+            os.unlink(temppath)
+        os.link(path, temppath)
+        os.rename(temppath, storepath)
+    except OSError, err:
+        munkicommon.display_debug1(
+            'Could not add %s to the download cache: %s', path, err)
+        return
+    touchContentStoreItem(storepath)
+
+
+def evictFromContentStore(cachedir, size_limit, bytes_needed=None):
+    """Removes stored files no item in the Cache directory links to, least
+    recently used first, until they take up no more than size_limit bytes,
+    or, if bytes_needed is given, until that many bytes have been freed.
+    Returns the number of bytes freed."""
+    storedir = os.path.join(cachedir, CONTENT_STORE_DIRNAME)
+    if not os.path.isdir(storedir):
+        return 0
+    unused = []
+    unused_size = 0
+    for item in munkicommon.listdir(storedir):
+        storepath = os.path.join(storedir, item)
+        try:
+            info = os.lstat(storepath)
+        except OSError:
+            continue
+        if item == CONTENT_STORE_INDEX:
+            continue
+        if item.endswith('.tmp'):
+            # left over from an interrupted addToContentStore
+            os.unlink(storepath)
+            continue
+        if info.st_nlink > 1:
+            # still used by an item in the Cache directory
+            continue
+        try:
+            lastused = float(fetch.getxattr(storepath, XATTR_LASTUSED))
+        except (TypeError, ValueError):
+            lastused = info.st_mtime
+        unused.append((lastused, info.st_size, storepath))
+        unused_size += info.st_size
+
+    freed = 0
+    for (unused_lastused, size, storepath) in sorted(unused):
+        if unused_size - freed <= size_limit:
+            break
+        if bytes_needed is not None and freed >= bytes_needed:
+            break
+        munkicommon.display_detail(
+            'Removing %s from download cache', os.path.basename(storepath))
+        os.unlink(storepath)
+        freed += size
+    return freed
+
+
+def writeContentStoreIndex(cachedir):
+    """Writes the list of hashes in the content store to a text file in
+    the store, one per line, so peers using this machine's store as their
+    PeerCacheURL can see what it has."""
+    storedir = os.path.join(cachedir, CONTENT_STORE_DIRNAME)
+    if not os.path.isdir(storedir):
+        return
+    hashes = sorted(item for item in munkicommon.listdir(storedir)
+                    if item != CONTENT_STORE_INDEX
+                    and not item.endswith('.tmp'))
+    indexpath = os.path.join(storedir, CONTENT_STORE_INDEX)
+    temppath = indexpath + '.tmp'
+    try:
+        fileobj = open(temppath, 'w')
+        try:
+            for item_hash in hashes:
+                fileobj.write(item_hash + '\n')
+        finally:
+            fileobj.close()
+        os.chmod(temppath, 0644)
+        os.rename(temppath, indexpath)
+    except (IOError, OSError), err:
+        munkicommon.display_warning(
+            'Could not write download cache index: %s', err)
+
+
 MACHINE = {}
 CONDITIONS = {}
 def check(client_id='', localmanifestpath=None):
@@ -2721,6 +3414,8 @@ def check(client_id='', localmanifestpath=None):
     munkicommon.getConditions()
     CONDITIONS = munkicommon.getConditions()
 
+    global DOWNLOAD_QUEUE
+
     ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
     if munkicommon.munkistatusoutput:
         munkistatus.activate()
@@ -2746,120 +3441,138 @@ def check(client_id='', localmanifestpath=None):
         installinfo['managed_installs'] = []
         installinfo['removals'] = []
 
-        # set up INFO_OBJECT for conditional item comparisons
-        makePredicateInfoObject()
-        munkicommon.report['Conditions'] = INFO_OBJECT
+        # queue installer item downloads until we know everything we need.
+        # the queue must go away however we leave here, or later installs
+        # would be queued and never downloaded
+        DOWNLOAD_QUEUE = []
+        try:
+            # set up INFO_OBJECT for conditional item comparisons
+            makePredicateInfoObject()
+            munkicommon.report['Conditions'] = INFO_OBJECT
 
-        munkicommon.display_detail('**Checking for installs**')
-        processManifestForKey(mainmanifestpath, 'managed_installs',
-                              installinfo)
-        if munkicommon.stopRequested():
-            return 0
+            # get all the catalogs and included manifests we'll need at once
+            prefetchManifestTree(mainmanifestpath)
 
-        if munkicommon.munkistatusoutput:
-            # reset progress indicator and detail field
-            munkistatus.message('Checking for additional changes...')
-            munkistatus.percent('-1')
-            munkistatus.detail('')
+            munkicommon.display_detail('**Checking for installs**')
+            processManifestForKey(mainmanifestpath, 'managed_installs',
+                                  installinfo)
+            if munkicommon.stopRequested():
+                return 0
 
-        # now generate a list of items to be uninstalled
-        munkicommon.display_detail('**Checking for removals**')
-        processManifestForKey(mainmanifestpath, 'managed_uninstalls',
-                              installinfo)
-        if munkicommon.stopRequested():
-            return 0
+            if munkicommon.munkistatusoutput:
+                # reset progress indicator and detail field
+                munkistatus.message('Checking for additional changes...')
+                munkistatus.percent('-1')
+                munkistatus.detail('')
 
-        # now check for implicit removals
-        # use catalogs from main manifest
-        cataloglist = getManifestValueForKey(mainmanifestpath, 'catalogs')
-        autoremovalitems = getAutoRemovalItems(installinfo, cataloglist)
-        if autoremovalitems:
-            munkicommon.display_detail('**Checking for implicit removals**')
-        for item in autoremovalitems:
+            # now generate a list of items to be uninstalled
+            munkicommon.display_detail('**Checking for removals**')
+            processManifestForKey(mainmanifestpath, 'managed_uninstalls',
+                                  installinfo)
             if munkicommon.stopRequested():
                 return 0
-            unused_result = processRemoval(item, cataloglist, installinfo)
 
-        # look for additional updates
-        munkicommon.display_detail('**Checking for managed updates**')
-        processManifestForKey(mainmanifestpath, 'managed_updates',
-                              installinfo)
-        if munkicommon.stopRequested():
-            return 0
+            # now check for implicit removals
+            # use catalogs from main manifest
+            cataloglist = getManifestValueForKey(mainmanifestpath, 'catalogs')
+            autoremovalitems = getAutoRemovalItems(installinfo, cataloglist)
+            if autoremovalitems:
+                munkicommon.display_detail(
+                    '**Checking for implicit removals**')
+            for item in autoremovalitems:
+                if munkicommon.stopRequested():
+                    return 0
+                unused_result = processRemoval(item, cataloglist, installinfo)
 
-        # build list of optional installs
-        processManifestForKey(mainmanifestpath, 'optional_installs',
-                              installinfo)
-        if munkicommon.stopRequested():
-            return 0
+            # look for additional updates
+            munkicommon.display_detail('**Checking for managed updates**')
+            processManifestForKey(mainmanifestpath, 'managed_updates',
+                                  installinfo)
+            if munkicommon.stopRequested():
+                return 0
 
-        # verify available license seats for optional installs
-        if installinfo.get('optional_installs'):
-            updateAvailableLicenseSeats(installinfo)
-
-        # now process any self-serve choices
-        usermanifest = '/Users/Shared/.SelfServeManifest'
-        selfservemanifest = os.path.join(ManagedInstallDir, 'manifests',
-                                                'SelfServeManifest')
-        if os.path.exists(usermanifest):
-            # copy user-generated SelfServeManifest to our
-            # ManagedInstallDir
-            try:
-                plist = FoundationPlist.readPlist(usermanifest)
-                if plist:
-                    FoundationPlist.writePlist(plist, selfservemanifest)
-                    # now remove the user-generated manifest
+            # build list of optional installs
+            processManifestForKey(mainmanifestpath, 'optional_installs',
+                                  installinfo)
+            if munkicommon.stopRequested():
+                return 0
+
+            # verify available license seats for optional installs
+            if installinfo.get('optional_installs'):
+                updateAvailableLicenseSeats(installinfo)
+
+            # now process any self-serve choices
+            usermanifest = '/Users/Shared/.SelfServeManifest'
+            selfservemanifest = os.path.join(ManagedInstallDir, 'manifests',
+                                                    'SelfServeManifest')
+            if os.path.exists(usermanifest):
+                # copy user-generated SelfServeManifest to our
+                # ManagedInstallDir
+                try:
+                    plist = FoundationPlist.readPlist(usermanifest)
+                    if plist:
+                        FoundationPlist.writePlist(plist, selfservemanifest)
+                        # now remove the user-generated manifest
+                        try:
+                            os.unlink(usermanifest)
+                        except OSError:
+                            pass
+                except FoundationPlist.FoundationPlistException:
+                    # problem reading the usermanifest
+                    # better remove it
+                    munkicommon.display_error(
+                        'Could not read %s', usermanifest)
                     try:
                         os.unlink(usermanifest)
                     except OSError:
                         pass
-            except FoundationPlist.FoundationPlistException:
-                # problem reading the usermanifest
-                # better remove it
-                munkicommon.display_error('Could not read %s', usermanifest)
-                try:
-                    os.unlink(usermanifest)
-                except OSError:
-                    pass
 
-        if os.path.exists(selfservemanifest):
-            # use catalogs from main manifest for self-serve manifest
-            cataloglist = getManifestValueForKey(
-                                            mainmanifestpath, 'catalogs')
-            munkicommon.display_detail(
-                '**Processing self-serve choices**')
-            selfserveinstalls = getManifestValueForKey(selfservemanifest,
-                                                       'managed_installs')
-
-            # build list of items in the optional_installs list
-            # that have not exceeded available seats
-            available_optional_installs = [item['name']
-                for item in installinfo.get('optional_installs', [])
-                if (not 'licensed_seats_available' in item
-                    or item['licensed_seats_available'])]
-            if selfserveinstalls:
-                # filter the list, removing any items not in the current list
-                # of available self-serve installs
-                selfserveinstalls = [item for item in selfserveinstalls
-                                     if item in available_optional_installs]
-                for item in selfserveinstalls:
-                    unused_result = processInstall(
-                        item, cataloglist, installinfo)
-
-            # we don't need to filter uninstalls
-            processManifestForKey(selfservemanifest, 'managed_uninstalls',
-                                  installinfo, cataloglist)
-
-            # update optional_installs with install/removal info
-            for item in installinfo['optional_installs']:
-                if (not item.get('installed') and
-                    isItemInInstallInfo(item,
-                                        installinfo['managed_installs'])):
-                    item['will_be_installed'] = True
-                elif (item.get('installed') and
-                      isItemInInstallInfo(item,
-                                          installinfo['removals'])):
-                    item['will_be_removed'] = True
+            if os.path.exists(selfservemanifest):
+                # use catalogs from main manifest for self-serve manifest
+                cataloglist = getManifestValueForKey(
+                                                mainmanifestpath, 'catalogs')
+                munkicommon.display_detail(
+                    '**Processing self-serve choices**')
+                selfserveinstalls = getManifestValueForKey(selfservemanifest,
+                                                           'managed_installs')
+
+                # build list of items in the optional_installs list
+                # that have not exceeded available seats
+                available_optional_installs = [item['name']
+                    for item in installinfo.get('optional_installs', [])
+                    if (not 'licensed_seats_available' in item
+                        or item['licensed_seats_available'])]
+                if selfserveinstalls:
+                    # filter the list, removing any items not in the current
+                    # list of available self-serve installs
+                    selfserveinstalls = [
+                        item for item in selfserveinstalls
+                        if item in available_optional_installs]
+                    for item in selfserveinstalls:
+                        unused_result = processInstall(
+                            item, cataloglist, installinfo)
+
+                # we don't need to filter uninstalls
+                processManifestForKey(selfservemanifest, 'managed_uninstalls',
+                                      installinfo, cataloglist)
+
+                # update optional_installs with install/removal info
+                for item in installinfo['optional_installs']:
+                    if (not item.get('installed') and
+                        isItemInInstallInfo(item,
+                                            installinfo['managed_installs'])):
+                        item['will_be_installed'] = True
+                    elif (item.get('installed') and
+                          isItemInInstallInfo(item,
+                                              installinfo['removals'])):
+                        item['will_be_removed'] = True
+
+            # now download everything we need to install
+            downloadQueuedItems(installinfo)
+        finally:
+            DOWNLOAD_QUEUE = None
+        if munkicommon.stopRequested():
+            return 0
 
         # filter managed_installs to get items already installed
         installed_items = [item.get('name','')
@@ -2931,7 +3644,8 @@ def check(client_id='', localmanifestpath=None):
         # this could happen if an item is downloaded on one
         # updatecheck run, but later removed from the manifest
         # before it is installed or removed - so the cached item
-        # is no longer needed.
+        # is no longer needed. Its content stays in the content store
+        # until evicted, in case another item or version needs it.
         cache_list = [item['installer_item']
                       for item in installinfo.get('managed_installs', [])]
         cache_list.extend([item['uninstaller_item']
@@ -2939,7 +3653,9 @@ def check(client_id='', localmanifestpath=None):
                            if item.get('uninstaller_item')])
         cachedir = os.path.join(ManagedInstallDir, 'Cache')
         for item in munkicommon.listdir(cachedir):
-            if item.endswith('.download'):
+            if item == CONTENT_STORE_DIRNAME:
+                continue
+            elif item.endswith('.download'):
                 # we have a partial download here
                 # remove the '.download' from the end of the filename
                 fullitem = os.path.splitext(item)[0]
@@ -2959,6 +3675,12 @@ def check(client_id='', localmanifestpath=None):
             elif item not in cache_list:
                 munkicommon.display_detail('Removing %s from cache', item)
                 os.unlink(os.path.join(cachedir, item))
+        # DownloadCacheSizeLimit is in MB
+        evictFromContentStore(
+            cachedir,
+            (munkicommon.pref('DownloadCacheSizeLimit') or 0) * 1024 * 1024)
+        if munkicommon.pref('PeerCacheAdvertise'):
+            writeContentStoreIndex(cachedir)
 
         # write out install list so our installer
         # can use it to install things in the right order
@@ -3200,7 +3922,10 @@ def getResourceIfChangedAtomically(url,
                                   message=None,
                                   resume=False,
                                   expected_hash=None,
-                                  verify=False):
+                                  verify=False,
+                                  rate_limit=None,
+                                  windowed=False,
+                                  compressed=False):
 
     '''Gets a given URL from the Munki server. Sets up cert/CA info if it
     exists, and adds any additional headers'''
@@ -3258,7 +3983,10 @@ def getResourceIfChangedAtomically(url,
                                                 expected_hash=expected_hash,
                                                 message=message,
                                                 resume=resume,
-                                                verify=verify)
+                                                verify=verify,
+                                                rate_limit=rate_limit,
+                                                windowed=windowed,
+                                                compressed=compressed)
 
 
 def getPrimaryManifestCatalogs(client_id='', force_refresh=False):
@@ -27,8 +27,10 @@ Note: this module should be 100% free of ObjC-dependant Python imports.
 
 import grp
 import os
+import Queue
 import subprocess
 import stat
+import threading
 
 
 class Error(Exception):
@@ -156,3 +158,139 @@ def getPIDforProcessName(processname):
                     return str(pid)
 
     return 0
+
+
+def runConcurrently(function, items, max_workers=4):
+    """Call function(item) for each item in items, using up to max_workers
+    threads at a time.
+
+    Args:
+      function: callable taking a single argument.
+      items: list of arguments to call function with.
+      max_workers: int maximum number of concurrent calls.
+    Returns:
+      List of (result, exception) tuples in the same order as items.
+      exception is None if the call returned normally; otherwise result is
+      None and exception is the exception the call raised.
+    """
+    results = [(None, None)] * len(items)
+    work_queue = Queue.Queue()
+    for index, item in enumerate(items):
+        work_queue.put((index, item))
+
+    def worker():
+        """Process items from the work queue until it's empty."""
+        while True:
+            try:
+                index, item = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (function(item), None)
+            except Exception, e:
+                results[index] = (None, e)
+
+    worker_count = min(max(max_workers, 1), len(items))
+    if worker_count < 2:
+        # nothing to gain from threads
+        worker()
+        return results
+
+    threads = [threading.Thread(target=worker) for unused_i in
+               range(worker_count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def iterConcurrently(function, items, max_workers=4, max_pending=None):
+    """Call function(item) for each item in items, using up to max_workers
+    threads at a time, and yield the results in order as they are ready.
+
+    Unlike runConcurrently, results don't have to wait for all the calls to
+    finish. No more than max_pending calls (default: twice max_workers) are
+    running or waiting to be collected at a time, so results don't pile up
+    when the caller is slower than the calls. If the caller stops early,
+    calls that haven't started yet are skipped.
+
+    Args:
+      function: callable taking a single argument.
+      items: list of arguments to call function with.
+      max_workers: int maximum number of concurrent calls.
+      max_pending: int maximum number of results to work ahead.
+    Yields:
+      (result, exception) tuples in the same order as items, as for
+      runConcurrently.
+    """
+    items = list(items)
+    worker_count = min(max(max_workers, 1), len(items))
+    if worker_count < 2:
+        # nothing to gain from threads
+        for item in items:
+            try:
+                yield (function(item), None)
+            except Exception, e:
+                yield (None, e)
+        return
+
+    if not max_pending:
+        max_pending = 2 * worker_count
+    results = {}
+    condition = threading.Condition()
+    # next: the index of the next item to start on
+    # collected: how many results the caller has taken
+    state = {'next': 0, 'collected': 0, 'stop': False}
+
+    def worker():
+        """Process items until there are none left or we're told to stop."""
+        while True:
+            condition.acquire()
+            try:
+                while (not state['stop'] and state['next'] < len(items) and
+                       state['next'] - state['collected'] >= max_pending):
+                    condition.wait()
+                if state['stop'] or state['next'] >= len(items):
+                    return
+                index = state['next']
+                state['next'] += 1
+            finally:
+                condition.release()
+            try:
+                result = (function(items[index]), None)
+            except Exception, e:
+                result = (None, e)
+            condition.acquire()
+            try:
+                results[index] = result
+                condition.notify_all()
+            finally:
+                condition.release()
+
+    threads = [threading.Thread(target=worker) for unused_i in
+               range(worker_count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for index in range(len(items)):
+            condition.acquire()
+            try:
+                while not index in results:
+                    # a timeout keeps us responsive to KeyboardInterrupt
+                    condition.wait(1)
+                result = results.pop(index)
+                state['collected'] = index + 1
+                condition.notify_all()
+            finally:
+                condition.release()
+            yield result
+    finally:
+        condition.acquire()
+        try:
+            state['stop'] = True
+            condition.notify_all()
+        finally:
+            condition.release()
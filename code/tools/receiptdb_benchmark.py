@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+receiptdb_benchmark.py
+
+Compares loading a synthetic set of receipts into removepackages' receipt
+database one path at a time, the way it used to, with the bulk load
+removepackages.initDatabase now does when it rebuilds the database, and
+checks that both end up with the same contents.
+
+Run from a Munki source checkout:
+    ./receiptdb_benchmark.py [--packages N] [--paths N]
+
+The defaults make 400 packages of 5000 paths each: 2 million paths.
+"""
+
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, 'client'))
+from munkilib import removepackages
+
+
+def makeReceipt(pkgindex, pathcount):
+    '''Returns a list of (path, uid, gid, perms) tuples for a made-up
+    package. Like real packages, they share a lot of directories.'''
+    random.seed(pkgindex)
+    paths = ['Library', 'Library/Application Support',
+             'Applications', 'usr', 'usr/local', 'usr/local/bin']
+    bundle = 'Applications/Example %s.app/Contents' % pkgindex
+    while len(paths) < pathcount:
+        if random.randint(0, 9) == 0:
+            # something other packages also install
+            paths.append('Library/Frameworks/Shared%s.framework/file%s'
+                         % (random.randint(0, 50), random.randint(0, 500)))
+        else:
+            paths.append('%s/Resources/%s/file%s.txt'
+                         % (bundle, random.randint(0, 99), len(paths)))
+    return [(path, '0', '80', '100644') for path in paths]
+
+
+def loadRowAtATime(dbpath, receipts):
+    '''Loads receipts the way removepackages used to: a lookup and two
+    inserts per path, with default settings'''
+    conn = sqlite3.connect(dbpath)
+    conn.text_factory = str
+    curs = conn.cursor()
+    removepackages.CreateTables(curs)
+    for pkgindex, pathinfo in enumerate(receipts):
+        curs.execute(
+            '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
+               values (?, ?, ?, ?, ?, ?)''',
+            (0, 0, 'com.example.pkg%s' % pkgindex, '1.0', '',
+             'pkg%s.pkg' % pkgindex))
+        pkgkey = curs.lastrowid
+        for (path, uid, gid, perms) in pathinfo:
+            row = curs.execute(
+                'SELECT path_key from paths where path = ?',
+                (path, )).fetchone()
+            if not row:
+                curs.execute('INSERT INTO paths (path) values (?)', (path, ))
+                pathkey = curs.lastrowid
+            else:
+                pathkey = row[0]
+            curs.execute(
+                '''INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms)
+                   values (?, ?, ?, ?, ?)''',
+                (pkgkey, pathkey, uid, gid, perms))
+    conn.commit()
+    curs.close()
+    conn.close()
+
+
+def loadInBulk(dbpath, receipts):
+    '''Loads receipts the way removepackages.initDatabase does now'''
+    conn = removepackages.createDatabase(dbpath)
+    curs = conn.cursor()
+    for pkgindex, pathinfo in enumerate(receipts):
+        curs.execute(
+            '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
+               values (?, ?, ?, ?, ?, ?)''',
+            (0, 0, 'com.example.pkg%s' % pkgindex, '1.0', '',
+             'pkg%s.pkg' % pkgindex))
+        removepackages.importPaths(curs, curs.lastrowid, pathinfo)
+    removepackages.CreateIndexes(curs)
+    conn.commit()
+    curs.close()
+    conn.close()
+
+
+def dbContents(dbpath):
+    '''Returns a sorted list of (pkgid, path) rows from a receipt db'''
+    conn = sqlite3.connect(dbpath)
+    rows = conn.execute(
+        '''SELECT pkgs.pkgid, paths.path FROM pkgs_paths
+           JOIN pkgs ON pkgs.pkg_key = pkgs_paths.pkg_key
+           JOIN paths ON paths.path_key = pkgs_paths.path_key''').fetchall()
+    conn.close()
+    rows.sort()
+    return rows
+
+
+def main():
+    '''Main'''
+    usage = '%prog [options]'
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('--packages', type='int', default=400,
+                 help='Number of packages. Default 400.')
+    p.add_option('--paths', type='int', default=5000,
+                 help='Number of paths per package. Default 5000.')
+    options, unused_arguments = p.parse_args()
+
+    receipts = [makeReceipt(pkgindex, options.paths)
+                for pkgindex in range(options.packages)]
+    print 'Loading %s packages, %s paths...' % (
+        options.packages, options.packages * options.paths)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        times = []
+        for name, function in [('row at a time', loadRowAtATime),
+                               ('bulk', loadInBulk)]:
+            dbpath = os.path.join(tempdir, name.replace(' ', '_'))
+            start = time.time()
+            function(dbpath, receipts)
+            times.append(time.time() - start)
+            print '%-15s %8.1fs' % (name, times[-1])
+        if (dbContents(os.path.join(tempdir, 'row_at_a_time'))
+                != dbContents(os.path.join(tempdir, 'bulk'))):
+            print >> sys.stderr, 'The databases have different contents!'
+            exit(-1)
+        print '%-15s %7.1fx' % ('speedup', times[0] / times[1])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
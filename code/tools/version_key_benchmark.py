@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+version_key_benchmark.py
+
+Compares the speed of munkicommon.MunkiLooseVersion and
+munkicommon.MunkiVersionKey for the version comparisons and sorts
+updatecheck does, and checks that both give the same answers.
+
+Run from a Munki source checkout:
+    ./version_key_benchmark.py [--versions N] [--repeat N]
+"""
+
+import optparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    os.pardir, 'client'))
+from munkilib import munkicommon
+
+
+def makeVersions(count):
+    '''Returns a list of version strings in a variety of styles'''
+    random.seed(0)
+    versions = []
+    for unused_index in range(count):
+        style = random.randint(0, 3)
+        major = random.randint(0, 20)
+        minor = random.randint(0, 12)
+        patch = random.randint(0, 9)
+        if style == 0:
+            versions.append('%s.%s' % (major, minor))
+        elif style == 1:
+            versions.append('%s.%s.%s' % (major, minor, patch))
+        elif style == 2:
+            versions.append('%s.%s.%s.0.0' % (major, minor, patch))
+        else:
+            versions.append('%s.%sb%s' % (major, minor, patch))
+    return versions
+
+
+def compareVersionsLoose(versions):
+    '''compareVersions-style pairwise comparisons with MunkiLooseVersion'''
+    for index in range(len(versions) - 1):
+        thisvers, thatvers = versions[index], versions[index + 1]
+        if (munkicommon.MunkiLooseVersion(thisvers) <
+                munkicommon.MunkiLooseVersion(thatvers)):
+            continue
+        elif (munkicommon.MunkiLooseVersion(thisvers) ==
+              munkicommon.MunkiLooseVersion(thatvers)):
+            continue
+
+
+def compareVersionsKey(versions):
+    '''compareVersions-style pairwise comparisons with MunkiVersionKey'''
+    for index in range(len(versions) - 1):
+        thiskey = munkicommon.MunkiVersionKey(versions[index])
+        thatkey = munkicommon.MunkiVersionKey(versions[index + 1])
+        if thiskey < thatkey:
+            continue
+        elif thiskey == thatkey:
+            continue
+
+
+def sortLoose(versions):
+    '''Sort newest first the way updatecheck used to'''
+    def compare_version_keys(a, b):
+        return cmp(munkicommon.MunkiLooseVersion(b),
+                   munkicommon.MunkiLooseVersion(a))
+    return sorted(versions, compare_version_keys)
+
+
+def sortKey(versions):
+    '''Sort newest first using MunkiVersionKey'''
+    return sorted(versions, key=munkicommon.MunkiVersionKey, reverse=True)
+
+
+def main():
+    '''Main'''
+    usage = '%prog [options]'
+    p = optparse.OptionParser(usage=usage)
+    p.add_option('--versions', type='int', default=2000,
+                 help='Number of version strings to use. Default 2000.')
+    p.add_option('--repeat', type='int', default=10,
+                 help='Number of times to run each test. Default 10.')
+    options, unused_arguments = p.parse_args()
+
+    versions = makeVersions(options.versions)
+
+    # sanity check: both should agree before we care which is faster
+    for index in range(len(versions) - 1):
+        thisvers, thatvers = versions[index], versions[index + 1]
+        if (cmp(munkicommon.MunkiLooseVersion(thisvers),
+                munkicommon.MunkiLooseVersion(thatvers)) !=
+                cmp(munkicommon.MunkiVersionKey(thisvers),
+                    munkicommon.MunkiVersionKey(thatvers))):
+            print >> sys.stderr, ('Comparison mismatch: %s vs %s'
+                                  % (thisvers, thatvers))
+            exit(-1)
+    if ([munkicommon.MunkiVersionKey(vers) for vers in sortLoose(versions)]
+            != [munkicommon.MunkiVersionKey(vers)
+                for vers in sortKey(versions)]):
+        print >> sys.stderr, 'Sort order mismatch'
+        exit(-1)
+
+    tests = [('compare', compareVersionsLoose, compareVersionsKey),
+             ('sort', sortLoose, sortKey)]
+    print '%-10s %18s %18s %8s' % ('test', 'MunkiLooseVersion',
+                                   'MunkiVersionKey', 'speedup')
+    for name, loose_function, key_function in tests:
+        loose_time = min(timeit.repeat(
+            lambda: loose_function(versions), number=1,
+            repeat=options.repeat))
+        key_time = min(timeit.repeat(
+            lambda: key_function(versions), number=1,
+            repeat=options.repeat))
+        print '%-10s %17.4fs %17.4fs %7.1fx' % (
+            name, loose_time, key_time, loose_time / key_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+catalogindex_test.py
+
+Unit tests for catalogindex.
+
+"""
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import plistlib
+import shutil
+import tempfile
+import time
+import unittest
+
+import catalogindex
+
+
+APP = {'name': u'Caf\xe9', 'version': '1.0',
+       'installer_item_hash': 'abc123',
+       'installer_item_location': 'apps/Cafe-1.0.dmg',
+       'receipts': [{'packageid': 'com.example.cafe', 'version': '1.0'}],
+       'installs': [{'type': 'application',
+                     'path': '/Applications/Cafe.app'}]}
+UPDATE = {'name': 'CafeUpdate', 'version': '1.0.1',
+          'update_for': [u'Caf\xe9']}
+TOOL = {'name': 'Tool', 'version': '2.0',
+        'installer_item_location': 'tools/Tool-2.0.pkg'}
+
+
+class TestCatalogIndex(unittest.TestCase):
+    """Test writing and reading the catalog index."""
+
+    def setUp(self):
+        self.catalogsdir = tempfile.mkdtemp()
+        self.catalogs = {'all': [APP, UPDATE, TOOL],
+                         'testing': [APP, UPDATE, TOOL],
+                         'production': [TOOL]}
+        for name, items in self.catalogs.items():
+            plistlib.writePlist(items, os.path.join(self.catalogsdir, name))
+        self.indexpath = os.path.join(
+            self.catalogsdir, catalogindex.INDEX_FILENAME)
+        catalogindex.writeIndex(
+            self.indexpath, self.catalogs, plistlib.writePlistToString)
+
+    def tearDown(self):
+        shutil.rmtree(self.catalogsdir)
+
+    def test_lookup_tables_match_catalog(self):
+        db = catalogindex.openIndex(self.catalogsdir)
+        self.assertEqual(
+            catalogindex.indexedLookupTables(db),
+            catalogindex.lookupTables(
+                catalogindex.lookupRows(self.catalogs['all'])))
+        self.assertEqual(
+            catalogindex.indexedLookupTables(db)['receipts'],
+            {'com.example.cafe': {'1.0': [0]}})
+
+    def test_items(self):
+        db = catalogindex.openIndex(self.catalogsdir)
+        items = catalogindex.IndexedItems(db, plistlib.readPlistFromString)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(items[2], TOOL)
+        self.assertRaises(IndexError, items.__getitem__, 3)
+
+    def test_names(self):
+        db = catalogindex.openIndex(self.catalogsdir)
+        self.assertEqual(sorted(catalogindex.catalogNames(db)),
+                         ['all', 'production', 'testing'])
+        self.assertEqual(
+            catalogindex.installerItemNames(db, ['testing']),
+            [u'Caf\xe9', 'Tool'])
+        self.assertEqual(
+            catalogindex.installerItemNames(db, ['production', 'missing']),
+            ['Tool'])
+
+    def test_index_older_than_a_catalog_is_ignored(self):
+        future = time.time() + 10
+        os.utime(os.path.join(self.catalogsdir, 'production'),
+                 (future, future))
+        self.assertEqual(catalogindex.openIndex(self.catalogsdir), None)
+
+    def test_catalog_replaced_with_old_mtime_is_noticed(self):
+        path = os.path.join(self.catalogsdir, 'production')
+        info = os.stat(path)
+        plistlib.writePlist([TOOL, APP], path + '.new')
+        os.rename(path + '.new', path)
+        os.utime(path, (info.st_atime, info.st_mtime - 3600))
+        self.assertEqual(catalogindex.openIndex(self.catalogsdir), None)
+
+    def test_added_or_removed_catalog_is_noticed(self):
+        plistlib.writePlist([TOOL], os.path.join(self.catalogsdir, 'new'))
+        self.assertEqual(catalogindex.openIndex(self.catalogsdir), None)
+        os.remove(os.path.join(self.catalogsdir, 'new'))
+        os.remove(os.path.join(self.catalogsdir, 'production'))
+        self.assertEqual(catalogindex.openIndex(self.catalogsdir), None)
+
+    def test_gzipped_copies_are_ignored(self):
+        shutil.copy(os.path.join(self.catalogsdir, 'production'),
+                    os.path.join(self.catalogsdir, 'production.gz'))
+        db = catalogindex.openIndex(self.catalogsdir)
+        self.assertNotEqual(db, None)
+        db.close()
+
+    def test_missing_index(self):
+        os.remove(self.indexpath)
+        self.assertEqual(catalogindex.openIndex(self.catalogsdir), None)
+
+
+def main():
+    unittest.main(buffer=True)
+
+
+if __name__ == '__main__':
+    main()
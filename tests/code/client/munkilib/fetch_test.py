@@ -0,0 +1,467 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+fetch_test.py
+
+Unit tests for fetch's in-process HTTP backend, run against a local
+HTTP server.
+
+"""
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import BaseHTTPServer
+import datetime
+import gzip
+import hashlib
+import os
+import shutil
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+
+import fetch
+import munkicommon
+
+
+CONTENT = ''.join(chr(index % 251) for index in range(300000))
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+GZIP_BUFFER = StringIO.StringIO()
+GZIP_FILE = gzip.GzipFile(fileobj=GZIP_BUFFER, mode='wb')
+GZIP_FILE.write(CONTENT)
+GZIP_FILE.close()
+GZIPPED_CONTENT = GZIP_BUFFER.getvalue()
+ETAG = '"munki-test-etag"'
+LAST_MODIFIED = 'Tue, 01 Apr 2014 12:00:00 GMT'
+
+
+def log(msg, logname=''):
+    """Redefine munkicommon's logging function so our tests don't write
+    a bunch of garbage to Munki's logs"""
+    pass
+munkicommon.log = log
+
+
+class TestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves CONTENT at /file with ETag, Range and gzip support, and at
+    /noranges without Range support. Stands in for a peer cache by serving the
+    server's peer_files at /peer/<hash>. 404 for anything else. Records
+    what it saw on the server object. Range requests ending at a byte in the
+    server's truncate_ends get only half their bytes, as many times as it
+    says."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        self.server.client_ports.add(self.client_address[1])
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if (self.path not in ['/file', '/noranges']
+                and self.path[6:] not in self.server.peer_files):
+            body = 'Not found'
+            self.send_response(404)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/peer/'):
+            body = self.server.peer_files[self.path[6:]]
+            self.send_response(200)
+            self.send_header('ETag', '"peer-etag"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        if_match = self.headers.get('If-Match')
+        if if_match and if_match != ETAG:
+            self.send_response(412)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if ('gzip' in self.headers.get('Accept-Encoding', '')
+                and not self.headers.get('Range')):
+            self.send_response(200)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(GZIPPED_CONTENT)))
+            self.end_headers()
+            self.wfile.write(GZIPPED_CONTENT)
+            return
+        start = 0
+        end = len(CONTENT) - 1
+        byte_range = self.headers.get('Range')
+        if (byte_range and byte_range.startswith('bytes=')
+                and self.path == '/file'):
+            (start, range_end) = byte_range[6:].split('-')
+            start = int(start)
+            if range_end:
+                end = min(int(range_end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s'
+                             % (start, end, len(CONTENT)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        if self.server.truncate_ends.get(end):
+            self.server.truncate_ends[end] -= 1
+            self.wfile.write(CONTENT[start:start + (end + 1 - start) // 2])
+            self.close_connection = 1
+            return
+        self.wfile.write(CONTENT[start:end + 1])
+
+
+class TestHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Handles each connection in its own thread, so segmented downloads
+    can have several connections open at once."""
+    daemon_threads = True
+
+
+class TestHTTPGet(unittest.TestCase):
+    """Test fetch.httpget against a local HTTP server."""
+
+    def setUp(self):
+        self.server = TestHTTPServer(('127.0.0.1', 0), TestRequestHandler)
+        self.server.requests = []
+        self.server.client_ports = set()
+        self.server.peer_files = {}
+        self.server.truncate_ends = {}
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.baseurl = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.tempdir = tempfile.mkdtemp()
+        self.destinationpath = os.path.join(self.tempdir, 'file')
+        fetch.CONNECTION_POOL.closeAll()
+
+    def tearDown(self):
+        fetch.CONNECTION_POOL.closeAll()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def readDestination(self):
+        return open(self.destinationpath, 'rb').read()
+
+    def test_download(self):
+        header = fetch.httpget(self.baseurl + '/file', self.destinationpath)
+        self.assertEqual(header['http_result_code'], '200')
+        self.assertEqual(header['etag'], ETAG)
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertFalse(os.path.exists(self.destinationpath + '.download'))
+
+    def test_download_caches_hash(self):
+        fetch.httpget(self.baseurl + '/file', self.destinationpath)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+
+    def test_etag_not_modified(self):
+        fetch.httpget(self.baseurl + '/file', self.destinationpath)
+        header = fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                               etag=ETAG)
+        self.assertEqual(header['http_result_code'], '304')
+        self.assertEqual(self.readDestination(), CONTENT)
+
+    def test_custom_headers(self):
+        fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                      custom_headers=['X-Munki-Test: yes'])
+        self.assertEqual(self.server.requests[-1][1].get('x-munki-test'),
+                         'yes')
+
+    def test_resume(self):
+        tempdownloadpath = self.destinationpath + '.download'
+        partial = open(tempdownloadpath, 'wb')
+        partial.write(CONTENT[:1000])
+        partial.close()
+        fetch.xattr.setxattr(tempdownloadpath, fetch.XATTR_ETAG, ETAG)
+        header = fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                               resume=True)
+        self.assertEqual(header['http_result_code'], '206')
+        self.assertEqual(self.server.requests[-1][1].get('range'),
+                         'bytes=1000-')
+        self.assertEqual(self.readDestination(), CONTENT)
+        # the cached hash covers the partial file we resumed from
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+
+    def test_resume_with_changed_etag_starts_over(self):
+        tempdownloadpath = self.destinationpath + '.download'
+        partial = open(tempdownloadpath, 'wb')
+        partial.write('stale data')
+        partial.close()
+        fetch.xattr.setxattr(tempdownloadpath, fetch.XATTR_ETAG, '"old"')
+        header = fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                               resume=True)
+        self.assertEqual(header['http_result_code'], '200')
+        self.assertEqual(self.readDestination(), CONTENT)
+
+    def test_uncompressed_by_default(self):
+        fetch.httpget(self.baseurl + '/file', self.destinationpath)
+        self.assertEqual(
+            self.server.requests[-1][1].get('accept-encoding'), 'identity')
+
+    def test_compressed(self):
+        header = fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                               compressed=True)
+        self.assertEqual(header['content-encoding'], 'gzip')
+        self.assertEqual(
+            self.server.requests[-1][1].get('accept-encoding'), 'gzip')
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+
+    def test_connection_reuse(self):
+        for unused_index in range(3):
+            fetch.httpget(self.baseurl + '/file', self.destinationpath)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_redirect(self):
+        header = fetch.httpget(self.baseurl + '/redirect',
+                               self.destinationpath, follow_redirects=True)
+        self.assertEqual(header['http_result_code'], '200')
+        self.assertEqual(self.readDestination(), CONTENT)
+
+    def test_not_found(self):
+        try:
+            fetch.httpget(self.baseurl + '/missing', self.destinationpath)
+        except fetch.CurlError, err:
+            self.assertEqual(err[0], 22)
+        else:
+            self.fail('CurlError not raised')
+        self.assertFalse(os.path.exists(self.destinationpath))
+
+    def test_rate_limit(self):
+        start = time.time()
+        fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                      rate_limit=600)
+        # 300000 bytes at 600 KB/sec takes about half a second
+        self.assertTrue(time.time() - start >= 0.4)
+        self.assertEqual(self.readDestination(), CONTENT)
+
+    def test_max_time_keeps_partial_download(self):
+        try:
+            fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                          resume=True, rate_limit=100, max_time=1)
+        except fetch.CurlError, err:
+            self.assertEqual(err[0], 28)
+        else:
+            self.fail('CurlError not raised')
+        tempdownloadpath = self.destinationpath + '.download'
+        self.assertTrue(0 < os.path.getsize(tempdownloadpath) < len(CONTENT))
+        self.assertEqual(
+            fetch.getxattr(tempdownloadpath, fetch.XATTR_ETAG), ETAG)
+
+    def test_segmented_download(self):
+        header = fetch.segmentedget(self.baseurl + '/file',
+                                    self.destinationpath, segments=4)
+        self.assertEqual(header['etag'], ETAG)
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertFalse(os.path.exists(self.destinationpath + '.download'))
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+        ranges = sorted(request[1].get('range')
+                        for request in self.server.requests)
+        self.assertEqual(len(ranges), 5)
+        self.assertTrue('bytes=0-0' in ranges)
+        for request in self.server.requests[1:]:
+            self.assertEqual(request[1].get('if-match'), ETAG)
+
+    def test_segmented_download_retries_failed_segment(self):
+        self.server.truncate_ends[150001] = 1
+        fetch.segmentedget(self.baseurl + '/file', self.destinationpath,
+                           segments=4)
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+
+    def test_segmented_download_resumes(self):
+        # fail more times than segmentedget retries
+        self.server.truncate_ends[150001] = fetch.SEGMENT_RETRIES + 1
+        try:
+            fetch.segmentedget(self.baseurl + '/file', self.destinationpath,
+                               segments=4)
+        except fetch.CurlError, err:
+            self.assertEqual(err[0], 18)
+        else:
+            self.fail('CurlError not raised')
+        tempdownloadpath = self.destinationpath + '.download'
+        self.assertTrue(
+            fetch.getxattr(tempdownloadpath, fetch.XATTR_SEGMENTS))
+        del self.server.requests[:]
+        fetch.segmentedget(self.baseurl + '/file', self.destinationpath,
+                           segments=4)
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SEGMENTS), None)
+        # only the rest of the failed segment is downloaded again
+        ranges = sorted(request[1].get('range')
+                        for request in self.server.requests)
+        self.assertEqual(len(ranges), 2)
+        self.assertTrue('bytes=0-0' in ranges)
+        resumed_start = int(ranges[1][6:].split('-')[0])
+        self.assertTrue(75001 < resumed_start < 150002)
+
+    def test_segmented_download_stops(self):
+        original_stoprequested = munkicommon.stopRequested
+        munkicommon.stopRequested = lambda: True
+        try:
+            self.assertRaises(fetch.CurlError, fetch.segmentedget,
+                              self.baseurl + '/file', self.destinationpath,
+                              segments=4)
+        finally:
+            munkicommon.stopRequested = original_stoprequested
+        self.assertTrue(
+            os.path.exists(self.destinationpath + '.download'))
+        self.assertFalse(os.path.exists(self.destinationpath))
+
+    def test_segmented_download_follows_redirect(self):
+        fetch.segmentedget(self.baseurl + '/redirect', self.destinationpath,
+                           follow_redirects=True, segments=3)
+        self.assertEqual(self.readDestination(), CONTENT)
+
+    def test_segmented_download_without_ranges(self):
+        header = fetch.segmentedget(self.baseurl + '/noranges',
+                                    self.destinationpath, segments=4)
+        self.assertEqual(header, None)
+        self.assertFalse(os.path.exists(self.destinationpath))
+        self.assertFalse(os.path.exists(self.destinationpath + '.download'))
+
+    def test_segmented_download_of_small_file(self):
+        header = fetch.segmentedget(self.baseurl + '/file',
+                                    self.destinationpath, segments=4,
+                                    minimum_size=len(CONTENT) + 1)
+        self.assertEqual(header, None)
+        self.assertFalse(os.path.exists(self.destinationpath))
+
+    def test_peer_cache(self):
+        self.server.peer_files[CONTENT_HASH] = CONTENT
+        self.assertTrue(fetch.getResourceFromPeer(
+            self.baseurl + '/peer/', CONTENT_HASH, self.destinationpath))
+        self.assertEqual(self.server.requests[-1][0], '/peer/' + CONTENT_HASH)
+        self.assertEqual(self.readDestination(), CONTENT)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_SHA),
+            CONTENT_HASH)
+        self.assertEqual(
+            fetch.getxattr(self.destinationpath, fetch.XATTR_ETAG), None)
+        self.assertFalse(os.path.exists(self.destinationpath + '.peer'))
+
+    def test_connect_timeout(self):
+        fetch.httpget(self.baseurl + '/file', self.destinationpath,
+                      connect_timeout=1)
+        self.assertEqual(self.readDestination(), CONTENT)
+        # the short timeout is only for connecting
+        (key, connection, reused) = fetch.CONNECTION_POOL.getConnection(
+            'http', self.baseurl[len('http://'):], None)
+        self.assertTrue(reused)
+        self.assertEqual(connection.sock.gettimeout(), fetch.HTTP_TIMEOUT)
+
+    def test_peer_cache_miss(self):
+        self.assertFalse(fetch.getResourceFromPeer(
+            self.baseurl + '/peer', CONTENT_HASH, self.destinationpath))
+        self.assertFalse(os.path.exists(self.destinationpath))
+
+    def test_peer_cache_bad_copy(self):
+        self.server.peer_files[CONTENT_HASH] = 'not the right content'
+        self.assertFalse(fetch.getResourceFromPeer(
+            self.baseurl + '/peer', CONTENT_HASH, self.destinationpath))
+        self.assertFalse(os.path.exists(self.destinationpath))
+        self.assertFalse(os.path.exists(self.destinationpath + '.peer'))
+
+
+class TestDownloadWindow(unittest.TestCase):
+    """Test fetch.getDownloadWindowTimeLeft."""
+
+    def setUp(self):
+        self.original_pref = munkicommon.pref
+        self.window = None
+        munkicommon.pref = lambda name: self.window
+
+    def tearDown(self):
+        munkicommon.pref = self.original_pref
+
+    def timeLeftAt(self, hour, minute):
+        """Returns getDownloadWindowTimeLeft() at hour:minute today"""
+        now = datetime.datetime.now().replace(hour=hour, minute=minute,
+                                              second=0)
+        return fetch.getDownloadWindowTimeLeft(now=now)
+
+    def test_no_window(self):
+        self.assertEqual(fetch.getDownloadWindowTimeLeft(), None)
+
+    def test_inside_window(self):
+        self.window = {'Start': '09:00', 'End': '17:00'}
+        self.assertEqual(self.timeLeftAt(16, 0), 3600)
+
+    def test_outside_window(self):
+        self.window = {'Start': '09:00', 'End': '17:00'}
+        self.assertEqual(self.timeLeftAt(8, 59), 0)
+        self.assertEqual(self.timeLeftAt(17, 0), 0)
+
+    def test_window_spanning_midnight(self):
+        self.window = {'Start': '22:00', 'End': '06:00'}
+        self.assertEqual(self.timeLeftAt(23, 0), 7 * 3600)
+        self.assertEqual(self.timeLeftAt(5, 0), 3600)
+        self.assertEqual(self.timeLeftAt(12, 0), 0)
+
+    def test_invalid_window_is_ignored(self):
+        self.window = {'Start': 'tonight'}
+        self.assertEqual(self.timeLeftAt(12, 0), None)
+
+    def test_window_error_without_cached_file(self):
+        now = datetime.datetime.now()
+        start = now + datetime.timedelta(hours=1)
+        end = now + datetime.timedelta(hours=2)
+        self.window = {'Start': start.strftime('%H:%M'),
+                       'End': end.strftime('%H:%M')}
+        self.assertRaises(
+            fetch.DownloadWindowError, fetch.getResourceIfChangedAtomically,
+            'http://127.0.0.1:1/file', '/nonexistent/file', windowed=True)
+
+
+def main():
+    unittest.main(buffer=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+manifestindex_test.py
+
+Unit tests for manifestindex.
+
+"""
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+import manifestindex
+
+
+class TestManifestIndex(unittest.TestCase):
+    """Test indexing and searching manifests."""
+
+    def setUp(self):
+        self.manifests_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.manifests_path, 'groups'))
+        self.writeManifest('site_default',
+                           {'catalogs': ['production'],
+                            'managed_installs': ['Firefox', 'Office2011']})
+        self.writeManifest('groups/lab',
+                           {'catalogs': ['testing', 'production'],
+                            'included_manifests': ['site_default'],
+                            'managed_installs': ['FirefoxESR', 'Firefox']})
+        self.writeManifest('lab-01',
+                           {'catalogs': ['testing'],
+                            'included_manifests': ['groups/lab']})
+        self.db = manifestindex.openIndex(self.manifests_path)
+        self.update()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.manifests_path)
+
+    def writeManifest(self, name, manifest):
+        plistlib.writePlist(manifest, os.path.join(self.manifests_path, name))
+
+    def update(self):
+        return manifestindex.updateIndex(
+            self.db, self.manifests_path,
+            ['site_default', 'groups/lab', 'lab-01'], plistlib.readPlist)
+
+    def test_find_text(self):
+        self.assertEqual(
+            manifestindex.findText(self.db, 'firefox'),
+            [('groups/lab', 'managed_installs', 'FirefoxESR'),
+             ('site_default', 'managed_installs', 'Firefox')])
+        self.assertEqual(
+            manifestindex.findText(self.db, 'lab', 'included_manifests'),
+            [('lab-01', 'included_manifests', 'groups/lab')])
+        self.assertEqual(manifestindex.findText(self.db, 'Safari'), [])
+
+    def test_manifests_with(self):
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'testing', 'catalogs'),
+            [('groups/lab', 'catalogs', 'testing'),
+             ('lab-01', 'catalogs', 'testing')])
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'Office2011'),
+            [('site_default', 'managed_installs', 'Office2011')])
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'Office2011',
+                                        recursive=True),
+            [('groups/lab', 'included_manifests', 'site_default'),
+             ('lab-01', 'included_manifests', 'groups/lab'),
+             ('site_default', 'managed_installs', 'Office2011')])
+
+    def test_only_changed_manifests_are_reindexed(self):
+        self.assertEqual(self.update(), 0)
+        self.writeManifest('lab-01', {'catalogs': ['testing'],
+                                      'managed_installs': ['Chrome']})
+        self.assertEqual(self.update(), 1)
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'Chrome'),
+            [('lab-01', 'managed_installs', 'Chrome')])
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'groups/lab'), [])
+
+    def test_removed_manifests_are_dropped(self):
+        os.remove(os.path.join(self.manifests_path, 'lab-01'))
+        self.assertEqual(
+            manifestindex.updateIndex(
+                self.db, self.manifests_path, ['site_default', 'groups/lab'],
+                plistlib.readPlist), 1)
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'groups/lab'), [])
+
+    def test_index_manifest(self):
+        manifest = {'catalogs': ['production'],
+                    'managed_installs': ['Firefox', 'Chrome']}
+        self.writeManifest('site_default', manifest)
+        manifestindex.indexManifest(
+            self.db, self.manifests_path, 'site_default', manifest)
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'Chrome'),
+            [('site_default', 'managed_installs', 'Chrome')])
+        # we already know about this version
+        self.assertEqual(self.update(), 0)
+
+    def test_index_pending_manifest(self):
+        manifest = {'catalogs': ['production'],
+                    'managed_installs': ['Firefox', 'Chrome']}
+        manifestindex.indexManifest(
+            self.db, self.manifests_path, 'site_default', manifest,
+            pending=True)
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'Chrome'),
+            [('site_default', 'managed_installs', 'Chrome')])
+        # the file on disk is read again once it's there
+        self.writeManifest('site_default', manifest)
+        self.assertEqual(self.update(), 1)
+
+    def test_unreadable_manifests(self):
+        open(os.path.join(self.manifests_path, 'lab-01'), 'w').write('bad')
+        self.update()
+        self.assertEqual(manifestindex.unreadableManifests(self.db),
+                         ['lab-01'])
+
+    def test_index_persists(self):
+        self.db.close()
+        self.db = manifestindex.openIndex(self.manifests_path)
+        self.assertEqual(self.update(), 0)
+        self.assertEqual(
+            manifestindex.manifestsWith(self.db, 'FirefoxESR'),
+            [('groups/lab', 'managed_installs', 'FirefoxESR')])
+
+
+def main():
+    unittest.main(buffer=True)
+
+
+if __name__ == '__main__':
+    main()
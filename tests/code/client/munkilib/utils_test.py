@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+utils_test.py
+
+Unit tests for utils.
+
+"""
+# Copyright 2014 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+import unittest
+
+import utils
+
+
+class TestRunConcurrently(unittest.TestCase):
+    """Test utils.runConcurrently."""
+
+    def test_results_are_in_item_order(self):
+        def slow_square(value):
+            # finish later items first
+            time.sleep(0.01 * (5 - value))
+            return value * value
+        results = utils.runConcurrently(slow_square, range(5), max_workers=5)
+        self.assertEqual(results, [(0, None), (1, None), (4, None),
+                                   (9, None), (16, None)])
+
+    def test_exceptions_are_returned(self):
+        def fail_on_odd(value):
+            if value % 2:
+                raise ValueError(value)
+            return value
+        results = utils.runConcurrently(fail_on_odd, range(4), max_workers=2)
+        self.assertEqual(results[0], (0, None))
+        self.assertEqual(results[2], (2, None))
+        self.assertEqual(results[1][0], None)
+        self.assertTrue(isinstance(results[1][1], ValueError))
+        self.assertTrue(isinstance(results[3][1], ValueError))
+
+    def test_max_workers_is_respected(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+        def track(unused_value):
+            lock.acquire()
+            state['running'] += 1
+            state['max_running'] = max(state['max_running'], state['running'])
+            lock.release()
+            time.sleep(0.02)
+            lock.acquire()
+            state['running'] -= 1
+            lock.release()
+        utils.runConcurrently(track, range(10), max_workers=3)
+        self.assertTrue(1 < state['max_running'] <= 3)
+
+    def test_single_worker_runs_in_calling_thread(self):
+        threads = utils.runConcurrently(
+            lambda unused_value: threading.current_thread(), range(3),
+            max_workers=1)
+        for thread, err in threads:
+            self.assertEqual(thread, threading.current_thread())
+            self.assertEqual(err, None)
+
+    def test_no_items(self):
+        self.assertEqual(utils.runConcurrently(len, []), [])
+
+
+class TestIterConcurrently(unittest.TestCase):
+    """Test utils.iterConcurrently."""
+
+    def test_results_are_in_item_order(self):
+        def slow_square(value):
+            # finish later items first
+            time.sleep(0.01 * (5 - value))
+            return value * value
+        results = list(utils.iterConcurrently(slow_square, range(5),
+                                              max_workers=5))
+        self.assertEqual(results, [(0, None), (1, None), (4, None),
+                                   (9, None), (16, None)])
+
+    def test_exceptions_are_returned(self):
+        def fail_on_odd(value):
+            if value % 2:
+                raise ValueError(value)
+            return value
+        results = list(utils.iterConcurrently(fail_on_odd, range(4),
+                                              max_workers=2))
+        self.assertEqual(results[0], (0, None))
+        self.assertEqual(results[2], (2, None))
+        self.assertEqual(results[1][0], None)
+        self.assertTrue(isinstance(results[3][1], ValueError))
+
+    def test_does_not_work_too_far_ahead(self):
+        started = []
+        def track(value):
+            started.append(value)
+            return value
+        results = utils.iterConcurrently(track, range(20), max_workers=2,
+                                         max_pending=3)
+        self.assertEqual(results.next(), (0, None))
+        time.sleep(0.05)
+        # items 1-3 may be done and waiting for us, but no more
+        self.assertTrue(len(started) <= 4)
+        results.close()
+
+    def test_stopping_early_skips_the_rest(self):
+        started = []
+        def track(value):
+            started.append(value)
+            time.sleep(0.01)
+            return value
+        results = utils.iterConcurrently(track, range(50), max_workers=2)
+        results.next()
+        results.close()
+        time.sleep(0.05)
+        self.assertTrue(len(started) < 10)
+
+    def test_single_worker_runs_in_calling_thread(self):
+        for thread, err in utils.iterConcurrently(
+                lambda unused_value: threading.current_thread(), range(3),
+                max_workers=1):
+            self.assertEqual(thread, threading.current_thread())
+            self.assertEqual(err, None)
+
+
+def main():
+    unittest.main(buffer=True)
+
+
+if __name__ == '__main__':
+    main()